@@ -22,6 +22,7 @@
 
 import os
 import sys
+import syslog
 import subprocess
 import pluginsmf
 
@@ -29,6 +30,12 @@ from time_slider import smf, autosnapsmf, util
 
 PLUGINBASEFMRI = "svc:/application/time-slider/plugin"
 
+# How often, in seconds, to check on a running plugin that has
+# deferred triggers waiting for it.
+DRAININTERVAL = 60
+# Maximum number of deferred triggers kept per plugin.
+MAXDEFERRED = 256
+
 
 class Plugin(Exception):
 
@@ -37,6 +44,8 @@ class Plugin(Exception):
         util.debug("Instantiating plugin for:\t%s" % (instanceName), self.verbose)
         self.smfInst = pluginsmf.PluginSMF(instanceName)
         self._proc = None
+        # List of (schedule, label) triggers waiting to be executed
+        self.deferred = []
 
         # Note that the associated plugin service's start method checks
         # that the command is defined and executable. But SMF doesn't 
@@ -68,12 +77,33 @@ class Plugin(Exception):
             except ValueError:
                 return
 
+        # Triggers are queued and executed one at a time, in order, by
+        # drain() whenever the plugin is not already running and it is
+        # within one of the plugin's permitted time windows.
+        self.deferred.append((schedule, label))
+        if len(self.deferred) > MAXDEFERRED:
+            schedule,label = self.deferred.pop(0)
+            syslog.syslog(syslog.LOG_WARNING,
+                          "Plugin: %s: Too many deferred triggers. " \
+                          "Dropping trigger for: %s" \
+                          % (self.smfInst.instanceName, label))
+        self.drain()
+
+    def drain(self):
+        """
+        Executes the oldest deferred trigger if possible. Returns the
+        number of seconds after which drain() should be called again,
+        or None if there are no more deferred triggers.
+        """
+        if len(self.deferred) == 0:
+            return None
+
         # Skip if already running
         if self.is_running() == True:
-            util.debug("Plugin: %s is already running. Skipping execution" \
-                       % (self.smfInst.instanceName), \
+            util.debug("Plugin: %s is already running. Deferring " \
+                       "execution" % (self.smfInst.instanceName), \
                        self.verbose)
-            return
+            return DRAININTERVAL
         # Skip if plugin FMRI has been disabled or placed into maintenance
         cmd = [smf.SVCSCMD, "-H", "-o", "state", self.smfInst.instanceName]
         outdata,errdata = util.run_command(cmd)
@@ -82,8 +112,19 @@ class Plugin(Exception):
             util.debug("Plugin: %s is in %s state. Skipping execution" \
                        % (self.smfInst.instanceName, state), \
                        self.verbose)
-            return
+            self.deferred = []
+            return None
+
+        wait = pluginsmf.seconds_until_window(self.smfInst.get_windows())
+        if wait > 0:
+            util.debug("Plugin: %s is outside of its time windows. " \
+                       "Deferring %d triggers for %d seconds" \
+                       % (self.smfInst.instanceName, len(self.deferred),
+                          wait), \
+                       self.verbose)
+            return wait
 
+        schedule,label = self.deferred.pop(0)
         cmd = self.smfInst.get_trigger_command()
         util.debug("Executing plugin command: %s" % str(cmd), self.verbose)
         svcFmri = "%s:%s" % (autosnapsmf.BASESVC, schedule)
@@ -100,6 +141,9 @@ class Plugin(Exception):
             raise RuntimeError, "%s subprocess error:\n %s" % \
                                 (cmd, str(message))
             self._proc = None
+        if len(self.deferred) > 0:
+            return DRAININTERVAL
+        return None
 
     def is_running(self):
         if self._proc == None:
@@ -129,8 +173,30 @@ class PluginManager():
         for plugin in self.plugins:
             plugin.execute(schedule, label)
 
+    def drain_plugins(self):
+        """
+        Executes deferred plugin triggers where possible. Returns the
+        number of seconds after which drain_plugins() should be called
+        again, or None if nothing is deferred.
+        """
+        wait = None
+        for plugin in self.plugins:
+            try:
+                pluginWait = plugin.drain()
+            except RuntimeError, message:
+                sys.stderr.write("Failed to execute deferred trigger of " \
+                                 "plugin: %s\n%s\n" \
+                                 % (plugin.smfInst.instanceName, message))
+                continue
+            if pluginWait != None and (wait == None or pluginWait < wait):
+                wait = pluginWait
+        return wait
+
 
     def refresh(self):
+        # Hang on to triggers deferred by the current plugins
+        deferred = dict([(plugin.smfInst.instanceName, plugin.deferred) \
+                         for plugin in self.plugins])
         self.plugins = []
         cmd = [smf.SVCSCMD, "-H", "-o", "state,FMRI", PLUGINBASEFMRI]
 
@@ -157,6 +223,7 @@ class PluginManager():
                 util.debug("Found enabled plugin:\t%s" % (fmri), self.verbose)
                 try:
                     plugin = Plugin(fmri, self.verbose)
+                    plugin.deferred = deferred.get(fmri, [])
                     self.plugins.append(plugin)
                 except RuntimeError, message:
                     sys.stderr.write("Ignoring misconfigured plugin: %s\n" \
@@ -23,6 +23,7 @@
 import os
 import sys
 import subprocess
+import time
 from os.path import abspath, dirname, join, pardir
 sys.path.insert(0, join(dirname(__file__), pardir))
 from time_slider import smf, autosnapsmf, util
@@ -37,6 +38,7 @@ class PluginSMF(smf.SMFInstance):
         smf.SMFInstance.__init__(self, instanceName)
         self.triggerCommand = None
         self.triggers = None
+        self.windows = None
 
     def get_trigger_command(self):
         # FIXME Use mutex locking for MT safety
@@ -57,6 +59,33 @@ class PluginSMF(smf.SMFInstance):
                 self.triggers.append(trigger.strip())
         return self.triggers
 
+    def get_windows(self):
+        """
+        Returns the times of day the plugin is permitted to run during
+        as a list of (start, end) tuples in minutes after midnight. An
+        empty list means any time of day.
+        """
+        #FIXME Use mutex locking to make MT-safe
+        if self.windows == None:
+            try:
+                value = self.get_prop(PLUGINPROPGROUP, "windows")
+            except RuntimeError:
+                # Not defined by older plugin instances
+                value = ""
+            self.windows = parse_windows(value.strip().replace('\\', ''))
+        return self.windows
+
+    def get_bwlimit(self):
+        """
+        Returns the bandwidth limit in KB per second for the data the
+        plugin transfers, or 0 if unlimited
+        """
+        try:
+            result = self.get_prop(PLUGINPROPGROUP, "bwlimit").strip()
+            return max(int(result), 0)
+        except (RuntimeError, ValueError):
+            return 0
+
     def get_verbose(self):
         value = self.get_prop(PLUGINPROPGROUP, "verbose")
         if value == "true":
@@ -64,3 +93,54 @@ class PluginSMF(smf.SMFInstance):
         else:
             return False
 
+
+def parse_windows(value):
+    """
+    Parses a comma separated list of time of day windows of the form
+    "HH:MM-HH:MM", such as "22:00-06:00", into a list of (start, end)
+    tuples in minutes after midnight. A window that ends before it
+    starts spans midnight. "00:00-24:00" is open all day. Invalid
+    windows, including empty ones that start and end at the same
+    time, are ignored.
+    """
+    windows = []
+    for window in value.split(','):
+        window = window.strip()
+        if len(window) == 0:
+            continue
+        try:
+            start,end = [t.strip().split(':') for t in window.split('-')]
+            start = int(start[0]) * 60 + int(start[1])
+            end = int(end[0]) * 60 + int(end[1])
+            if start < 0 or start >= 1440 or end < 0 or end > 1440 or \
+               start == end:
+                raise ValueError
+        except (ValueError, IndexError):
+            sys.stderr.write("Ignoring invalid time window: %s\n" % (window))
+            continue
+        windows.append((start, end))
+    return windows
+
+def seconds_until_window(windows, now=None):
+    """
+    Returns the number of seconds until the next of windows opens, or
+    0 if one of them is currently open or there are none.
+    """
+    if len(windows) == 0:
+        return 0
+    if now == None:
+        now = time.time()
+    tm = time.localtime(now)
+    minute = tm.tm_hour * 60 + tm.tm_min
+    wait = None
+    for start,end in windows:
+        if start <= end:
+            inside = start <= minute < end
+        else:
+            inside = minute >= start or minute < end
+        if inside:
+            return 0
+        minutes = (start - minute) % 1440
+        if wait == None or minutes < wait:
+            wait = minutes
+    return max(wait * 60 - tm.tm_sec, 1)
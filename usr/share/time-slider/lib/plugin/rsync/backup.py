@@ -36,10 +36,14 @@ import gio
 import dbus
 import shutil
 import copy
+import errno
 from bisect import insort, bisect_left
 
 from time_slider import util, zfs, dbussvc, autosnapsmf, timeslidersmf
+from plugin import pluginsmf
 import rsyncsmf
+import pendingqueue
+import reaper
 
 
 # Set to True if SMF property value of "plugin/command" is "true"
@@ -100,10 +104,87 @@ class RsyncSourceVanishedError(RsyncError):
         RsyncError.__init__(self, msg)
 
 
+class SnapshotDiff:
+    """
+    The set of paths that differ between two snapshots of the same
+    filesystem, as reported by zfs diff. Paths are relative to the
+    root of the filesystem.
+    """
+
+    def __init__(self, refSnapshot, snapshot, mountPoint, sourceDir):
+        """
+        Keyword arguments:
+        refSnapshot -- zfs.Snapshot the previous backup was made from
+        snapshot -- zfs.Snapshot being backed up. Must be newer than
+                    refSnapshot
+        mountPoint -- Mountpoint of the snapshots' filesystem
+        sourceDir -- Path to snapshot under <mountPoint>/.zfs/snapshot
+        """
+        # Paths that rsync needs to transfer
+        self.changed = set()
+        # Paths that must not be linked from the previous backup
+        self.removed = set()
+        for entry in refSnapshot.diff(snapshot):
+            paths = [self._relative_path(mountPoint, path) \
+                     for path in entry[1:]]
+            if entry[0] == "-":
+                self.removed.add(paths[0])
+            elif entry[0] == "R":
+                self.removed.add(paths[0])
+                self._add_changed(paths[1])
+                # zfs diff only reports the rename of a directory, not
+                # its contents, which are new paths as far as the
+                # backup is concerned.
+                newDir = os.path.join(sourceDir, paths[1])
+                if os.path.isdir(newDir) and not os.path.islink(newDir):
+                    for root, dirs, files in os.walk(newDir):
+                        for name in dirs + files:
+                            path = os.path.join(root, name)
+                            self.changed.add(os.path.relpath(path, sourceDir))
+            else:
+                self._add_changed(paths[0])
+
+    def _relative_path(self, mountPoint, path):
+        path = os.path.relpath(path, mountPoint)
+        return os.path.normpath(path)
+
+    def _add_changed(self, path):
+        # Listing the parent directories makes rsync restore their
+        # attributes after it writes the changed path into them.
+        while path not in self.changed:
+            self.changed.add(path)
+            if path == os.path.curdir:
+                break
+            path = os.path.dirname(path) or os.path.curdir
+
+    def write_file_list(self, fileObj):
+        """
+        Writes the changed paths in a format suitable for use with
+        rsync's --files-from and --from0 options.
+        """
+        for path in sorted(self.changed):
+            fileObj.write(path + '\0')
+
+    def list_stale(self, latest):
+        """
+        Returns the paths in the previous backup at latest that must
+        not be carried over into the new one: everything removed, and
+        changed paths other than directories, whose unchanged contents
+        still get carried over.
+        """
+        paths = set(self.removed)
+        for path in self.changed:
+            oldPath = os.path.join(latest, path)
+            if not os.path.isdir(oldPath) or os.path.islink(oldPath):
+                paths.add(path)
+        return sorted(paths)
+
+
 class RsyncProcess(threading.Thread):
 
 
-    def __init__(self, source, target, latest=None, verbose=False, logfile=None):
+    def __init__(self, source, target, latest=None, verbose=False,
+                 logfile=None, changes=None, bwlimit=0):
 
         self._sourceDir = source
         self._backupDir = target
@@ -112,10 +193,22 @@ class RsyncProcess(threading.Thread):
         self._proc = None
         self._forkError = None
         self._logFile = logfile
+        # Optional SnapshotDiff between latest and source
+        self._changes = changes
+        # Bandwidth limit in KB per second, or 0 for unlimited
+        self._bwlimit = bwlimit
+        self._filesFrom = None
         # Init done. Now initiaslise threading.
         threading.Thread.__init__ (self)
 
     def run(self):
+        if self._changes:
+            try:
+                self._link_unchanged()
+            except (OSError, RuntimeError) as e:
+                self._forkError = "Failed to link unchanged files " \
+                                  "from %s: %s" % (self._latest, str(e))
+                return
         try:
             self._proc = subprocess.Popen(self._cmd,
                                           stderr=subprocess.PIPE,
@@ -127,6 +220,35 @@ class RsyncProcess(threading.Thread):
         else:
             self._stdout,self._stderr = self._proc.communicate()
             self._exitValue = self._proc.wait()
+        if self._filesFrom:
+            os.unlink(self._filesFrom)
+
+    def _link_unchanged(self):
+        """
+        Populates the backup directory with hard links to every file in
+        the previous backup that zfs diff didn't report as changed or
+        removed, so that rsync only needs to look at changed paths.
+        The whole previous backup is hard linked by cp -al, which only
+        needs to read it rather than compare it with the new backup,
+        and then the paths zfs diff reported are removed again. Changed files mustn't stay linked to the previous backup
+        since rsync updates them in place.
+        """
+        # Solaris cp(1) can't create hard links, GNU cp can
+        cmd = ["/usr/gnu/bin/cp", "-al", "--remove-destination",
+               "%s/." % (self._latest),
+               self._backupDir]
+        util.run_command(cmd)
+        for path in self._changes.list_stale(self._latest):
+            path = os.path.join(self._backupDir, path)
+            try:
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.unlink(path)
+            except OSError, e:
+                # Already gone with a removed parent directory
+                if e.errno != errno.ENOENT:
+                    raise
 
     def _check_exit_code(self):
         if self._forkError:
@@ -191,7 +313,19 @@ class RsyncProcess(threading.Thread):
             # or status needs to be set.
             return
 
-        if self._latest:
+        if self._latest and self._changes:
+            # Only pass the paths zfs diff reported as changed to rsync.
+            # Note that -a does not imply -r when used with --files-from
+            fd,self._filesFrom = tempfile.mkstemp(prefix="rsync-files.")
+            fileObj = os.fdopen(fd, 'w')
+            self._changes.write_file_list(fileObj)
+            fileObj.close()
+            self._cmd = ["/usr/bin/rsync", "-a", "--inplace",\
+                   "--from0", "--files-from=%s" % (self._filesFrom), \
+                   "%s/." % (self._sourceDir), \
+                   "--link-dest=%s" % (self._latest), \
+                   self._backupDir]
+        elif self._latest:
             self._cmd = ["/usr/bin/rsync", "-a", "--inplace",\
                    "%s/." % (self._sourceDir), \
                    "--link-dest=%s" % (self._latest), \
@@ -203,6 +337,8 @@ class RsyncProcess(threading.Thread):
 
         if self._logFile:
             self._cmd.insert(1, "--log-file=%s" % (self._logFile))
+        if self._bwlimit > 0:
+            self._cmd.insert(1, "--bwlimit=%d" % (self._bwlimit))
         if self._verbose:
             self._cmd.insert(1, "-vv")
 
@@ -219,6 +355,9 @@ class BackupQueue():
         self._smfInst = rsyncsmf.RsyncSMF(self._pluginFMRI)
         self._verbose = self._smfInst.get_verbose()
         self._rsyncVerbose = self._smfInst.get_rsync_verbose()
+        self._zfsDiff = self._smfInst.get_zfs_diff()
+        self._bwlimit = self._smfInst.get_bwlimit()
+        self._windows = self._smfInst.get_windows()
         self._propName = "%s:%s" % (propbasename, fmri.rsplit(':', 1)[1])
 
         # Variables to quickly access time sorted backups and 
@@ -233,8 +372,12 @@ class BackupQueue():
                        self._verbose)
 
         self._tempSchedules = None
-        # List of all snapshots currently in our backup queue
-        self._pendingList = list_pending_snapshots(self._propName)
+        # Persistent queue of pending snapshots, and the list of all
+        # snapshots currently in it, sorted newest first.
+        self._pendingQueue = pendingqueue.PendingQueue(self._propName,
+                                                       self._verbose)
+        self._pendingQueue.load()
+        self._pendingList = self._pendingQueue.list()
 
         # Try to backup in sets of snapshots grouped by a common
         # snapshot label. These get taken from the head of the
@@ -242,8 +385,18 @@ class BackupQueue():
         # pending list gets refreshed and a new working set is
         # extracted.
         self._currentQueueSet = []
-        self._skipList = []
+        self._skipped = set()
         self._queueLength = 0
+        # Snapshots in the current working set that we have placed
+        # a hold on, and those of them that have been successfully
+        # backed up but not yet marked as completed. Holds and
+        # completion markers are applied in bulk per working set.
+        self._heldList = []
+        self._completedList = []
+        # Maps filesystems of the current working set to their
+        # mountpoints, or None if they are not mounted.
+        self._mountPoints = {}
+        self._datasets = zfs.Datasets()
 
         self._cleanupThreshold = self._smfInst.get_cleanup_threshold()
         if self._cleanupThreshold < 1 or \
@@ -271,32 +424,26 @@ class BackupQueue():
         # Finally go look for the backup device
         self._find_backup_device()
 
+        # Backups deleted to recover space are trashed and then
+        # removed in the background, rate limited to avoid slowing
+        # down backups in progress.
+        self._reaper = reaper.TrashReaper(self._rsyncDir,
+                                          self._smfInst.get_cleanup_bwlimit(),
+                                          self._verbose,
+                                          self._space_reclaimed)
+
     def empty_trash_folders(self):
-        trashDirs = []
-        trashedBackups = []
-        os.chdir(self._rsyncDir)
-        for root, dirs, files in os.walk(self._rsyncDir):
-            if '.time-slider' in dirs:
-                dirs.remove ('.time-slider')
-                trashDir = os.path.join(root,
-                                        rsyncsmf.RSYNCTRASHSUFFIX)
-                if os.path.exists(trashDir):
-                    trashDirs.append(trashDir)
-        for trashDir in trashDirs:
-            os.chdir(trashDir)
-            trashItems = []
-            trashItems = [d for d in os.listdir(trashDir) \
-                          if os.path.isdir(d) and
-                          not os.path.islink(d)]
-            if len(trashItems) > 0:
-                util.debug("Deleting trash backups in %s" % (trashDir),
-                           self._verbose)
-            for trashItem in trashItems:
-                util.debug("Deleting trash item: %s" % (trashItem),
-                           self._verbose)
-                # FIXME add some dbus notification here to let the
-                # applet know what's going on.
-                shutil.rmtree(trashItem)
+        """
+           Hands everything in the trash on the backup device to the
+           trash reaper, including anything left over by a reaper that
+           was interrupted.
+        """
+        self._reaper.resume()
+
+    def _space_reclaimed(self, path, freed):
+        util.debug("Recovered %d bytes deleting trash item: %s" \
+                   % (freed, path), self._verbose)
+        self._bus.rsync_reclaimed(self._rsyncBaseDir, freed)
 
     def _get_temp_schedules(self):
         # Get retention rule for non archival snapshots as per
@@ -330,6 +477,7 @@ class BackupQueue():
         backupDirs = []
         partialDirs = []
         deadBackups = []
+        pendingNames = set([name for ctime,name in self._pendingList])
         os.chdir(self._rsyncDir)
         for root, dirs, files in os.walk(self._rsyncDir):
             if '.time-slider' in dirs:
@@ -351,7 +499,6 @@ class BackupQueue():
             baseName = dirName.replace(prefix, '', 1).lstrip('/')
             fsName = baseName.replace(suffix, '', 1).rstrip('/')
             for snapshotLabel in partials:
-                pending = False
                 # Reconstruct the origin snapshot name and see
                 # if it's still pending rsync backup. If it is
                 # then leave it alone since it can be used to
@@ -359,11 +506,7 @@ class BackupQueue():
                 # never going to be backed up and needs to be
                 # manually deleted.
                 snapshotName = "%s@%s" % (fsName, snapshotLabel)
-                for ctime,name in self._pendingList:
-                    if name == snapshotName:
-                        pending = True
-                        continue
-                if pending == False:
+                if snapshotName not in pendingNames:
                     util.debug("Deleting zombied partial backup: %s" \
                                % (os.path.abspath(snapshotLabel)),
                                self._verbose)
@@ -530,15 +673,18 @@ class BackupQueue():
                     # filesystem afterwards, which is a waste of time
                     # and space.
                     pending = [name for time,name in \
-                               list_pending_snapshots(self._propName) if \
+                               self._pendingQueue.list() if \
                                name.find(snapshot.fsname + '@') == 0]
-                    cmd = [zfs.PFCMD, zfs.ZFSCMD, "inherit", self._propName]
-                    util.debug("Unqueuing pending backups of deselected " \
-                               "filesystem: " + snapshot.fsname + '\n' + \
-                               str(pending),
-                               self._verbose)
-                    cmd.extend(pending)
-                    util.run_command(cmd)
+                    if len(pending) > 0:
+                        cmd = [zfs.PFCMD, zfs.ZFSCMD, "inherit",
+                               self._propName]
+                        util.debug("Unqueuing pending backups of " \
+                                   "deselected filesystem: " + \
+                                   snapshot.fsname + '\n' + str(pending),
+                                   self._verbose)
+                        util.run_command_chunked(cmd, pending)
+                        self._pendingQueue.remove(pending)
+                        self._pendingQueue.save()
 
             lockFileDir = os.path.join(head,
                                        os.path.pardir,
@@ -574,16 +720,25 @@ class BackupQueue():
         return deleteables
 
     def _recover_space(self, deleteables):
-
-        # Important:
-        # Don't actually loop throught this list fully. Break out
-        # as soon as pool capacity is beneath the threshhold level
-        # again.
+        """
+           Trashes the oldest backups in deleteables, one at a time,
+           until usage of the backup device is back beneath the cleanup
+           threshold, and hands them to the trash reaper for deletion.
+           Nothing more is trashed while the reaper still has backups
+           to delete since that may recover enough space by itself.
+           There's no telling how much in advance: files hard linked
+           between consecutive backups are only freed once all of
+           them are gone. Returns the backups in deleteables that
+           remain.
+        """
         remainder = deleteables[:]
         for mtime,dirName in deleteables:
+            # Important:
+            # Don't actually loop throught this list fully. Break out
+            # as soon as pool capacity is beneath the threshhold level
+            # again.
             if util.get_filesystem_capacity(self._rsyncDir) < \
-               self._cleanupThreshold:
-                # No need to delete anything further
+               self._cleanupThreshold or self._reaper.is_busy():
                 return remainder
             lockFile = None
             lockFp = None
@@ -617,7 +772,7 @@ class BackupQueue():
                                  os.path.pardir,
                                  os.path.pardir,
                                  rsyncsmf.RSYNCTRASHSUFFIX)
-            trashDir = os.path.join(trash, tail)
+            trashDir = os.path.abspath(os.path.join(trash, tail))
 
             if not os.path.exists(trash):
                 os.makedirs(trash, 0755)
@@ -627,7 +782,7 @@ class BackupQueue():
             os.rename(dirName, trashDir)
             lockFp.close()
             os.unlink(lockFile)
-            shutil.rmtree(trashDir)
+            self._reaper.add(trashDir)
             # Remove the log file if it exists
             logFile = os.path.join(head,
                                    os.path.pardir,
@@ -640,14 +795,86 @@ class BackupQueue():
                 util.debug("Expected to find log file %s when deleting %s " \
                            "during space recovery" % (logFile, dirName),
                            self._verbose)
-            # Remove dirName from the backup list
+            # Remove dirName from the backup list and times
             idx = bisect_left(self._backups, [mtime, dirName])
             del self._backups[idx]
+            try:
+                del self._backupTimes[head][tail]
+            except KeyError:
+                pass
             # Remove if from the remainder list too
             idx = bisect_left(remainder, [mtime, dirName])
             del remainder[idx]
         return remainder
 
+    def _build_queue_set(self):
+        """
+           Constructs a new working set queue from the head of the
+           pending list. Identifies the newest snapshot and then all
+           snapshots with a matching snapshot label. Holds are placed
+           on the whole set and the mount status of their filesystems
+           is looked up in bulk.
+        """
+        ctime,headSnapName = self._pendingList[0]
+        label = headSnapName.rsplit("@", 1)[1]
+        queueSet = [(ctime,snapName) for \
+                    ctime,snapName in self._pendingList if \
+                    snapName.rsplit("@", 1)[1] == label]
+
+        # Place a hold on the snapshots so they don't go anywhere
+        # while rsync is trying to back them up. Snapshots that
+        # were destroyed since the pending list was generated
+        # can't be held and get dropped from the set.
+        self._heldList = self._datasets.hold_snapshots(self._propName,
+                                                       [snapName for \
+                                                        ctime,snapName in \
+                                                        queueSet])
+        held = set(self._heldList)
+        vanished = []
+        for ctime,snapName in queueSet:
+            if snapName not in held:
+                util.debug("Snapshot: %s no longer exists. Skipping" \
+                           % (snapName), self._verbose)
+                vanished.append(snapName)
+        if len(vanished) > 0:
+            self._pendingQueue.remove(vanished)
+            self._pendingQueue.save()
+        self._currentQueueSet = [(ctime,snapName) for \
+                                 ctime,snapName in queueSet if \
+                                 snapName in held]
+
+        fsNames = [snapName.split('@', 1)[0] for \
+                   ctime,snapName in self._currentQueueSet]
+        props = self._datasets.get_properties(["mounted", "mountpoint"],
+                                              fsNames)
+        self._mountPoints = {}
+        for fsName in fsNames:
+            try:
+                if props[fsName]["mounted"] == "yes":
+                    self._mountPoints[fsName] = props[fsName]["mountpoint"]
+                else:
+                    self._mountPoints[fsName] = None
+            except KeyError:
+                self._mountPoints[fsName] = None
+
+    def _finalise_queue_set(self):
+        """
+           Marks all snapshots backed up so far from the current working
+           set as completed and releases the holds placed on the set.
+           Must be called before exiting once a working set has been
+           built.
+        """
+        if len(self._completedList) > 0:
+            self._datasets.set_user_property(self._propName, "completed",
+                                             self._completedList)
+            self._pendingQueue.remove(self._completedList)
+            self._pendingQueue.save()
+        if len(self._heldList) > 0:
+            self._datasets.release_snapshots(self._propName,
+                                             self._heldList)
+        self._completedList = []
+        self._heldList = []
+
     def backup_snapshot(self):
         # First, check to see if the rsync destination
         # directory is accessible.
@@ -687,18 +914,19 @@ class BackupQueue():
 
         if len(self._currentQueueSet) == 0:
             # Means we are just getting started or have just completed
-            # backup of one full set of snapshots. Clear out anything
-            # we may have moved to the trash during the previous 
-            # backup set iterations.
+            # backup of one full set of snapshots. Record the results
+            # of the previous set and clear out anything we may have
+            # moved to the trash during the previous backup set
+            # iterations.
+            self._finalise_queue_set()
             self.empty_trash_folders()
-            # Refresh the pending list and build a new working set queue
-            self._pendingList = list_pending_snapshots(self._propName)
-            # Remove skipped items to avoid infinite looping.
-            for item in self._skipList:
-                try:
-                    self._pendingList.remove(item)
-                except ValueError:
-                    pass
+            # Refresh the pending list, picking up snapshots triggered
+            # since the backup started, and build a new working set
+            # queue. Remove skipped items to avoid infinite looping.
+            self._pendingQueue.merge_journals()
+            self._pendingList = [(ctime,snapName) for ctime,snapName in \
+                                 self._pendingQueue.list() if \
+                                 snapName not in self._skipped]
             if len(self._pendingList) == 0:
                 # If something was actually backed up, signal
                 # that it is now completed.
@@ -710,16 +938,11 @@ class BackupQueue():
                     self._mainLoop.quit()
                 sys.exit(0)
             else:
-                # Construct a new working set queue
-                # Identify the newest snapshot and then all
-                # snapshots with a matching snapshot label
                 self._queueLength = len(self._pendingList)
-                ctime,headSnapName = self._pendingList[0]
-                label = headSnapName.rsplit("@", 1)[1]
-                self._currentQueueSet = \
-                    [(ctime,snapName) for \
-                     ctime,snapName in self._pendingList if \
-                     snapName.rsplit("@", 1)[1] == label]
+                self._build_queue_set()
+                if len(self._currentQueueSet) == 0:
+                    # Everything in the set vanished. Try the next one.
+                    return True
 
 
         if len(self._backups) > 0:
@@ -750,6 +973,7 @@ class BackupQueue():
                                         self._cleanupThreshold,
                                         time.ctime(oldestBackupTime)),
                                 self._verbose)
+                    self._finalise_queue_set()
                     if self._started == True:
                         self._bus.rsync_complete(self._rsyncBaseDir)
                     self._bus.rsync_synced()
@@ -758,30 +982,35 @@ class BackupQueue():
                         self._mainLoop.quit()
                     sys.exit(0)
 
+        # Leave the rest of the pending backups until the next time
+        # window opens. cron(1) will invoke us again before then.
+        wait = pluginsmf.seconds_until_window(self._windows)
+        if wait > 0:
+            util.debug("Outside of the permitted backup time windows. " \
+                       "Deferring pending backups for %d minutes" \
+                       % (wait / 60),
+                       self._verbose)
+            self._finalise_queue_set()
+            if self._started == True:
+                self._bus.rsync_complete(self._rsyncBaseDir)
+            self._bus.rsync_unsynced(len(self._pendingList))
+            if self._mainLoop:
+                self._mainLoop.quit()
+            sys.exit(0)
+
         if self._started == False:
             self._started = True
             self._bus.rsync_started(self._rsyncBaseDir)
 
         ctime,snapName = self._currentQueueSet[0]
         snapshot = zfs.Snapshot(snapName, long(ctime))
-        # Make sure the snapshot didn't get destroyed since we last
-        # checked it.
+        # The snapshot is already held by _build_queue_set() so
+        # it can't have been destroyed since.
         remainingList = self._currentQueueSet[1:]
-        if snapshot.exists() == False:
-            util.debug("Snapshot: %s no longer exists. Skipping" \
-                        % (snapName), self._verbose)
-            self._currentQueueSet = remainingList
-            return True
-
-        # Place a hold on the snapshot so it doesn't go anywhere
-        # while rsync is trying to back it up.
-        snapshot.hold(self._propName)
         self._queueLength -= 1
-        fs = zfs.Filesystem(snapshot.fsname)
         sourceDir = None
-        if fs.is_mounted() == True:
-            # Get the mountpoint
-            mountPoint = fs.get_mountpoint()
+        mountPoint = self._mountPoints.get(snapshot.fsname)
+        if mountPoint != None:
             sourceDir = "%s/.zfs/snapshot/%s" \
                         % (mountPoint, snapshot.snaplabel)
         else:
@@ -791,8 +1020,7 @@ class BackupQueue():
             # get expired by time-sliderd
             util.debug("%s is not mounted. Skipping." \
                         % (snapshot.fsname), self._verbose)
-            snapshot.release(self._propName)
-            self._skipList.append(ctime, snapName)
+            self._skipped.add(snapName)
             self._currentQueueSet = remainingList
             return True
 
@@ -821,6 +1049,14 @@ class BackupQueue():
         # backupDir is the full directory path where the new
         # backup will be located ie <targetDir>/<snapshot label>
         backupDir = os.path.join(targetDir, snapshot.snaplabel)
+        if os.path.exists(backupDir):
+            # Completed by a previous invocation that exited before
+            # it got to mark the snapshot as completed.
+            util.debug("%s is already backed up to %s" \
+                       % (snapshot.name, backupDir), self._verbose)
+            self._completedList.append(snapshot.name)
+            self._currentQueueSet = remainingList
+            return True
 
         # Figure out the closest previous backup. Since we
         # backup newest first instead of oldest first it's
@@ -887,14 +1123,43 @@ class BackupQueue():
                            "backup reference point: %s. Exiting" \
                            % (lockFile), self._verbose)
                 os.chdir("/")
-                snapshot.release(self._propName)
+                self._finalise_queue_set()
                 sys.exit(1)
 
+        # If the incremental reference backup is older than the
+        # snapshot, zfs diff can tell us exactly which files rsync
+        # needs to look at. This requires the snapshot the reference
+        # backup was made from to still exist, otherwise fall back to
+        # a full walk of the snapshot.
+        changes = None
+        if linkDest and nearestNewer == None and self._zfsDiff:
+            refSnapshot = zfs.Snapshot("%s@%s" % (snapshot.fsname, link))
+            if refSnapshot.exists():
+                try:
+                    changes = SnapshotDiff(refSnapshot, snapshot,
+                                           mountPoint, sourceDir)
+                    util.debug("zfs diff found %d changed paths " \
+                               "since %s" \
+                               % (len(changes.changed), refSnapshot.name),
+                               self._verbose)
+                except RuntimeError, message:
+                    util.debug("zfs diff failed. Performing full " \
+                               "rsync of %s:\n%s" \
+                               % (snapshot.name, str(message)),
+                               self._verbose)
+            else:
+                util.debug("Snapshot %s no longer exists. Performing " \
+                           "full rsync of %s" \
+                           % (refSnapshot.name, snapshot.name),
+                           self._verbose)
+
         self._rsyncProc = RsyncProcess(sourceDir,
                                        partialDir,
                                        linkDest,
                                        self._rsyncVerbose,
-                                       logFile)
+                                       logFile,
+                                       changes,
+                                       self._bwlimit)
 
         # Notify the applet of current status via dbus
         self._bus.rsync_current(snapshot.name, self._queueLength)
@@ -909,6 +1174,7 @@ class BackupQueue():
         self._rsyncProc.start_backup()
 
         warningDone = False
+        deleteables = None
         while self._rsyncProc.is_alive():
             if len(self._backups) > 0:
                 # Monitor backup target capacity while we wait for rsync.
@@ -916,8 +1182,10 @@ class BackupQueue():
                 if capacity > self._cleanupThreshold:
                     # Find backups older than qTime that could in theory
                     # be deleted in order to make room for the curtent
-                    # pending item.
-                    deleteables = self._find_deleteable_backups(qTime)
+                    # pending item. Only needs doing once since
+                    # _recover_space() keeps the list up to date.
+                    if deleteables == None:
+                        deleteables = self._find_deleteable_backups(qTime)
                     # Only generate annoying debug message once instead of
                     # every 5 seconds.
                     if warningDone == False:
@@ -937,7 +1205,7 @@ class BackupQueue():
                 RsyncTargetDisconnectedError,
                 RsyncSourceVanishedError) as e:
             os.chdir("/")
-            snapshot.release(self._propName)
+            self._finalise_queue_set()
             util.log_error(syslog.LOG_ERR, str(e))
             # These are recoverable, so exit for now and try again
             # later
@@ -956,7 +1224,7 @@ class BackupQueue():
             util.log_error(syslog.LOG_ERR,
                            "Placing plugin into maintenance mode")
             self._smfInst.mark_maintenance()
-            snapshot.release(self._propName)
+            self._finalise_queue_set()
             sys.exit(-1)
 
         finally:
@@ -981,8 +1249,7 @@ class BackupQueue():
         # Update the dictionary and time sorted list with ctime also
         self._backupTimes[targetDir][snapshot.snaplabel] = long(ctime)
         insort(self._backups, [long(ctime), os.path.abspath(backupDir)]) 
-        snapshot.set_user_property(self._propName, "completed")
-        snapshot.release(self._propName)
+        self._completedList.append(snapshot.name)
         self._currentQueueSet = remainingList
         
         # Now is a good time to clean out the directory:
@@ -1084,6 +1351,7 @@ class BackupQueue():
                                     "Placing plugin into " \
                                     "maintenance state" % (dirName))
                     self._smfInst.mark_maintenance()
+                    self._finalise_queue_set()
                     sys.exit(-1)
         return True
 
@@ -1098,27 +1366,14 @@ def release_held_snapshots(propName):
     """ 
     # First narrow the list down by finding snapshots
     # with userref count > 0
-    heldList = []
-    released = []
-    cmd = [zfs.ZFSCMD, "list", "-H",
-           "-t", "snapshot",
-           "-o", "userrefs,name"]
-    outdata,errdata = util.run_command(cmd)
-    for line in outdata.rstrip().split('\n'):
-        holdCount,name = line.split()
-        if int(holdCount) > 0:
-            heldList.append(name)
+    datasets = zfs.Datasets()
+    heldList = datasets.list_held_snapshots()
     # Now check to see if any of those holds
     # match 'propName'
-    for snapName in heldList:
-        snapshot = zfs.Snapshot(snapName)
-        holds = snapshot.holds()
-        try:
-            holds.index(propName)
-            snapshot.release(propName)
-            released.append(snapName)
-        except ValueError:
-            pass
+    holds = datasets.list_holds(heldList)
+    released = [snapName for snapName in heldList \
+                if propName in holds.get(snapName, [])]
+    datasets.release_snapshots(propName, released)
     return released
 
 
@@ -1138,68 +1393,6 @@ def backup_name_to_snapshot_name(path):
     snapshotName = "%s@%s" % (fsName, snapLabel)
     return snapshotName
 
-def list_pending_snapshots(propName):
-    """
-    Lists all snaphots which have 'propName" set locally.
-    Resulting list is returned sorted in descending order
-    of creation time (ie.newest first).
-    Each element in the returned list is tuple of the form:
-    [creationtime, snapshotname]
-    """
-    results = []
-    snaplist = []
-    sortsnaplist = []
-    # The process for backing up snapshots is:
-    # Identify all filesystem snapshots that have the (propName)
-    # property set to "pending" on them. Back them up starting
-    # with the oldest first.
-    #
-    # Unfortunately, there's no single zfs command that can
-    # output a locally set user property and a creation timestamp
-    # in one go. So this is done in two passes. The first pass
-    # identifies snapshots that are tagged as "pending". The 
-    # second pass uses the filtered results from the first pass
-    # as arguments to zfs(1) to get creation times.
-    cmd = [zfs.ZFSCMD, "get", "-H",
-            "-s", "local",
-            "-o", "name,value",
-            propName]
-    outdata,errdata = util.run_command(cmd)
-    for line in outdata.rstrip().split('\n'):
-        if len(line) > 1:
-            line = line.split()
-            results.append(line)
-
-    for name,value in results:
-        if value != "pending":
-            # Already backed up. Skip it."
-            continue
-        if name.find('@') == -1:
-            # Not a snapshot, and should not be set on a filesystem/volume
-            # Ignore it.
-            util.log_error(syslog.LOG_WARNING,
-                           "Dataset: %s shouldn't have local property: %s" \
-                           % (name, propName))
-            continue
-        snaplist.append(name)
-
-    # Nothing pending so just return the empty list
-    if len(snaplist) == 0:
-        return snaplist
-
-    cmd = [zfs.ZFSCMD, "get", "-p", "-H",
-            "-o", "value,name",
-            "creation"]
-    cmd.extend(snaplist)
-
-    outdata,errdata = util.run_command(cmd)
-    for line in outdata.rstrip().split('\n'):
-        ctimeStr,name = line.split()
-        insort(sortsnaplist, tuple((long(ctimeStr), name)))
-    sortsnaplist.reverse()
-    return sortsnaplist
-
-
 def main(argv):
     # This command needs to be executed by the super user (root) to
     # ensure that rsync has permissions to access all local filesystem
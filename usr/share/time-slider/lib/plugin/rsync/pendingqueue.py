@@ -0,0 +1,261 @@
+#!/usr/bin/python2.6
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at usr/src/OPENSOLARIS.LICENSE
+# or http://www.opensolaris.org/os/licensing.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at usr/src/OPENSOLARIS.LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+
+import os
+import os.path
+import tempfile
+import time
+import syslog
+
+from time_slider import util, zfs
+import rsyncsmf
+
+# How often the queue gets rebuilt from scratch using zfs(1),
+# regardless of what the trigger command has told us.
+RECONCILEINTERVAL = 24 * 60 * 60
+
+QUEUESUFFIX = ".queue"
+JOURNALSUFFIX = ".pending"
+# Separates the instance name from the snapshot label in journal file
+# names. Can't appear in SMF instance names, so an instance never picks
+# up the journals of another whose name it is a prefix of.
+JOURNALSEP = "@"
+
+
+class PendingQueue:
+    """
+    Persistent queue of snapshots pending rsync backup for an rsync
+    plugin instance. Avoids having to search every dataset on the
+    system for the plugin's "pending" property each time the queue
+    is needed.
+
+    The queue is saved to a state file by the backup process only.
+    The trigger command adds newly pending snapshots to the queue by
+    writing a journal file for each snapshot set, which gets merged
+    in by the backup process on load() or merge_journals() and
+    deleted on the following save(). The queue is
+    reconciled against the actual zfs property values if the state
+    file is missing or more than RECONCILEINTERVAL seconds old.
+    """
+
+    def __init__(self, propName, verbose=False):
+        self._propName = propName
+        self._verbose = verbose
+        self._instance = propName.rsplit(':', 1)[1]
+        self._queueFile = os.path.join(rsyncsmf.RSYNCQUEUEDIR,
+                                       self._instance + QUEUESUFFIX)
+        # Maps snapshot name to creation time
+        self._snapshots = {}
+        self._lastReconcile = 0
+        self._journals = []
+
+    def load(self):
+        """
+        Loads the saved queue and merges in any journals written by
+        the trigger command since it was saved. Rebuilds the queue
+        from zfs(1) instead if necessary.
+        """
+        self._snapshots = {}
+        self._lastReconcile = 0
+        try:
+            f = open(self._queueFile, 'r')
+            self._lastReconcile = long(f.readline())
+            for line in f:
+                ctime,name = line.rstrip('\n').split(' ', 1)
+                self._snapshots[name] = long(ctime)
+            f.close()
+        except (IOError, ValueError):
+            self._lastReconcile = 0
+
+        if time.time() - self._lastReconcile > RECONCILEINTERVAL:
+            self.reconcile()
+        else:
+            self.merge_journals()
+
+    def reconcile(self):
+        """Rebuilds the queue from the zfs property values"""
+        util.debug("Rebuilding pending rsync backup queue from zfs " \
+                   "properties", self._verbose)
+        # Journals are redundant after this so get rid of them too.
+        self._journals = self._list_journals()
+        self._lastReconcile = long(time.time())
+        self._snapshots = {}
+        for ctime,name in list_pending_snapshots(self._propName):
+            self._snapshots[name] = ctime
+
+    def _list_journals(self):
+        try:
+            names = os.listdir(rsyncsmf.RSYNCQUEUEDIR)
+        except OSError:
+            return []
+        return [os.path.join(rsyncsmf.RSYNCQUEUEDIR, name) for name in names \
+                if name.find(self._instance + JOURNALSEP) == 0 and \
+                name.endswith(JOURNALSUFFIX)]
+
+    def merge_journals(self):
+        """
+        Merges in the journals written by the trigger command since
+        the queue was loaded or last saved.
+        """
+        self._journals = self._list_journals()
+        for journal in self._journals:
+            try:
+                f = open(journal, 'r')
+                for line in f:
+                    ctime,name = line.rstrip('\n').split(' ', 1)
+                    self._snapshots[name] = long(ctime)
+                f.close()
+            except (IOError, ValueError):
+                util.log_error(syslog.LOG_WARNING,
+                               "Ignoring unreadable pending rsync backup " \
+                               "journal: %s" % (journal))
+
+    def remove(self, names):
+        """
+        Removes the snapshots in names from the queue. Needs to be
+        followed by save() to make the change persistent.
+        """
+        for name in names:
+            try:
+                del self._snapshots[name]
+            except KeyError:
+                pass
+
+    def save(self):
+        """
+        Saves the queue to its state file and deletes the journals
+        merged in by load()
+        """
+        if not os.path.exists(rsyncsmf.RSYNCQUEUEDIR):
+            os.makedirs(rsyncsmf.RSYNCQUEUEDIR, 0755)
+        fd,tempFile = tempfile.mkstemp(dir=rsyncsmf.RSYNCQUEUEDIR)
+        f = os.fdopen(fd, 'w')
+        f.write("%d\n" % (self._lastReconcile))
+        for name,ctime in self._snapshots.items():
+            f.write("%d %s\n" % (ctime, name))
+        f.close()
+        os.chmod(tempFile, 0644)
+        os.rename(tempFile, self._queueFile)
+        for journal in self._journals:
+            try:
+                os.unlink(journal)
+            except OSError:
+                pass
+        self._journals = []
+
+    def list(self):
+        """
+        Returns the queue as a list sorted in descending order of
+        creation time (ie. newest first) in the same form as
+        list_pending_snapshots()
+        """
+        result = [(ctime, name) for name,ctime in self._snapshots.items()]
+        result.sort(reverse=True)
+        return result
+
+    def __len__(self):
+        return len(self._snapshots)
+
+
+def append_pending_snapshots(propName, snapshots, label):
+    """
+    Adds the snapshots in the snapshot set "label" to the pending queue
+    of the rsync plugin instance matching propName by writing a journal
+    for the backup process to pick up. Each element of snapshots is a
+    tuple of the form: (creationtime, snapshotname)
+    """
+    instance = propName.rsplit(':', 1)[1]
+    if not os.path.exists(rsyncsmf.RSYNCQUEUEDIR):
+        os.makedirs(rsyncsmf.RSYNCQUEUEDIR, 0755)
+    # Write to a temporary file first so that the backup process
+    # never sees a partially written journal.
+    fd,tempFile = tempfile.mkstemp(dir=rsyncsmf.RSYNCQUEUEDIR)
+    f = os.fdopen(fd, 'w')
+    for ctime,name in snapshots:
+        f.write("%d %s\n" % (ctime, name))
+    f.close()
+    os.chmod(tempFile, 0644)
+    os.rename(tempFile,
+              os.path.join(rsyncsmf.RSYNCQUEUEDIR,
+                           "%s%s%s%s" % (instance, JOURNALSEP, label,
+                                         JOURNALSUFFIX)))
+
+
+def list_pending_snapshots(propName):
+    """
+    Lists all snaphots which have 'propName" set locally.
+    Resulting list is returned sorted in descending order
+    of creation time (ie.newest first).
+    Each element in the returned list is tuple of the form:
+    [creationtime, snapshotname]
+    """
+    results = []
+    snaplist = []
+    sortsnaplist = []
+    # The process for backing up snapshots is:
+    # Identify all filesystem snapshots that have the (propName)
+    # property set to "pending" on them. Back them up starting
+    # with the oldest first.
+    #
+    # Unfortunately, there's no single zfs command that can
+    # output a locally set user property and a creation timestamp
+    # in one go. So this is done in two passes. The first pass
+    # identifies snapshots that are tagged as "pending". The
+    # second pass uses the filtered results from the first pass
+    # as arguments to zfs(1) to get creation times.
+    cmd = [zfs.ZFSCMD, "get", "-H",
+            "-s", "local",
+            "-o", "name,value",
+            propName]
+    outdata,errdata = util.run_command(cmd)
+    for line in outdata.rstrip().split('\n'):
+        if len(line) > 1:
+            line = line.split()
+            results.append(line)
+
+    for name,value in results:
+        if value != "pending":
+            # Already backed up. Skip it."
+            continue
+        if name.find('@') == -1:
+            # Not a snapshot, and should not be set on a filesystem/volume
+            # Ignore it.
+            util.log_error(syslog.LOG_WARNING,
+                           "Dataset: %s shouldn't have local property: %s" \
+                           % (name, propName))
+            continue
+        snaplist.append(name)
+
+    # Nothing pending so just return the empty list
+    if len(snaplist) == 0:
+        return snaplist
+
+    cmd = [zfs.ZFSCMD, "get", "-p", "-H",
+            "-o", "value,name",
+            "creation"]
+
+    outdata,errdata = util.run_command_chunked(cmd, snaplist)
+    for line in outdata.rstrip().split('\n'):
+        ctimeStr,name = line.split()
+        sortsnaplist.append(tuple((long(ctimeStr), name)))
+    sortsnaplist.sort(reverse=True)
+    return sortsnaplist
@@ -0,0 +1,303 @@
+#!/usr/bin/python2.6
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at usr/src/OPENSOLARIS.LICENSE
+# or http://www.opensolaris.org/os/licensing.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at usr/src/OPENSOLARIS.LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+
+import os
+import os.path
+import sys
+import stat
+import time
+import fcntl
+import threading
+import syslog
+import gobject
+import dbus
+import dbus.service
+import dbus.mainloop
+import dbus.mainloop.glib
+
+from time_slider import util, dbussvc
+import rsyncsmf
+
+# Nominal number of bytes of I/O charged against the bandwidth limit
+# for each directory entry removed, on top of any data blocks freed.
+# Stops trees of millions of tiny files from bypassing the throttle.
+ENTRYCOST = 4096
+
+# Seconds between attempts to take over the backup device's reaper
+# lock file from another reaper.
+LOCKRETRYDELAY = 30
+
+
+def list_trash(rsyncDir):
+    """
+    Returns the paths of all trashed backups found beneath the rsync
+    backup directory rsyncDir.
+    """
+    trashItems = []
+    for root, dirs, files in os.walk(rsyncDir):
+        if '.time-slider' in dirs:
+            dirs.remove('.time-slider')
+            trashDir = os.path.join(root, rsyncsmf.RSYNCTRASHSUFFIX)
+            if not os.path.exists(trashDir):
+                continue
+            for d in os.listdir(trashDir):
+                path = os.path.join(trashDir, d)
+                if os.path.isdir(path) and not os.path.islink(path):
+                    trashItems.append(path)
+    return trashItems
+
+
+class TrashReaper:
+    """
+    Deletes trashed backup directory trees beneath the rsync backup
+    directory rsyncDir in a background thread so that callers only
+    need to rename a backup into the trash. Deletion is throttled to
+    roughly bwlimit kilobytes per second so that it doesn't compete
+    with rsync for the backup device's bandwidth. A bwlimit of 0 means
+    unthrottled.
+
+    Only one reaper at a time, in any process, deletes from a given
+    backup device. It holds the device's reaper lock file and, before
+    giving it up, takes over anything else that has been trashed in
+    the meantime. The other reapers check back every LOCKRETRYDELAY
+    seconds and give up once everything they had queued is gone, so
+    they never hold up their own process. Trees are deleted bottom up
+    so an interrupted deletion leaves a smaller but otherwise intact
+    tree in the trash, which resume() picks up again later.
+
+    If supplied, callback is invoked with the path and the number of
+    bytes recovered each time a trashed tree has been deleted.
+    """
+
+    def __init__(self, rsyncDir, bwlimit=0, verbose=False, callback=None):
+        self._rsyncDir = rsyncDir
+        self._bwlimit = bwlimit * 1024
+        self._verbose = verbose
+        self._callback = callback
+        self._lock = threading.Lock()
+        self._thread = None
+        self._running = False
+        # Paths still to be deleted. The head of the list is the one
+        # currently being deleted.
+        self._queue = []
+        # Bytes freed so far from the tree currently being deleted.
+        self._freed = 0
+
+    def add(self, path):
+        """Queues the trashed directory tree at path for deletion"""
+        self._lock.acquire()
+        try:
+            if path in self._queue:
+                return
+            self._queue.append(path)
+            if self._running == False:
+                # The thread is deliberately not a daemon thread so
+                # that the process finishes emptying the trash before
+                # it exits.
+                self._running = True
+                self._thread = threading.Thread(target=self._run)
+                self._thread.start()
+        finally:
+            self._lock.release()
+
+    def resume(self):
+        """
+        Queues everything currently in the trash on the backup device
+        for deletion, including trees left partially deleted by a
+        previous reaper.
+        """
+        for path in list_trash(self._rsyncDir):
+            self.add(path)
+
+    def is_busy(self):
+        self._lock.acquire()
+        try:
+            return len(self._queue) > 0
+        finally:
+            self._lock.release()
+
+    def wait(self):
+        """
+        Blocks until everything queued has been deleted, by this
+        reaper's thread or by another reaper that took it over,
+        including anything queued while waiting.
+        """
+        while True:
+            self._lock.acquire()
+            thread = self._thread
+            running = self._running
+            self._lock.release()
+            if running == False:
+                return
+            thread.join()
+
+    def _run(self):
+        lockFile = os.path.join(self._rsyncDir, rsyncsmf.RSYNCREAPERLOCKFILE)
+        try:
+            lockFp = open(lockFile, 'w')
+        except IOError, message:
+            util.log_error(syslog.LOG_ERR,
+                           "Can't lock trash reaper lock file: %s\n%s" \
+                           % (lockFile, str(message)))
+            self._lock.acquire()
+            self._queue = []
+            self._running = False
+            self._lock.release()
+            return
+        while True:
+            try:
+                fcntl.flock(lockFp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except IOError:
+                pass
+            # Another reaper is working on this device. It takes over
+            # whatever we have queued before it finishes.
+            self._lock.acquire()
+            self._queue = [path for path in self._queue \
+                           if os.path.isdir(path)]
+            if len(self._queue) == 0:
+                lockFp.close()
+                self._running = False
+                self._lock.release()
+                return
+            self._lock.release()
+            time.sleep(LOCKRETRYDELAY)
+        failed = []
+        while True:
+            self._lock.acquire()
+            if len(self._queue) == 0:
+                # Take over anything trashed since, including what
+                # other reapers waiting on the lock file have queued.
+                self._lock.release()
+                trash = [path for path in list_trash(self._rsyncDir) \
+                         if not path in failed]
+                self._lock.acquire()
+                for path in trash:
+                    if not path in self._queue:
+                        self._queue.append(path)
+            if len(self._queue) == 0:
+                # Still holding self._lock so add() can't queue
+                # anything else for this thread before it unlocks.
+                lockFp.close()
+                self._running = False
+                self._lock.release()
+                return
+            path = self._queue[0]
+            self._freed = 0
+            self._lock.release()
+            if os.path.isdir(path):
+                try:
+                    self._delete_tree(path)
+                except OSError, message:
+                    failed.append(path)
+                    util.log_error(syslog.LOG_ERR,
+                                   "Failed to delete trashed backup: " \
+                                   "%s\n%s" % (path, str(message)))
+            self._lock.acquire()
+            freed = self._freed
+            del self._queue[0]
+            self._freed = 0
+            self._lock.release()
+            if self._callback and freed > 0:
+                self._callback(path, freed)
+
+    def _delete_tree(self, path):
+        util.debug("Deleting trash item: %s" % (path), self._verbose)
+        startTime = time.time()
+        charged = 0
+        for root, dirs, files in os.walk(path, topdown=False):
+            entries = [(name, False) for name in files] + \
+                      [(name, True) for name in dirs]
+            for name,isDir in entries:
+                entry = os.path.join(root, name)
+                st = os.lstat(entry)
+                if isDir and stat.S_ISDIR(st.st_mode):
+                    os.rmdir(entry)
+                else:
+                    # Includes symbolic links to directories
+                    os.unlink(entry)
+                size = st.st_blocks * 512
+                charged += size + ENTRYCOST
+                if isDir or st.st_nlink == 1:
+                    self._lock.acquire()
+                    self._freed += size
+                    self._lock.release()
+                if self._bwlimit > 0:
+                    # Sleep off any time we are ahead of the limit
+                    ahead = charged / float(self._bwlimit) - \
+                            (time.time() - startTime)
+                    if ahead > 0.1:
+                        time.sleep(ahead)
+        os.rmdir(path)
+        util.debug("Deleted trash item: %s in %.1f seconds" \
+                   % (path, time.time() - startTime), self._verbose)
+
+
+def main(argv):
+    # Trashed backups are owned by root since they were created by
+    # rsync-backup running as root.
+    if os.geteuid() != 0:
+        head,tail = os.path.split(sys.argv[0])
+        sys.stderr.write(tail + " can only be executed by root")
+        sys.exit(-1)
+
+    # The rsync backup directory to empty the trash of needs to be
+    # supplied as the argument immediately proceeding the command.
+    try:
+        rsyncDir = sys.argv[1]
+    except IndexError:
+        sys.stderr.write("No rsync backup directory defined. Exiting\n")
+        sys.exit(-1)
+
+    # Followed by the SMF fmri of the rsync plugin instance the backup
+    # directory belongs to, whose cleanup settings apply.
+    try:
+        pluginFMRI = sys.argv[2]
+    except IndexError:
+        sys.stderr.write("No time-slider plugin SMF instance FMRI " \
+                         "defined. Exiting\n")
+        sys.exit(-1)
+
+    syslog.openlog(sys.argv[0], 0, syslog.LOG_DAEMON)
+    # Stay out of the way of everything else as much as possible
+    os.nice(19)
+
+    smfInst = rsyncsmf.RsyncSMF(pluginFMRI)
+    verbose = smfInst.get_verbose()
+
+    gobject.threads_init()
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    dbus.mainloop.glib.threads_init()
+    sysbus = dbus.SystemBus()
+    dbusObj = dbussvc.RsyncBackup(sysbus, \
+        "/org/opensolaris/TimeSlider/plugin/rsync")
+
+    def reclaimed(path, freed):
+        dbusObj.rsync_reclaimed(rsyncDir, freed)
+
+    reaper = TrashReaper(rsyncDir,
+                         smfInst.get_cleanup_bwlimit(),
+                         verbose,
+                         reclaimed)
+    reaper.resume()
+    reaper.wait()
+    sys.exit(0)
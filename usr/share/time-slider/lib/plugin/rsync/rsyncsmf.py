@@ -33,7 +33,13 @@ RSYNCTRASHSUFFIX = ".time-slider/.trash"
 RSYNCLOCKSUFFIX = ".time-slider/.rsync-lock"
 RSYNCLOGSUFFIX = ".time-slider/.rsync-log"
 RSYNCCONFIGFILE = ".rsync-config"
+RSYNCREAPERLOCKFILE = ".rsync-reaper.lock"
+RSYNCREAPERCMD = "/usr/lib/time-slider/plugins/rsync/rsync-reaper"
 RSYNCFSTAG = "org.opensolaris:time-slider-rsync"
+RSYNCQUEUEDIR = "/var/tmp/time-slider/rsync"
+# Trash removal rate in KB per second for instances configured before
+# the cleanup_bwlimit property existed. Matches the manifest default.
+RSYNCCLEANUPBWLIMIT = 10240
 
 class RsyncSMF(pluginsmf.PluginSMF):
 
@@ -45,6 +51,17 @@ class RsyncSMF(pluginsmf.PluginSMF):
         result = self.get_prop(RSYNCPROPGROUP, "cleanup_threshold").strip()
         return int(result)
 
+    def get_cleanup_bwlimit(self):
+        """
+        Returns the rate in KB per second at which the trash on the
+        backup device gets removed, or 0 if unlimited
+        """
+        try:
+            result = self.get_prop(RSYNCPROPGROUP, "cleanup_bwlimit").strip()
+            return max(int(result), 0)
+        except (RuntimeError, ValueError):
+            return RSYNCCLEANUPBWLIMIT
+
     def get_target_dir(self):
         result = self.get_prop(RSYNCPROPGROUP, "target_dir").strip()
         # Strip out '\' characters inserted by svcprop
@@ -78,6 +95,13 @@ class RsyncSMF(pluginsmf.PluginSMF):
         else:
             return False
 
+    def get_zfs_diff(self):
+        value = self.get_prop(RSYNCPROPGROUP, "zfs_diff")
+        if value == "true":
+            return True
+        else:
+            return False
+
     def __str__(self):
         ret = "SMF Instance:\n" +\
               "\tName:\t\t\t%s\n" % (self.instance_name) +\
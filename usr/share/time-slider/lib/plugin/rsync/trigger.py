@@ -26,6 +26,7 @@ import subprocess
 import syslog
 
 import rsyncsmf
+import pendingqueue
 from time_slider import util, smf, zfs
 
 # Set to True if SMF property value of "plugin/command" is "true"
@@ -102,8 +103,8 @@ def main(argv):
     autosnapfs = [name for [name,mount] in datasets.list_filesystems() \
                    if name in autosnapsets]
     snappeddatasets = []
-    snapnames = [name for [name,ctime] in candidates \
-                 if name.split('@',1)[0] in autosnapfs]
+    snaptimes = dict([(name,ctime) for [name,ctime] in candidates \
+                      if name.split('@',1)[0] in autosnapfs])
 
     # Mark the snapshots with a user property. Doing this instead of
     # placing a physical hold on the snapshot allows time-slider to
@@ -115,16 +116,30 @@ def main(argv):
     # We set org.opensolaris:time-slider-plugin:<instance> to "pending",
     # indicate
     snapshots = []
-    for snap in snapnames:
+    for snap in snaptimes.keys():
         snapshot = zfs.Snapshot(snap)
         fs = zfs.Filesystem(snapshot.fsname)
         if fs.get_user_property(rsyncsmf.RSYNCFSTAG) == "true":
             if fs.is_mounted() == True:
-                snapshot.set_user_property(propname, "pending")
                 util.debug("Marking %s as pending rsync" % (snap), verbose)
+                snapshots.append((snaptimes[snap], snap))
             else:
                 util.debug("Ignoring snapshot of unmounted fileystem: %s" \
                            % (snap), verbose)
+    if len(snapshots) == 0:
+        return
+    datasets.set_user_property(propname, "pending",
+                               [snap for ctime,snap in snapshots])
+
+    # Let the backup process know about the new snapshots so it
+    # doesn't need to search the whole system for pending snapshots.
+    try:
+        pendingqueue.append_pending_snapshots(propname, snapshots, snaplabel)
+    except (IOError, OSError), message:
+        log_error(syslog.LOG_WARNING,
+                  "Failed to add snapshots to the pending rsync backup " \
+                  "queue. They will be backed up after the queue is " \
+                  "next rebuilt:\n%s" % (message))
 
 def maintenance(svcfmri):
     log_error(syslog.LOG_ERR,
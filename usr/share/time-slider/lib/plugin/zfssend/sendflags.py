@@ -0,0 +1,164 @@
+#!/usr/bin/python2.6
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at usr/src/OPENSOLARIS.LICENSE
+# or http://www.opensolaris.org/os/licensing.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at usr/src/OPENSOLARIS.LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+
+
+import os
+import os.path
+import subprocess
+import tempfile
+
+from time_slider import util, smf, zfs
+
+# zfs send options that change the stream format, in the order they
+# are probed:
+# -L  Allow blocks larger than 128K
+# -c  Send compressed blocks as they are stored on disk
+# -e  Send embedded data blocks as they are stored on disk
+# -w  Raw stream, preserving encryption
+# -p  Include dataset properties
+SENDFLAGS = ["L", "c", "e", "w", "p"]
+
+# Options that decide how the received dataset's blocks are stored.
+# The receive side can't switch them partway through a chain of
+# incremental streams, so they stay as they were for the base.
+FIXEDFLAGS = ["L", "w"]
+
+# Directory for caching the results of probing the receive side
+STATEDIR = "/var/tmp/time-slider/zfssend"
+
+
+def negotiate_flags(instance, wanted, probecmd, pool, verbose=False):
+    """
+    Returns the subset of wanted send option letters that both the
+    local zfs send and the receive side support for datasets in pool.
+    Each option is tested by sending a stream of a scratch dataset
+    created in pool to probecmd, which must receive it into a scratch
+    dataset and destroy it again. If probecmd is not set, wanted is
+    returned as is. The result is cached per plugin instance and pool
+    until wanted or probecmd change.
+    """
+    wanted = [flag for flag in SENDFLAGS if flag in wanted]
+    if len(wanted) == 0 or probecmd == None or len(probecmd) == 0:
+        return wanted
+
+    key = [' '.join(probecmd), ''.join(wanted)]
+    cacheFile = os.path.join(STATEDIR, instance + ".flags")
+    # Maps pools to [probe command, wanted, supported]
+    cache = {}
+    try:
+        f = open(cacheFile, 'r')
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) == 4:
+                cache[fields[0]] = fields[1:]
+        f.close()
+    except IOError:
+        pass
+    if pool in cache and cache[pool][:2] == key:
+        return [flag for flag in cache[pool][2]]
+
+    scratch = "%s/time-slider-probe-%d" % (pool, os.getpid())
+    snapname = scratch + "@probe"
+    try:
+        util.run_command([smf.PFCMD, zfs.ZFSCMD, "create",
+                          "-o", "mountpoint=none",
+                          "-o", "com.sun:auto-snapshot=false",
+                          scratch])
+        util.run_command([smf.PFCMD, zfs.ZFSCMD, "snapshot", snapname])
+    except RuntimeError, message:
+        util.debug("Unable to create scratch dataset for probing send " \
+                   "options: %s" % (str(message)), verbose)
+        destroy_scratch(scratch)
+        return []
+
+    try:
+        if probe(snapname, [], probecmd) == False:
+            util.debug("Probe command failed with a plain stream. " \
+                       "Not using any optional send options: %s" \
+                       % (' '.join(probecmd)), verbose)
+            return []
+        supported = []
+        for flag in wanted:
+            if probe(snapname, [flag], probecmd) == True:
+                supported.append(flag)
+            else:
+                util.debug("Receive side does not support zfs send " \
+                           "option: -%s" % (flag), verbose)
+        if len(supported) > 1 and \
+           probe(snapname, supported, probecmd) == False:
+            # Individually supported but not in combination. Use the
+            # most important one only.
+            supported = supported[:1]
+    finally:
+        destroy_scratch(scratch)
+
+    util.debug("Using zfs send options for %s: %s" \
+               % (pool, ' '.join(supported)), verbose)
+    cache[pool] = key + [''.join(supported)]
+    try:
+        if not os.path.exists(STATEDIR):
+            os.makedirs(STATEDIR, 0755)
+        fd,tempFile = tempfile.mkstemp(dir=STATEDIR)
+        f = os.fdopen(fd, 'w')
+        for name in sorted(cache.keys()):
+            f.write("%s\t%s\n" % (name, '\t'.join(cache[name])))
+        f.close()
+        os.chmod(tempFile, 0644)
+        os.rename(tempFile, cacheFile)
+    except (IOError, OSError), message:
+        util.debug("Unable to cache negotiated send options: %s" \
+                   % (str(message)), verbose)
+    return supported
+
+def probe(snapname, flags, probecmd):
+    """
+    Sends snapname using the send options in flags to probecmd.
+    Returns True if both ends succeeded.
+    """
+    sendcmd = [smf.PFCMD, zfs.ZFSCMD, "send"] + format_flags(flags) + \
+              [snapname]
+    try:
+        sendP = subprocess.Popen(sendcmd,
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE,
+                                 close_fds=True)
+        recvP = subprocess.Popen(probecmd,
+                                 stdin=sendP.stdout,
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE,
+                                 close_fds=True)
+        sendP.stdout.close()
+        recvP.communicate()
+        sendP.stderr.read()
+        return sendP.wait() == 0 and recvP.wait() == 0
+    except OSError:
+        return False
+
+def destroy_scratch(scratch):
+    try:
+        util.run_command([smf.PFCMD, zfs.ZFSCMD, "destroy", "-r", scratch])
+    except RuntimeError:
+        pass
+
+def format_flags(flags):
+    """Returns flags as a list of zfs send command line options"""
+    return ["-" + flag for flag in flags]
@@ -0,0 +1,222 @@
+#!/usr/bin/python2.6
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at usr/src/OPENSOLARIS.LICENSE
+# or http://www.opensolaris.org/os/licensing.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at usr/src/OPENSOLARIS.LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+
+import os
+import os.path
+import tempfile
+import time
+import syslog
+
+from time_slider import util
+import sendflags
+
+# Replication states of a dataset
+QUEUED = "queued"
+SENDING = "sending"
+SENT = "sent"
+FAILED = "failed"
+
+# Delay in seconds before the first retry of a failed dataset. It
+# doubles with each consecutive failure, up to MAXRETRYDELAY.
+RETRYDELAY = 60
+MAXRETRYDELAY = 24 * 60 * 60
+
+STATESUFFIX = ".state"
+
+
+class DatasetState:
+    """
+    Replication state of a single filesystem or volume. labels are
+    the snapshot labels held for the dataset but not yet sent, oldest
+    first. The last of them is the one the next stream is sent up to.
+    flags are the send option letters of the last stream received,
+    or None if not known.
+    """
+
+    def __init__(self, state=QUEUED, retries=0, nextAttempt=0, labels=None,
+                 flags=None):
+        self.state = state
+        self.retries = retries
+        self.nextAttempt = nextAttempt
+        if labels == None:
+            labels = []
+        self.labels = labels
+        self.flags = flags
+
+
+class SendState:
+    """
+    Persistent per dataset replication state of a zfs-send plugin
+    instance. Lets a failed send be retried on a later trigger,
+    backing off exponentially, instead of requiring the administrator
+    to intervene.
+    """
+
+    def __init__(self, instance, verbose=False):
+        self._verbose = verbose
+        self._stateFile = os.path.join(sendflags.STATEDIR,
+                                       instance + STATESUFFIX)
+        self._datasets = {}
+
+    def load(self):
+        """
+        Loads the saved state. Datasets that were still being sent
+        when the plugin last exited were interrupted, so are queued
+        again without counting it as a failure.
+        """
+        self._datasets = {}
+        try:
+            f = open(self._stateFile, 'r')
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                name,state,retries,nextAttempt,labels = fields[:5]
+                if state == SENDING:
+                    state = QUEUED
+                labels = [label for label in labels.split(',') \
+                          if len(label) > 0]
+                # Not recorded by older versions
+                flags = None
+                if len(fields) > 5 and fields[5] != '-':
+                    flags = fields[5]
+                self._datasets[name] = DatasetState(state,
+                                                    int(retries),
+                                                    long(nextAttempt),
+                                                    labels,
+                                                    flags)
+            f.close()
+        except IOError:
+            pass
+        except ValueError:
+            util.log_error(syslog.LOG_WARNING,
+                           "Ignoring corrupt zfs send state file: %s" \
+                           % (self._stateFile))
+            self._datasets = {}
+
+    def save(self):
+        if not os.path.exists(sendflags.STATEDIR):
+            os.makedirs(sendflags.STATEDIR, 0755)
+        fd,tempFile = tempfile.mkstemp(dir=sendflags.STATEDIR)
+        f = os.fdopen(fd, 'w')
+        for name in sorted(self._datasets.keys()):
+            record = self._datasets[name]
+            flags = record.flags
+            if flags == None:
+                flags = '-'
+            f.write("%s\t%s\t%d\t%d\t%s\t%s\n" \
+                    % (name, record.state, record.retries,
+                       record.nextAttempt, ','.join(record.labels), flags))
+        f.close()
+        os.chmod(tempFile, 0644)
+        os.rename(tempFile, self._stateFile)
+
+    def queue(self, dataset, label):
+        """Queues the held snapshot dataset@label to be sent"""
+        record = self._datasets.setdefault(dataset, DatasetState())
+        if label not in record.labels:
+            record.labels.append(label)
+        if record.state != FAILED:
+            record.state = QUEUED
+
+    def discard(self, dataset, labels):
+        """
+        Stops waiting for the snapshots of dataset with the labels in
+        labels to be sent, eg. because they no longer exist.
+        """
+        record = self._datasets.get(dataset)
+        if record == None:
+            return
+        record.labels = [label for label in record.labels \
+                         if label not in labels]
+        if len(record.labels) == 0 and record.state != SENT:
+            del self._datasets[dataset]
+
+    def list_pending(self):
+        """Returns the sorted list of datasets with snapshots to send"""
+        return sorted([name for name,record in self._datasets.items() \
+                       if len(record.labels) > 0])
+
+    def get_labels(self, dataset):
+        return self._datasets[dataset].labels[:]
+
+    def get_retries(self, dataset):
+        record = self._datasets.get(dataset)
+        if record == None:
+            return 0
+        return record.retries
+
+    def get_flags(self, dataset):
+        """
+        Returns the send option letters of the last stream of dataset
+        received, or None if not known
+        """
+        record = self._datasets.get(dataset)
+        if record == None:
+            return None
+        return record.flags
+
+    def get_next_attempt(self, dataset):
+        return self._datasets[dataset].nextAttempt
+
+    def is_due(self, dataset, now=None):
+        """
+        Returns True unless dataset failed and its retry delay has not
+        yet passed
+        """
+        if now == None:
+            now = time.time()
+        record = self._datasets[dataset]
+        return record.state != FAILED or record.nextAttempt <= now
+
+    def start(self, datasets):
+        for name in datasets:
+            self._datasets.setdefault(name, DatasetState()).state = SENDING
+
+    def sent(self, datasets, flags=None):
+        """
+        Records datasets as sent, by a stream using the send option
+        letters in flags. If flags is None, the stream was received
+        earlier and the options recorded then are kept.
+        """
+        for name in datasets:
+            record = self._datasets.get(name)
+            if flags == None and record != None:
+                self._datasets[name] = DatasetState(SENT,
+                                                    flags=record.flags)
+            else:
+                self._datasets[name] = DatasetState(SENT, flags=flags)
+
+    def failed(self, datasets):
+        """
+        Records another consecutive failure to send datasets and
+        schedules their next attempt
+        """
+        now = long(time.time())
+        for name in datasets:
+            record = self._datasets.setdefault(name, DatasetState())
+            record.state = FAILED
+            record.retries += 1
+            delay = min(RETRYDELAY * 2 ** (record.retries - 1),
+                        MAXRETRYDELAY)
+            record.nextAttempt = now + delay
+            util.debug("Retrying %s in %d seconds after %d failures" \
+                       % (name, delay, record.retries),
+                       self._verbose)
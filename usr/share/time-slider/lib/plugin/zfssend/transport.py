@@ -0,0 +1,442 @@
+#!/usr/bin/python2.6
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at usr/src/OPENSOLARIS.LICENSE
+# or http://www.opensolaris.org/os/licensing.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at usr/src/OPENSOLARIS.LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+
+
+import os
+import time
+import tempfile
+import subprocess
+import threading
+from collections import deque
+
+from time_slider import util, smf, zfs
+
+# Size of each read from the send side of the stream
+CHUNKSIZE = 128 * 1024
+
+# Stream compression commands. The receive command needs to
+# decompress the stream using the matching command.
+COMPRESSCMDS = {"lz4" : ["/usr/bin/lz4", "-c", "-q"],
+                "zstd" : ["/usr/bin/zstd", "-c", "-q"]}
+
+# Number of times an interrupted stream is resumed before giving up,
+# and the number of seconds to wait before each attempt.
+RESUMERETRIES = 3
+RESUMEDELAY = 30
+
+
+class TokenBucket:
+    """
+    Limits the combined rate of the streams sharing it to rate bytes
+    per second, allowing bursts of up to burst bytes.
+    """
+
+    def __init__(self, rate, burst=None):
+        self._rate = float(rate)
+        if burst == None:
+            burst = max(rate, CHUNKSIZE)
+        self._burst = burst
+        self._tokens = burst
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, count):
+        """Blocks until count bytes may be passed on"""
+        self._lock.acquire()
+        try:
+            now = time.time()
+            self._tokens = min(self._burst,
+                               self._tokens + (now - self._last) * self._rate)
+            self._last = now
+            # Going into debt makes later callers wait their turn too.
+            self._tokens -= count
+            delay = 0
+            if self._tokens < 0:
+                delay = -self._tokens / self._rate
+        finally:
+            self._lock.release()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class StreamBuffer:
+    """
+    Copies a data stream from infile to each of outfiles through an in
+    memory buffer of up to size bytes per output file, so that a slow
+    or bursty consumer doesn't stall the producer or the other
+    consumers. Reading is done by one thread and writing by a separate
+    thread per output file. An output file that fails is dropped from
+    the stream without affecting the others. All files get closed once
+    the stream has been copied, reading fails or every output has
+    failed. If bucket, a TokenBucket, is supplied it limits the rate
+    the stream is read at.
+    """
+
+    def __init__(self, infile, outfiles, size, bucket=None):
+        self._in = infile
+        self._bucket = bucket
+        self._outs = outfiles
+        self._size = max(size, CHUNKSIZE)
+        self._chunks = [deque() for f in outfiles]
+        self._buffered = [0 for f in outfiles]
+        self._eof = False
+        self._cond = threading.Condition()
+        # Error reading the stream, which all outputs fail with
+        self.error = None
+        # Error writing to each output file, if any
+        self.errors = [None for f in outfiles]
+        self.bytes = 0
+        self.startTime = None
+        self.endTime = None
+        self._reader = threading.Thread(target=self._read)
+        self._writers = [threading.Thread(target=self._write, args=(idx,)) \
+                         for idx in range(len(outfiles))]
+
+    def start(self):
+        self.startTime = time.time()
+        self._reader.start()
+        for writer in self._writers:
+            writer.start()
+
+    def join(self):
+        self._reader.join()
+        for writer in self._writers:
+            writer.join()
+        self.endTime = time.time()
+
+    def rate(self):
+        """Returns the average throughput in bytes per second"""
+        elapsed = self.endTime - self.startTime
+        if elapsed <= 0:
+            return 0
+        return self.bytes / elapsed
+
+    def _live(self):
+        return [idx for idx in range(len(self._outs)) \
+                if self.errors[idx] == None]
+
+    def _fail(self, error, idx=None):
+        self._cond.acquire()
+        if idx == None:
+            if self.error == None:
+                self.error = error
+        elif self.errors[idx] == None:
+            self.errors[idx] = error
+            self._chunks[idx].clear()
+            self._buffered[idx] = 0
+        self._cond.notifyAll()
+        self._cond.release()
+
+    def _read(self):
+        try:
+            try:
+                while True:
+                    data = os.read(self._in.fileno(), CHUNKSIZE)
+                    if self._bucket != None and len(data) > 0:
+                        self._bucket.consume(len(data))
+                    self._cond.acquire()
+                    try:
+                        if len(data) == 0:
+                            self._eof = True
+                            self._cond.notifyAll()
+                            return
+                        # Wait for room in the buffer of every output
+                        # still taking the stream.
+                        while self.error == None:
+                            live = self._live()
+                            if len([idx for idx in live \
+                                    if self._buffered[idx] + len(data) > \
+                                    self._size]) == 0:
+                                break
+                            self._cond.wait()
+                        if self.error != None or len(live) == 0:
+                            return
+                        for idx in live:
+                            self._chunks[idx].append(data)
+                            self._buffered[idx] += len(data)
+                        self.bytes += len(data)
+                        self._cond.notifyAll()
+                    finally:
+                        self._cond.release()
+            except (IOError, OSError), message:
+                self._fail("Error reading stream: %s" % (str(message)))
+        finally:
+            self._in.close()
+
+    def _write(self, idx):
+        out = self._outs[idx]
+        chunks = self._chunks[idx]
+        try:
+            try:
+                while True:
+                    self._cond.acquire()
+                    try:
+                        while len(chunks) == 0 and \
+                              self._eof == False and \
+                              self.error == None and \
+                              self.errors[idx] == None:
+                            self._cond.wait()
+                        if self.error != None or \
+                           self.errors[idx] != None or \
+                           len(chunks) == 0:
+                            return
+                        data = chunks.popleft()
+                        self._buffered[idx] -= len(data)
+                        self._cond.notifyAll()
+                    finally:
+                        self._cond.release()
+                    written = 0
+                    while written < len(data):
+                        written += os.write(out.fileno(), data[written:])
+            except (IOError, OSError), message:
+                self._fail("Error writing stream: %s" % (str(message)), idx)
+        finally:
+            out.close()
+
+
+class Transport:
+    """
+    Runs zfs send streams into the configured receive command,
+    optionally compressing them, through a StreamBuffer of buffersize
+    bytes. If tokencmd is set, it is used to look up the
+    receive_resume_token of a partially received stream so that
+    interrupted streams can be resumed using "zfs send -t". tokencmd
+    is invoked with the name of the dataset being sent appended and
+    should print the token of the dataset it is received into, or
+    nothing or "-" if there is none. If bucket, a TokenBucket, is
+    supplied it limits the rate of the streams. If listcmd is set, it
+    is used to list the snapshots already received. It is invoked the
+    same way as tokencmd and should print the names of the snapshots
+    of the dataset it is received into, one per line, or nothing if
+    that dataset does not exist.
+    """
+
+    def __init__(self, recvcmd, buffersize, compresscmd=None,
+                 tokencmd=None, verbose=False, bucket=None, listcmd=None):
+        self.recvcmd = recvcmd
+        self.buffersize = buffersize
+        self.compresscmd = compresscmd
+        self.bucket = bucket
+        self._tokencmd = tokencmd
+        self._listcmd = listcmd
+        self._verbose = verbose
+
+    def send(self, dataset, sendcmd):
+        """
+        Sends the stream generated by sendcmd, resuming it after
+        interruptions if possible. Returns the StreamBuffer used for
+        the final attempt, or raises RuntimeError on failure.
+        """
+        streamBuffer,errors = send_fanout(dataset, sendcmd, [self])
+        if errors[0] != None:
+            raise RuntimeError, errors[0]
+        return streamBuffer
+
+    def resume(self, dataset, error):
+        """
+        Resumes the interrupted stream of dataset that failed with
+        error. Returns the StreamBuffer used for the final attempt, or
+        raises RuntimeError if the stream can't be resumed.
+        """
+        for attempt in range(RESUMERETRIES):
+            token = self.get_resume_token(dataset)
+            if token == None:
+                break
+            util.debug("Resuming interrupted stream of %s in %d " \
+                       "seconds: %s" % (dataset, RESUMEDELAY, str(error)),
+                       self._verbose)
+            time.sleep(RESUMEDELAY)
+            streamBuffer,errors = run_pipeline([smf.PFCMD, zfs.ZFSCMD,
+                                                "send", "-t", token],
+                                               [self.recvcmd],
+                                               self.compresscmd,
+                                               self.buffersize,
+                                               self.bucket)
+            if errors[0] == None:
+                return streamBuffer
+            error = errors[0]
+        raise RuntimeError, error
+
+    def get_resume_token(self, dataset):
+        if self._tokencmd == None or len(self._tokencmd) == 0:
+            return None
+        try:
+            outdata,errdata = util.run_command(self._tokencmd + [dataset])
+        except RuntimeError, message:
+            util.debug("Failed to look up resume token of %s: %s" \
+                       % (dataset, str(message)),
+                       self._verbose)
+            return None
+        token = outdata.strip()
+        if len(token) == 0 or token == "-":
+            return None
+        return token
+
+    def list_received(self, dataset):
+        """
+        Returns the labels of the snapshots of dataset that have been
+        received, or None if no listcmd is set. Raises RuntimeError if
+        the receive side can't be queried.
+        """
+        if self._listcmd == None or len(self._listcmd) == 0:
+            return None
+        outdata,errdata = util.run_command(self._listcmd + [dataset])
+        labels = []
+        for line in outdata.split('\n'):
+            # Only the first column is used, so the command may print
+            # other details, such as the output of "zfs list" with
+            # the default columns.
+            fields = line.split()
+            if len(fields) == 0 or '@' not in fields[0]:
+                continue
+            labels.append(fields[0].split('@', 1)[1])
+        return labels
+
+
+def send_fanout(dataset, sendcmd, transports):
+    """
+    Sends the stream generated by a single run of sendcmd to the
+    receive command of each of transports, which must all use the same
+    compression, buffer size and bucket. Receivers that fail are resumed
+    individually if possible. Returns the StreamBuffer of the shared
+    stream and a list containing an error message, or None, for each
+    of transports.
+    """
+    streamBuffer,errors = run_pipeline(sendcmd,
+                                       [t.recvcmd for t in transports],
+                                       transports[0].compresscmd,
+                                       transports[0].buffersize,
+                                       transports[0].bucket)
+    for idx in range(len(transports)):
+        if errors[idx] == None:
+            continue
+        try:
+            transports[idx].resume(dataset, errors[idx])
+            errors[idx] = None
+        except RuntimeError, message:
+            errors[idx] = str(message)
+    return streamBuffer,errors
+
+
+def run_pipeline(sendcmd, recvcmds, compresscmd, buffersize, bucket=None):
+    """
+    Runs sendcmd, optionally piped through compresscmd, into each of
+    recvcmds through a StreamBuffer, rate limited by bucket if set.
+    Returns the StreamBuffer and a list containing an error message,
+    or None, for each of recvcmds.
+    Raises RuntimeError if the send side can't be started.
+    """
+    sendP = None
+    compressP = None
+    # Standard error of every command is collected in a file rather
+    # than a pipe, which nothing reads until the stream has ended, so
+    # that a command writing a lot to it can't stall the pipeline.
+    sendErrfile = tempfile.TemporaryFile()
+    compressErrfile = None
+    try:
+        sendP = subprocess.Popen(sendcmd,
+                                 stdout=subprocess.PIPE,
+                                 stderr=sendErrfile,
+                                 close_fds=True)
+        source = sendP.stdout
+        if compresscmd:
+            compressErrfile = tempfile.TemporaryFile()
+            compressP = subprocess.Popen(compresscmd,
+                                         stdin=sendP.stdout,
+                                         stdout=subprocess.PIPE,
+                                         stderr=compressErrfile,
+                                         close_fds=True)
+            sendP.stdout.close()
+            source = compressP.stdout
+    except OSError, message:
+        if sendP != None:
+            sendP.stdout.close()
+            sendP.wait()
+        sendErrfile.close()
+        if compressErrfile != None:
+            compressErrfile.close()
+        raise RuntimeError, "%s subprocess error:\n %s" % \
+                            (str(sendcmd), str(message))
+
+    errors = []
+    recvPs = []
+    recvErrfiles = []
+    for recvcmd in recvcmds:
+        errfile = tempfile.TemporaryFile()
+        try:
+            recvPs.append(subprocess.Popen(recvcmd,
+                                           stdin=subprocess.PIPE,
+                                           stderr=errfile,
+                                           close_fds=True))
+            recvErrfiles.append(errfile)
+            errors.append(None)
+        except OSError, message:
+            errfile.close()
+            recvPs.append(None)
+            recvErrfiles.append(None)
+            errors.append("%s subprocess error:\n %s" % \
+                          (str(recvcmd), str(message)))
+
+    live = [idx for idx in range(len(recvPs)) if recvPs[idx] != None]
+    streamBuffer = StreamBuffer(source,
+                                [recvPs[idx].stdin for idx in live],
+                                buffersize, bucket)
+    streamBuffer.start()
+    streamBuffer.join()
+
+    # A failure of the send side fails every receiver.
+    sendError = None
+    for cmd,p,errfile in [(compresscmd, compressP, compressErrfile),
+                          (sendcmd, sendP, sendErrfile)]:
+        if p != None:
+            errno = p.wait()
+            err = _read_errors(errfile)
+            if errno != 0 and sendError == None:
+                sendError = "Command: %s failed with exit code " \
+                            "%d. Error message: \n%s" \
+                            % (str(cmd), errno, err)
+    if sendError == None:
+        sendError = streamBuffer.error
+
+    for pos,idx in enumerate(live):
+        p = recvPs[idx]
+        errno = p.wait()
+        err = _read_errors(recvErrfiles[idx])
+        if errno != 0:
+            errors[idx] = "Command: %s failed with exit code " \
+                          "%d. Error message: \n%s" \
+                          % (str(recvcmds[idx]), errno, err)
+        elif sendError != None:
+            errors[idx] = sendError
+        elif streamBuffer.errors[pos] != None:
+            errors[idx] = streamBuffer.errors[pos]
+    return streamBuffer,errors
+
+
+def _read_errors(errfile):
+    """
+    Returns what a command wrote to errfile and closes it.
+    """
+    errfile.seek(0)
+    errdata = errfile.read()
+    errfile.close()
+    return errdata
@@ -24,16 +24,463 @@ import os
 import sys
 import subprocess
 import syslog
-from bisect import insort
+import threading
+import time
+from bisect import bisect_right
 
-import time_slider.util
-import time_slider.smf
-import time_slider.zfs
+from time_slider import util, smf, zfs
+from plugin import pluginsmf
+import zfssendsmf
+import transport
+import sendflags
+import sendstate
 
 # Set to True if SMF property value of "plugin/command" is "true"
 verboseprop = "plugin/verbose"
 propbasename = "org.opensolaris:time-slider-plugin"
-print _("Do I work?")
+
+
+class SendTarget:
+    """
+    A receive side that snapshots are replicated to. Each target keeps
+    its own record of the last snapshot sent to it, in the user
+    property propname, holds the snapshots it still needs using
+    propname as the tag, and keeps its own replication state. Targets
+    can therefore fall behind or fail independently of each other,
+    while sharing snapshot streams whenever they are in step.
+    """
+
+    def __init__(self, name, propname, statename, streamTransport,
+                 probecmd, verbose=False):
+        self.name = name
+        self.propname = propname
+        self.statename = statename
+        self.transport = streamTransport
+        self.probecmd = probecmd
+        self.state = sendstate.SendState(statename, verbose)
+        self.datasets = []
+        self.streams = {}
+        self.roots = []
+        # Maps the datasets whose snapshots on the receive side could
+        # not be listed by plan() to the error message.
+        self.unreachable = {}
+        self._verbose = verbose
+        # Maps the datasets to send to the label they are sent up
+        # to, and to the earlier labels they missed.
+        self._labels = {}
+        self._missed = {}
+
+    def __str__(self):
+        if self.name == None:
+            return zfssendsmf.RECEIVEPROPGROUP
+        return "%s-%s" % (zfssendsmf.RECEIVEPROPGROUP, self.name)
+
+    def queue(self, datasets, snapnames, holds, snaplabel):
+        """
+        Holds the newly created snapshots in snapnames for this target
+        and queues them along with any still held from earlier runs
+        that failed or were deferred, forgetting about those that have
+        since been destroyed. holds maps snapshots to their existing
+        hold tags.
+        """
+        verbose = self._verbose
+        unheld = [name for name in snapnames \
+                  if self.propname not in holds.get(name, [])]
+        if len(unheld) > 0:
+            util.debug("Placing hold on %d snapshots for %s" \
+                       % (len(unheld), self), verbose)
+        held = set(snapnames).difference(unheld)
+        held.update(datasets.hold_snapshots(self.propname, unheld))
+
+        self.state.load()
+        for name in sorted(held):
+            self.state.queue(name.split('@', 1)[0], snaplabel)
+        leftover = []
+        for dataset in self.state.list_pending():
+            leftover.extend(["%s@%s" % (dataset, label) \
+                             for label in self.state.get_labels(dataset) \
+                             if "%s@%s" % (dataset, label) not in held])
+        found = datasets.get_properties(["type"], leftover)
+        for name in leftover:
+            if name not in found:
+                dataset,label = name.split('@', 1)
+                self.state.discard(dataset, [label])
+        self.state.save()
+
+        # Datasets that failed recently are left queued until their
+        # retry delay has passed. Each of the others gets a single
+        # stream up to its newest queued snapshot, covering any
+        # earlier ones it missed.
+        now = time.time()
+        self.datasets = []
+        for dataset in self.state.list_pending():
+            if self.state.is_due(dataset, now) == False:
+                nextAttempt = self.state.get_next_attempt(dataset)
+                util.debug("Deferring retry of %s to %s until %s" \
+                           % (dataset, self, time.ctime(nextAttempt)),
+                           verbose)
+                continue
+            labels = self.state.get_labels(dataset)
+            self.datasets.append(dataset)
+            self._labels[dataset] = labels[-1]
+            self._missed[dataset] = labels[:-1]
+
+    def plan(self, datasets, snaplabel, flags, everything):
+        """
+        Works out the snapshot streams needed to bring this target up
+        to date, using the send options in flags, which maps each pool
+        to the option letters negotiated for it. If everything, the
+        list of all filesystems and volumes
+        on the system, is supplied, subtrees are sent as recursive
+        streams where possible. If the snapshot an incremental stream
+        needs to be sent from no longer exists, sending resumes from
+        the newest snapshot the receive side has in common, or starts
+        over with a full stream if there is none. Raises RuntimeError
+        if that can't be determined.
+        """
+        verbose = self._verbose
+        labels = self._labels
+        missed = self._missed
+        propname = self.propname
+
+        # Look up the previously sent snapshot label of every dataset,
+        # and which of those snapshots and their bookmarks exist, in
+        # one go rather than per dataset.
+        props = datasets.get_properties([propname], self.datasets)
+        prevlabels = {}
+        for dataset in self.datasets:
+            prevlabel = props.get(dataset, {}).get(propname, "-")
+            if prevlabel == "-" or len(prevlabel) == 0:
+                prevlabel = None
+            prevlabels[dataset] = prevlabel
+            # A label can still be queued if the plugin exited after
+            # recording the backup but before saving its state. Its
+            # hold is now that of the previously sent snapshot.
+            if prevlabel in missed[dataset]:
+                missed[dataset].remove(prevlabel)
+        prevsnaps = ["%s@%s" % (dataset, prevlabels[dataset]) \
+                     for dataset in self.datasets \
+                     if prevlabels[dataset] != None]
+        prevbookmarks = [name.replace('@', '#', 1) for name in prevsnaps]
+        existing = set(datasets.get_properties(["type"],
+                                               prevsnaps + \
+                                               prevbookmarks).keys())
+
+        subtrees = {}
+        if everything != None:
+            current = [dataset for dataset in self.datasets \
+                       if labels[dataset] == snaplabel and \
+                       prevlabels[dataset] != snaplabel]
+            subtrees = find_replication_subtrees(current, everything,
+                                                 prevlabels, existing)
+            # All members of a recursive stream get the same options
+            for root in subtrees.keys():
+                rootflags = self._stream_flags(root, flags, True)
+                for name in subtrees[root]:
+                    if self._stream_flags(name, flags, True) != rootflags:
+                        del subtrees[root]
+                        break
+
+        self.streams = {}
+        self.roots = []
+        for root in sorted(subtrees.keys()):
+            members = subtrees[root]
+            prevsnapname = "%s@%s" % (root, prevlabels[root])
+            snapname = "%s@%s" % (root, snaplabel)
+            util.debug("Sending recursive incremental stream of %d " \
+                       "datasets from %s to %s" \
+                       % (len(members), prevsnapname, snapname),
+                       verbose)
+            streamflags = self._stream_flags(root, flags, True)
+            sendcmd = [smf.PFCMD, zfs.ZFSCMD, "send", "-R"] + \
+                      sendflags.format_flags(streamflags) + \
+                      ["-I", prevsnapname, snapname]
+            # Any snapshots the members missed are intermediate
+            # snapshots of the stream, so they are covered too.
+            prevsnapnames = []
+            for name in members:
+                prevsnapnames.append("%s@%s" % (name, prevlabels[root]))
+                prevsnapnames.extend(["%s@%s" % (name, label) \
+                                      for label in missed[name]])
+            prevbookmarks = ["%s#%s" % (name, prevlabels[root]) \
+                             for name in members \
+                             if "%s#%s" % (name, prevlabels[root]) \
+                             in existing]
+            self.streams[root] = [sendcmd, snaplabel, prevsnapnames,
+                                  prevbookmarks, members, streamflags]
+            self.roots.append(root)
+        inSubtree = set()
+        for members in subtrees.values():
+            inSubtree.update(members)
+
+        # If the previously sent snapshot is not recorded or no longer
+        # exists, the receive side may still have a snapshot in common
+        # to resume sending incrementally from.
+        unbased = []
+        for dataset in self.datasets:
+            prevlabel = prevlabels[dataset]
+            if dataset in inSubtree or prevlabel == labels[dataset]:
+                continue
+            if prevlabel == None or \
+               ("%s@%s" % (dataset, prevlabel) not in existing and \
+                "%s#%s" % (dataset, prevlabel) not in existing):
+                unbased.append(dataset)
+        bases,unreachable = self._find_common_bases(datasets, unbased)
+        self.unreachable = unreachable
+        if len(unreachable) > 0:
+            self.state.failed(sorted(unreachable.keys()))
+
+        for dataset in self.datasets:
+            if dataset in inSubtree or dataset in unreachable:
+                continue
+            sendcmd = None
+            prevsnapnames = []
+            prevbookmarks = []
+            prevlabel = prevlabels[dataset]
+            label = labels[dataset]
+            missedsnapnames = ["%s@%s" % (dataset, l) \
+                               for l in missed[dataset]]
+
+            snapname = "%s@%s" % (dataset, label)
+            fullflags = self._stream_flags(dataset, flags, False)
+            incrflags = self._stream_flags(dataset, flags, True)
+            if prevlabel == label:
+                # Already sent. Only the state didn't get saved.
+                if len(missedsnapnames) > 0:
+                    datasets.release_snapshots(propname, missedsnapnames)
+                self.state.sent([dataset])
+                continue
+            elif dataset in bases:
+                base = bases[dataset]
+                if base == snapname:
+                    # Received, but not recorded as sent.
+                    util.debug("%s already received by %s" \
+                               % (snapname, self), verbose)
+                    datasets.set_user_property(propname, label, [dataset])
+                    if len(missedsnapnames) > 0:
+                        datasets.release_snapshots(propname,
+                                                   missedsnapnames)
+                    self.state.sent([dataset])
+                    continue
+                elif base == None:
+                    util.debug("No snapshot of %s in common with %s, " \
+                               "sending full stream" % (dataset, self),
+                               verbose)
+                    streamflags = fullflags
+                    sendcmd = [zfs.ZFSCMD, "send"] + \
+                              sendflags.format_flags(streamflags) + \
+                              [snapname]
+                else:
+                    util.debug("Resuming %s from newest snapshot in " \
+                               "common with %s: %s" \
+                               % (dataset, self, base),
+                               verbose)
+                    streamflags = incrflags
+                    sendcmd = [zfs.ZFSCMD, "send"] + \
+                              sendflags.format_flags(streamflags) + \
+                              ["-i", base, snapname]
+            elif prevlabel == None:
+                # No previous backup - send a full replication stream
+                streamflags = fullflags
+                sendcmd = [zfs.ZFSCMD, "send"] + \
+                          sendflags.format_flags(streamflags) + [snapname]
+                util.debug("No previous backup to %s registered for %s" \
+                           % (self, dataset), verbose)
+            else:
+                # A record of a previous backup exists. Check that it
+                # exists to enable send of an incremental stream.
+                # Failing that, a bookmark of it will do just as well.
+                prevsnapname = "%s@%s" % (dataset, prevlabel)
+                prevbookmark = "%s#%s" % (dataset, prevlabel)
+                util.debug("Previously sent snapshot: %s" % prevsnapname,
+                           verbose)
+                if prevbookmark in existing:
+                    prevbookmarks = [prevbookmark]
+                if prevsnapname in existing:
+                    # Coalesce any snapshots missed since into a single
+                    # stream that includes them as intermediate
+                    # snapshots.
+                    if len(missedsnapnames) > 0:
+                        util.debug("Including %d missed snapshots of %s" \
+                                   % (len(missedsnapnames), dataset),
+                                   verbose)
+                        incropt = "-I"
+                    else:
+                        incropt = "-i"
+                    streamflags = incrflags
+                    sendcmd = [zfs.ZFSCMD, "send"] + \
+                              sendflags.format_flags(streamflags) + \
+                              [incropt, prevsnapname, snapname]
+                    prevsnapnames = [prevsnapname]
+                elif prevbookmark in existing:
+                    util.debug("Sending from bookmark: %s" % prevbookmark,
+                               verbose)
+                    streamflags = incrflags
+                    sendcmd = [zfs.ZFSCMD, "send"] + \
+                              sendflags.format_flags(streamflags) + \
+                              ["-i", prevbookmark, snapname]
+                else:
+                    # This should not happen under normal operation
+                    # since we place a hold on the snapshot until it
+                    # gets sent, or bookmark it before it can be
+                    # destroyed. So getting here suggests that
+                    # something else released the hold on the snapshot,
+                    # allowing it to get destroyed prematurely.
+                    # Without receive/list_command there is no way to
+                    # find another snapshot to send from.
+                    raise RuntimeError, \
+                          "Previously sent snapshot no longer exists: %s" \
+                          % prevsnapname
+            sendcmd.insert(0, smf.PFCMD)
+            self.streams[dataset] = [sendcmd, label,
+                                     prevsnapnames + missedsnapnames,
+                                     prevbookmarks, [dataset], streamflags]
+            self.roots.append(dataset)
+        self.roots.sort()
+        self.state.save()
+
+    def _stream_flags(self, dataset, flags, incremental):
+        """
+        Returns the send option letters for a stream of dataset, given
+        flags, the options negotiated for each pool. An incremental
+        stream keeps the options in sendflags.FIXEDFLAGS the way they
+        were for the stream its base was received from. That isn't
+        known for datasets last sent by older versions of the plugin,
+        so they just get the negotiated options.
+        """
+        negotiated = flags.get(dataset.split('/')[0], [])
+        previous = self.state.get_flags(dataset)
+        if incremental == False or previous == None:
+            return negotiated
+        return [flag for flag in sendflags.SENDFLAGS \
+                if (flag in sendflags.FIXEDFLAGS and flag in previous) or \
+                   (flag not in sendflags.FIXEDFLAGS and flag in negotiated)]
+
+    def _find_common_bases(self, datasets, names):
+        """
+        Finds the newest snapshot or bookmark of each dataset in names
+        that the receive side also has a snapshot of, using a single
+        cheap listing of the receive side per dataset instead of a
+        full resend. Returns a dictionary mapping the datasets to the
+        snapshot or bookmark found, or to None if there is none in
+        common, and a dictionary mapping the datasets the receive side
+        could not be queried about to the error message. The snapshot
+        about to be sent is itself returned if it has already been
+        received. Nothing is found if no command to list the receive
+        side's snapshots is configured.
+        """
+        bases = {}
+        unreachable = {}
+        received = {}
+        for dataset in names:
+            try:
+                remote = self.transport.list_received(dataset)
+            except RuntimeError, message:
+                unreachable[dataset] = "Failed to list snapshots of %s " \
+                                       "received: %s" \
+                                       % (dataset, str(message))
+                continue
+            if remote == None:
+                return {},{}
+            received[dataset] = set(remote)
+
+        sources = datasets.list_send_sources([dataset for dataset \
+                                              in received.keys() \
+                                              if len(received[dataset]) > 0])
+        for dataset,remote in received.items():
+            base = None
+            snapname = "%s@%s" % (dataset, self._labels[dataset])
+            # Only consider sources up to the snapshot being sent.
+            for name in sources.get(dataset, []):
+                if name.replace('#', '@', 1).split('@', 1)[1] in remote:
+                    base = name
+                if name == snapname:
+                    break
+            bases[dataset] = base
+        return bases,unreachable
+
+
+class SendStream(threading.Thread):
+    """
+    Sends a single snapshot stream for dataset in its own thread,
+    teeing it to each of the targets added to it. When the stream
+    completes, errors holds an error message, or None, for each target
+    and done is notified.
+    """
+
+    def __init__(self, dataset, sendcmd, label, members, flags, done):
+        self.dataset = dataset
+        self.label = label
+        self.members = members
+        self.flags = flags
+        self.targets = []
+        self.prevsnapnames = []
+        self.prevbookmarks = []
+        self.errors = []
+        self.finished = False
+        self.startTime = None
+        self.endTime = None
+        self.bytes = 0
+        self.rate = 0
+        self._sendcmd = sendcmd
+        self._done = done
+        threading.Thread.__init__(self)
+
+    def add_target(self, target, prevsnapnames, prevbookmarks):
+        """
+        Adds target to the receivers of the stream. prevsnapnames are
+        the previously sent or missed snapshots whose holds for target
+        the stream makes redundant, and prevbookmarks the bookmarks of
+        the previously sent snapshots.
+        """
+        self.targets.append(target)
+        self.prevsnapnames.append(prevsnapnames)
+        self.prevbookmarks.append(prevbookmarks)
+
+    def remove_target(self, target):
+        idx = self.targets.index(target)
+        del self.targets[idx]
+        del self.prevsnapnames[idx]
+        del self.prevbookmarks[idx]
+
+    def run(self):
+        self.startTime = time.time()
+        try:
+            try:
+                streamBuffer,self.errors = \
+                    transport.send_fanout(self.dataset, self._sendcmd,
+                                          [t.transport for t in self.targets])
+                self.bytes = streamBuffer.bytes
+                self.rate = streamBuffer.rate()
+            except Exception, message:
+                self.errors = [str(message) for t in self.targets]
+        finally:
+            self.endTime = time.time()
+            self._done.acquire()
+            self.finished = True
+            self._done.notify()
+            self._done.release()
+
+    def elapsed(self):
+        return self.endTime - self.startTime
+
+
+def find_parents(datasets):
+    """
+    Maps each dataset name in datasets to the name of its closest
+    ancestor that is also in datasets, or None if there isn't one.
+    """
+    names = set(datasets)
+    parents = {}
+    for name in datasets:
+        parents[name] = None
+        head = name
+        while head.find('/') != -1:
+            head = head.rsplit('/', 1)[0]
+            if head in names:
+                parents[name] = head
+                break
+    return parents
 
 def main(argv):
 
@@ -79,6 +526,77 @@ def main(argv):
     # The user property/tag used when tagging and holding zfs datasets
     propname = "%s:%s" % (propbasename, plugininstance)
 
+    smfInst = zfssendsmf.ZfsSendSMF(pluginfmri)
+
+    compression = smfInst.get_compression()
+    compresscmd = None
+    if compression != "none":
+        try:
+            compresscmd = transport.COMPRESSCMDS[compression]
+        except KeyError:
+            log_error(syslog.LOG_ERR,
+                      "Plugin: %s: Unsupported send/compression value: %s" \
+                      % (pluginfmri, compression))
+            maintenance(pluginfmri)
+            sys.exit(-1)
+    buffersize = smfInst.get_buffer_size()
+    # A single bandwidth limit shared by all streams to all targets
+    bucket = None
+    bwlimit = smfInst.get_bwlimit()
+    if bwlimit > 0:
+        bucket = transport.TokenBucket(bwlimit * 1024)
+
+    # The default receive target is configured by the "receive"
+    # property group and any additional ones by "receive-<name>"
+    # property groups. Each additional target uses its own user
+    # property/tag and state, derived from the default ones.
+    targets = []
+    for name in [None] + smfInst.get_targets():
+        group = smfInst.get_receive_group(name)
+        recvcmd = smfInst.get_receive_command(name)
+
+        # Check to see if the receive command is accessible and executable
+        try:
+            statinfo = os.stat(recvcmd[0])
+            other_x = (statinfo.st_mode & 01)
+            if other_x == 0:
+                log_error(syslog.LOG_ERR,
+                          "Plugin: %s: Configured %s/command is not " \
+                          "executable: %s" \
+                          % (pluginfmri, group, ' '.join(recvcmd)))
+                maintenance(pluginfmri)
+                sys.exit(-1)
+        except (OSError, IndexError):
+            log_error(syslog.LOG_ERR,
+                      "Plugin: %s: Can not access the configured " \
+                      "%s/command: %s" \
+                      % (pluginfmri, group, ' '.join(recvcmd)))
+            maintenance(pluginfmri)   
+            sys.exit(-1)
+
+        # Invoke the send and receive commands via pfexec(1) since
+        # we are not using the role's shell to take care of that
+        # for us.
+        recvcmd.insert(0, smf.PFCMD)
+
+        if name == None:
+            targetprop = propname
+            statename = plugininstance
+        else:
+            targetprop = "%s:%s" % (propname, name)
+            statename = "%s-%s" % (plugininstance, name)
+        streamTransport = transport.Transport(recvcmd,
+                                              buffersize,
+                                              compresscmd,
+                                              smfInst.get_token_command(name),
+                                              verbose,
+                                              bucket,
+                                              smfInst.get_list_command(name))
+        targets.append(SendTarget(name, targetprop, statename,
+                                  streamTransport,
+                                  smfInst.get_probe_command(name),
+                                  verbose))
+
     # Identifying snapshots is a two stage process.
     #
     # First: identify all snapshots matching the AUTOSNAP_LABEL
@@ -94,140 +612,290 @@ def main(argv):
     # results but is not actually part of the auto-snapshot set
     # created by time-slider. It also avoids incorrectly placing
     # zfs holds on the imported snapshots.
+    #
+    # Rather than scanning every snapshot on the system for the label,
+    # the snapshot name is derived from each tagged dataset, and the
+    # ones that actually exist are found with a single zfs(1) call.
 
     datasets = zfs.Datasets()
-    candidates = datasets.list_snapshots(snaplabel)
     originsets = datasets.list_auto_snapshot_sets(schedule)
-    snappeddatasets = []
-    snapnames = [name for [name,ctime] in candidates \
-                 if name.split('@',1)[0] in originsets]
-
+    candidates = ["%s@%s" % (name, snaplabel) for name in originsets]
+    userrefs = datasets.get_properties(["userrefs"], candidates)
+    snapnames = [name for name in candidates if name in userrefs]
 
     # Place a hold on the the newly created snapshots so
     # they can be backed up without fear of being destroyed
-    # before the backup gets a chance to complete.
-    for snap in snapnames:
-        snapshot = zfs.Snapshot(snap)
-        holds = snapshot.holds()
+    # before the backup gets a chance to complete. Only snapshots
+    # with user holds need to have their hold tags looked up.
+    alreadyheld = [name for name in snapnames \
+                   if userrefs[name].get("userrefs", "0") != "0"]
+    holds = datasets.list_holds(alreadyheld)
+    for target in targets:
+        target.queue(datasets, snapnames, holds, snaplabel)
+
+    # Use the richest set of stream format options that the receive
+    # side supports for each pool, since pools differ in the features
+    # they have enabled. Targets have to agree on the options in order
+    # to share streams.
+    wanted = smfInst.get_send_flags()
+    flags = {}
+    for target in targets:
+        pools = set([dataset.split('/')[0] for dataset in target.datasets])
+        for pool in sorted(pools):
+            supported = sendflags.negotiate_flags(target.statename, wanted,
+                                                  target.probecmd, pool,
+                                                  verbose)
+            flags[pool] = [flag for flag in supported \
+                           if flag in flags.get(pool, supported)]
+
+    everything = None
+    if smfInst.get_recursive() == True:
+        everything = [name for name,mountpoint in \
+                      datasets.list_filesystems()] + \
+                     datasets.list_volumes()
+
+    for target in targets:
         try:
-            holds.index(propname)
-        except ValueError:
-            util.debug("Placing hold on %s" % (snap), verbose)
-            snapshot.hold(propname)
-        datasetname = snapshot.fsname
-        # Insert datasetnames in alphabetically sorted order because
-        # zfs receive falls over if it receives a child before the
-        # parent if the "-F" option is not used.
-        insort(snappeddatasets, datasetname)
-
-    # Find out the receive command property value
-    cmd = [smf.SVCPROPCMD, "-c", "-p", "receive/command", pluginfmri]
-    outdata,errdata = util.run_command(cmd)
-    # Strip out '\' characters inserted by svcprop
-    recvcmd = outdata.strip().replace('\\', '').split()
-
-    # Check to see if the receive command is accessible and executable
-    try:
-        statinfo = os.stat(recvcmd[0])
-        other_x = (statinfo.st_mode & 01)
-        if other_x == 0:
-            log_error(syslog.LOG_ERR,
-                      "Plugin: %s: Configured receive/command is not " \
-                      "executable: %s" \
-                      % (pluginfmri, outdata))
+            target.plan(datasets, snaplabel, flags, everything)
+        except RuntimeError, message:
+            log_error(syslog.LOG_ERR, str(message))
             maintenance(pluginfmri)
             sys.exit(-1)
-    except OSError:
-        log_error(syslog.LOG_ERR,
-                  "Plugin: %s: Can not access the configured " \
-                  "receive/command: %s" \
-                  % (pluginfmri, outdata)) 
-        maintenance(pluginfmri)   
-        sys.exit(-1)
-
-    for dataset in snappeddatasets:
-        sendcmd = None
-        prevsnapname = None
-        ds = zfs.ReadableDataset(dataset)
-        prevlabel = ds.get_user_property(propname)
-
-        snapname = "%s@%s" % (ds.name, snaplabel)
-        if (prevlabel == None or len(prevlabel) == 0):
-            # No previous backup - send a full replication stream
-            sendcmd = [zfs.ZFSCMD, "send", snapname]
-            util.debug("No previous backup registered for %s" % ds.name, verbose)
-        else:
-            # A record of a previous backup exists.
-            # Check that it exists to enable send of an incremental stream.
-            prevsnapname = "%s@%s" % (ds.name, prevlabel)
-            util.debug("Previously sent snapshot: %s" % prevsnapname, verbose)
-            prevsnap = zfs.Snapshot(prevsnapname)
-            if prevsnap.exists():
-                sendcmd = [zfs.ZFSCMD, "send", "-i", prevsnapname, snapname]
-            else:
-                # This should not happen under normal operation since we
-                # place a hold on the snapshot until it gets sent. So
-                # getting here suggests that something else released the
-                # hold on the snapshot, allowing it to get destroyed
-                # prematurely.
-                log_error(syslog.LOG_ERR,
-                          "Previously sent snapshot no longer exists: %s" \
-                          % prevsnapname)
-                maintenance(pluginfmri)
-                sys.exit(-1)
-        
-        
-        # Invoke the send and receive commands via pfexec(1) since
-        # we are not using the role's shell to take care of that
-        # for us.
-        sendcmd.insert(0, smf.PFCMD)
-        recvcmd.insert(0, smf.PFCMD)
 
-        try:
-            sendP = subprocess.Popen(sendcmd,
-                                     stdout=subprocess.PIPE,
-                                     stderr=subprocess.PIPE,
-                                     close_fds=True)
-            recvP = subprocess.Popen(recvcmd,
-                                     stdin=sendP.stdout,
-                                     stderr=subprocess.PIPE,
-                                     close_fds=True)
-
-            recvout,recverr = recvP.communicate()
-            recverrno = recvP.wait()
-            sendout,senderr = sendP.communicate()
-            senderrno = sendP.wait()
-
-            if senderrno != 0:
-                raise RuntimeError, "Send command: %s failed with exit code" \
-                                    "%d. Error message: \n%s" \
-                                    % (str(sendcmd), senderrno, senderr)
-            if recverrno != 0:
-                raise RuntimeError, "Receive command %s failed with exit " \
-                                    "code %d. Error message: \n%s" \
-                                    % (str(recvcmd), recverrno, recverr)
-
-            if prevsnapname != None:
-                util.debug("Releasing hold on %s" % (prevsnapname), verbose)
-                snapshot = zfs.Snapshot(prevsnapname)
-                util.debug("Releasing hold on previous snapshot: %s" \
-                      % (prevsnapname),
-                      verbose)
-                snapshot.release(propname)
-        except Exception, message:
+    jobs = smfInst.get_jobs()
+    errors = []
+    for target in targets:
+        errors.extend(["%s: %s" % (target, target.unreachable[dataset]) \
+                       for dataset in sorted(target.unreachable.keys())])
+    errors.extend(send_streams(targets, jobs, smfInst.get_bookmarks(),
+                               smfInst.get_windows(), verbose))
+    if len(errors) > 0:
+        for error in errors:
             log_error(syslog.LOG_ERR,
                       "Error during snapshot send/receive operation: %s" \
-                      % (message))
-
+                      % (error))
+        # Only give up once a dataset has used up its failure budget.
+        # Until then its snapshots stay held and queued for a retry.
+        budget = smfInst.get_failure_budget()
+        exhausted = []
+        for target in targets:
+            failures = target.roots + sorted(target.unreachable.keys())
+            exhausted.extend(["%s (%s)" % (dataset, target) \
+                              for dataset in failures \
+                              if target.state.get_retries(dataset) >= budget])
+        if len(exhausted) > 0:
+            log_error(syslog.LOG_ERR,
+                      "Giving up after %d consecutive failed attempts " \
+                      "to send: %s" % (budget, ', '.join(exhausted)))
             maintenance(pluginfmri)
-            sys.exit(-1)            
-
-        # Finally, after success, make a record of the latest backup
-        # and release the old snapshot.
-        ds.set_user_property(propname, snaplabel)
-        util.debug("Sending of \"%s\"snapshot streams completed" \
-              % (snaplabel),
-              verbose)
+            sys.exit(-1)
+        log_error(syslog.LOG_WARNING,
+                  "Failed snapshot streams will be retried later")
+        sys.exit(0)
+
+    util.debug("Sending of \"%s\"snapshot streams completed" \
+          % (snaplabel),
+          verbose)
+
+def find_replication_subtrees(selected, everything, prevlabels, existing):
+    """
+    Identifies subtrees of datasets that can be sent as a single
+    recursive incremental replication stream (zfs send -R -I) instead
+    of a stream per dataset. A subtree qualifies if its root has at
+    least one descendant, every dataset in it is in selected, and
+    every one of them was last sent from the same snapshot label,
+    which still exists. Only the topmost qualifying subtrees are
+    returned, in the form of a dictionary:
+    {rootname : [datasetname, ...]}
+
+    Keyword arguments:
+    selected -- sorted list of datasets being sent
+    everything -- list of all filesystems and volumes on the system
+    prevlabels -- maps selected datasets to their previously sent
+                  snapshot label, or None
+    existing -- set of names of all existing snapshots
+    """
+    selectedset = set(selected)
+    everything = sorted(everything)
+    subtrees = {}
+    for root in selected:
+        parent = root
+        covered = False
+        while parent.find('/') != -1:
+            parent = parent.rsplit('/', 1)[0]
+            if parent in subtrees:
+                covered = True
+                break
+        if covered:
+            continue
+        prevlabel = prevlabels[root]
+        if prevlabel == None:
+            continue
+        idx = bisect_right(everything, root)
+        members = [root]
+        for name in everything[idx:]:
+            if name.find(root + '/') != 0:
+                break
+            members.append(name)
+        if len(members) < 2:
+            continue
+        qualifies = True
+        for name in members:
+            if name not in selectedset or \
+               prevlabels[name] != prevlabel or \
+               "%s@%s" % (name, prevlabel) not in existing:
+                qualifies = False
+                break
+        if qualifies:
+            subtrees[root] = members
+    return subtrees
+
+def send_streams(targets, jobs, bookmarks, windows, verbose):
+    """
+    Sends the snapshot streams planned for targets, up to jobs of them
+    concurrently. A stream needed by several targets is only generated
+    once and teed to all of them. A dataset's stream is not started
+    for a target until the stream of its closest ancestor has been
+    received by that target, because zfs receive falls over if it
+    receives a child before the parent if the "-F" option is not used.
+    If bookmarks is True, the newly sent snapshots are bookmarked and
+    their holds released as soon as each stream is received. The
+    progress of each dataset is recorded and saved in the targets'
+    state. No further streams are started for a target after one of
+    its streams fails, nor at all once outside of the time of day
+    windows, which leaves them queued for the next run. Returns a list
+    of error messages for the streams that failed.
+    """
+    done = threading.Condition()
+    shared = {}
+    pending = []
+    parents = {}
+    for target in targets:
+        parents[target] = find_parents(target.roots)
+        for root in target.roots:
+            sendcmd,label,prevsnapnames,prevbookmarks,members,flags = \
+                target.streams[root]
+            key = (root, tuple(sendcmd))
+            if key not in shared:
+                shared[key] = SendStream(root, sendcmd, label, members,
+                                         flags, done)
+                pending.append(shared[key])
+            shared[key].add_target(target, prevsnapnames, prevbookmarks)
+    pending.sort(key=lambda s: s.dataset)
+    total = len(pending)
+    running = []
+    completed = set()
+    failed = set()
+    errors = []
+    sent = 0
+    startTime = time.time()
+
+    done.acquire()
+    while len(pending) > 0 or len(running) > 0:
+        if len(pending) > 0 and pluginsmf.seconds_until_window(windows) > 0:
+            util.debug("Outside of the permitted time windows. Leaving " \
+                       "%d snapshot streams until later" % (len(pending)),
+                       verbose)
+            pending = []
+        for stream in pending[:]:
+            if len(running) >= jobs:
+                break
+            for target in stream.targets[:]:
+                if target in failed:
+                    stream.remove_target(target)
+            if len(stream.targets) == 0:
+                pending.remove(stream)
+                continue
+            ready = True
+            for target in stream.targets:
+                parent = parents[target][stream.dataset]
+                if parent != None and (parent, target) not in completed:
+                    ready = False
+                    break
+            if ready == False:
+                continue
+            util.debug("Starting send of %s to %s" \
+                       % (stream.dataset,
+                          ', '.join([str(t) for t in stream.targets])),
+                       verbose)
+            for target in stream.targets:
+                target.state.start(stream.members)
+                target.state.save()
+            pending.remove(stream)
+            running.append(stream)
+            stream.start()
+        if len(running) == 0:
+            # Remaining streams are for targets that had a failure
+            break
+        while len([s for s in running if s.finished]) == 0:
+            done.wait()
+        for stream in [s for s in running if s.finished]:
+            running.remove(stream)
+            stream.join()
+            sent += 1
+            util.debug("Sent %s: %d bytes in %.1f seconds (%.1f KB/s)" \
+                       % (stream.dataset, stream.bytes, stream.elapsed(),
+                          stream.rate / 1024),
+                       verbose)
+            for idx in range(len(stream.targets)):
+                target = stream.targets[idx]
+                if stream.errors[idx] != None:
+                    errors.append("%s: %s" % (target, stream.errors[idx]))
+                    failed.add(target)
+                    target.state.failed(stream.members)
+                    target.state.save()
+                    continue
+                completed.add((stream.dataset, target))
+                record_sent(target, stream, stream.prevsnapnames[idx],
+                            stream.prevbookmarks[idx], targets, bookmarks,
+                            verbose)
+    done.release()
+    util.debug("Sent %d of %d snapshot streams in %.1f seconds using " \
+               "up to %d concurrent streams" \
+               % (sent, total, time.time() - startTime, jobs),
+               verbose)
+    return errors
+
+def record_sent(target, stream, prevsnapnames, prevbookmarks, targets,
+                bookmarks, verbose):
+    """
+    Makes a record of the latest backup to target and releases the
+    holds on the snapshots sent previously
+    """
+    propname = target.propname
+    zfsdatasets = zfs.Datasets()
+    zfsdatasets.set_user_property(propname, stream.label, stream.members)
+    if bookmarks == True:
+        # The new snapshots stay held unless they could be bookmarked.
+        snapnames = ["%s@%s" % (name, stream.label) \
+                     for name in stream.members]
+        marked = set(zfsdatasets.create_bookmarks(snapnames))
+        snapnames = [name for name in snapnames \
+                     if name.replace('@', '#', 1) in marked]
+        util.debug("Bookmarked and releasing hold on: %s" \
+                   % (', '.join(snapnames)),
+                   verbose)
+        zfsdatasets.release_snapshots(propname, snapnames)
+    if len(prevsnapnames) > 0:
+        util.debug("Releasing hold on previous and missed " \
+                   "snapshots: %s" \
+                   % (', '.join(prevsnapnames)),
+                   verbose)
+        zfsdatasets.release_snapshots(propname, prevsnapnames)
+    # Bookmarks of the previously sent snapshots are superseded by
+    # the latest backup, unless another target still needs them.
+    if len(prevbookmarks) > 0 and len(targets) > 1:
+        props = zfsdatasets.get_properties([t.propname for t in targets],
+                                           stream.members)
+        inuse = set()
+        for name,values in props.items():
+            inuse.update(["%s#%s" % (name, value) \
+                          for value in values.values()])
+        prevbookmarks = [name for name in prevbookmarks \
+                         if name not in inuse]
+    zfsdatasets.destroy_bookmarks(prevbookmarks)
+    target.state.sent(stream.members, ''.join(stream.flags))
+    target.state.save()
 
 def maintenance(svcfmri):
     log_error(syslog.LOG_ERR,
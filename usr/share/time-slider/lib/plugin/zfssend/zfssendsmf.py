@@ -0,0 +1,143 @@
+#!/usr/bin/python2.6
+#
+# CDDL HEADER START
+#
+# The contents of this file are subject to the terms of the
+# Common Development and Distribution License (the "License").
+# You may not use this file except in compliance with the License.
+#
+# You can obtain a copy of the license at usr/src/OPENSOLARIS.LICENSE
+# or http://www.opensolaris.org/os/licensing.
+# See the License for the specific language governing permissions
+# and limitations under the License.
+#
+# When distributing Covered Code, include this CDDL HEADER in each
+# file and include the License file at usr/src/OPENSOLARIS.LICENSE.
+# If applicable, add the following below this CDDL HEADER, with the
+# fields enclosed by brackets "[]" replaced with your own identifying
+# information: Portions Copyright [yyyy] [name of copyright owner]
+#
+# CDDL HEADER END
+#
+
+
+from plugin import pluginsmf
+
+RECEIVEPROPGROUP = "receive"
+SENDPROPGROUP = "send"
+
+class ZfsSendSMF(pluginsmf.PluginSMF):
+
+    def __init__(self, instanceName):
+        pluginsmf.PluginSMF.__init__(self, instanceName)
+
+    def get_targets(self):
+        """
+        Returns the names of the additional receive targets, each of
+        which is configured by a property group named "receive-<name>"
+        """
+        value = self.get_prop(RECEIVEPROPGROUP, "targets")
+        # Strip out '\' characters inserted by svcprop
+        targets = value.strip().replace('\\', '').replace(',', ' ')
+        return targets.split()
+
+    def get_receive_group(self, target=None):
+        """
+        Returns the name of the property group configuring target, or
+        the default receive target if target is None
+        """
+        if target == None:
+            return RECEIVEPROPGROUP
+        return "%s-%s" % (RECEIVEPROPGROUP, target)
+
+    def _get_receive_prop(self, target, propname):
+        """
+        Additional targets only need to define the properties they
+        use. Those left out are treated as empty.
+        """
+        try:
+            return self.get_prop(self.get_receive_group(target), propname)
+        except RuntimeError:
+            if target == None:
+                raise
+            return ""
+
+    def get_receive_command(self, target=None):
+        value = self._get_receive_prop(target, "command")
+        # Strip out '\' characters inserted by svcprop
+        return value.strip().replace('\\', '').split()
+
+    def get_jobs(self):
+        result = self.get_prop(SENDPROPGROUP, "jobs").strip()
+        try:
+            jobs = int(result)
+        except ValueError:
+            jobs = 1
+        return max(jobs, 1)
+
+    def get_failure_budget(self):
+        """
+        Returns the number of consecutive failed attempts to send a
+        dataset tolerated before the plugin gives up
+        """
+        result = self.get_prop(SENDPROPGROUP, "failure_budget").strip()
+        try:
+            budget = int(result)
+        except ValueError:
+            budget = 5
+        return max(budget, 1)
+
+    def get_recursive(self):
+        value = self.get_prop(SENDPROPGROUP, "recursive")
+        if value == "true":
+            return True
+        else:
+            return False
+
+    def get_bookmarks(self):
+        value = self.get_prop(SENDPROPGROUP, "bookmarks")
+        if value == "true":
+            return True
+        else:
+            return False
+
+    def get_buffer_size(self):
+        """Returns the stream buffer size in bytes"""
+        result = self.get_prop(SENDPROPGROUP, "buffer_size").strip()
+        try:
+            size = int(result)
+        except ValueError:
+            size = 64
+        return max(size, 1) * 1024 * 1024
+
+    def get_compression(self):
+        value = self.get_prop(SENDPROPGROUP, "compression").strip()
+        if len(value) == 0:
+            return "none"
+        return value
+
+    def get_token_command(self, target=None):
+        value = self._get_receive_prop(target, "token_command")
+        # Strip out '\' characters inserted by svcprop
+        return value.strip().replace('\\', '').split()
+
+    def get_list_command(self, target=None):
+        value = self._get_receive_prop(target, "list_command")
+        # Strip out '\' characters inserted by svcprop
+        return value.strip().replace('\\', '').split()
+
+    def get_send_flags(self):
+        """
+        Returns the list of zfs send option letters to use if the
+        receive side supports them
+        """
+        value = self.get_prop(SENDPROPGROUP, "flags")
+        # Strip out '\' characters inserted by svcprop
+        flags = value.strip().replace('\\', '').split(',')
+        return [flag.strip().lstrip('-') for flag in flags \
+                if len(flag.strip()) > 0]
+
+    def get_probe_command(self, target=None):
+        value = self._get_receive_prop(target, "probe_command")
+        # Strip out '\' characters inserted by svcprop
+        return value.strip().replace('\\', '').split()
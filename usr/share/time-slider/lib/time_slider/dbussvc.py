@@ -84,6 +84,12 @@ class RsyncBackup(dbus.service.Object):
     def rsync_unsynced(self, queueSize):
         pass
 
+    # Rsync trash reaper rsync_reclaimed signal
+    @dbus.service.signal(dbus_interface="org.opensolaris.TimeSlider.plugin.rsync",
+                         signature='st')
+    def rsync_reclaimed(self, target, reclaimed):
+        pass
+
 
 class Config(dbus.service.Object):
     """
@@ -26,8 +26,8 @@ import os
 import time
 import getopt
 import locale
-import shutil
 import fcntl
+import subprocess
 from bisect import insort
 
 try:
@@ -76,6 +76,18 @@ gtk.glade.textdomain(GETTEXT_DOMAIN)
 import zfs
 from rbac import RBACprofile
 
+# Number of snapshots scanned before they are handed to the view
+SCANBATCHSIZE = 1000
+# Milliseconds to wait for typing in the filter entries to pause
+FILTERDELAY = 250
+# Maximum number of snapshots destroyed between progress updates
+DELETEBATCHSIZE = 100
+
+SIZETEMPLATES = [(1024.0 ** 4, "%0.1f TB"),
+                 (1024.0 ** 3, "%0.1f GB"),
+                 (1024.0 ** 2, "%0.1f MB"),
+                 (1024.0, "%0.1f KB")]
+
 class RsyncBackup:
 
     def __init__(self, mountpoint, rsync_dir = None,  fsname= None, snaplabel= None, creationtime= None):
@@ -155,9 +167,8 @@ class RsyncBackup:
                                  rsyncsmf.RSYNCTRASHSUFFIX,
                                  self.snaplabel)
 
-        # move then delete
+        # move to the trash. The trash reaper deletes it later.
         os.rename (self.mountpoint, backupTrashDir)
-        shutil.rmtree (backupTrashDir)
 
         log = "%s/%s/%s/%s.log" % (self.rsync_dir,
                                    self.fsname,
@@ -169,6 +180,210 @@ class RsyncBackup:
         lockFp.close()
         os.unlink(lockFile)
 
+def format_creation_time(creationtime):
+    try:
+        tm = time.localtime(creationtime)
+        return unicode(time.strftime ("%c", tm),
+                       locale.getpreferredencoding()).encode('utf-8')
+    except:
+        return time.ctime(creationtime)
+
+def format_size(size):
+    if size == None:
+        return ""
+    for threshold,template in SIZETEMPLATES:
+        if size >= threshold:
+            return template % (size / threshold)
+    return "%d B" % size
+
+def parse_size(value):
+    """
+    Returns the parsable zfs(1) size property value as a long, or None
+    if it isn't available
+    """
+    try:
+        return long(value)
+    except ValueError:
+        return None
+
+class SnapshotListModel(gtk.GenericTreeModel):
+    """
+    Virtual list model of the snapshots and backups in the delete
+    dialog. Each row is kept as a compact tuple of:
+    (fsname, snaplabel, creationtime, backup, used, referenced, written)
+    where backup is the RsyncBackup of an external backup or None for
+    a snapshot, and the sizes are in bytes, or None if unknown. Column
+    values are only worked out when the view asks for them, which is
+    only for the visible rows, and zfs.Snapshot objects are only
+    created for the rows that get selected.
+    """
+
+    column_types = (str, str, str, str, str, long, gobject.TYPE_PYOBJECT,
+                    str, str, str)
+
+    def __init__(self, mounts, rows = None):
+        gtk.GenericTreeModel.__init__(self)
+        # Row references are indices into self.rows. Keep references
+        # to them ourselves rather than leaking one per iterator.
+        self.set_property("leak-references", False)
+        self.mounts = mounts
+        self.rows = []
+        self.__refs = []
+        if rows:
+            self.rows = rows
+            self.__refs = range(len(rows))
+
+    def append_rows(self, rows):
+        first = len(self.rows)
+        self.rows.extend(rows)
+        self.__refs.extend(range(first, len(self.rows)))
+        for idx in range(first, len(self.rows)):
+            path = (idx,)
+            self.row_inserted(path, self.get_iter(path))
+
+    def get_item(self, rowref):
+        """
+        Returns the RsyncBackup or zfs.Snapshot object of the row
+        """
+        fsname,snaplabel,creationtime,backup = self.rows[rowref][:4]
+        if backup != None:
+            return backup
+        return zfs.Snapshot("%s@%s" % (fsname, snaplabel), creationtime)
+
+    def on_get_flags(self):
+        return gtk.TREE_MODEL_LIST_ONLY
+
+    def on_get_n_columns(self):
+        return len(self.column_types)
+
+    def on_get_column_type(self, index):
+        return self.column_types[index]
+
+    def on_get_iter(self, path):
+        if path[0] < len(self.rows):
+            return self.__refs[path[0]]
+        return None
+
+    def on_get_path(self, rowref):
+        return (rowref,)
+
+    def on_get_value(self, rowref, column):
+        fsname,snaplabel,creationtime,backup = self.rows[rowref][:4]
+        if column == 0:
+            if backup == None:
+                return _("Snapshot")
+            return _("Backup")
+        elif column == 1:
+            if backup != None:
+                return backup.zfs_mountpoint
+            mountpoint = self.mounts[fsname]
+            if mountpoint == "legacy":
+                return _("Legacy")
+            return mountpoint
+        elif column == 2:
+            return fsname
+        elif column == 3:
+            return snaplabel
+        elif column == 4:
+            if backup != None:
+                return backup.creationtime_str
+            return format_creation_time(creationtime)
+        elif column == 5:
+            return creationtime
+        elif column == 6:
+            return self.get_item(rowref)
+        else:
+            return format_size(self.rows[rowref][column - 3])
+
+    def on_iter_next(self, rowref):
+        if rowref + 1 < len(self.rows):
+            return self.__refs[rowref + 1]
+        return None
+
+    def on_iter_children(self, rowref):
+        if rowref == None and len(self.rows) > 0:
+            return self.__refs[0]
+        return None
+
+    def on_iter_has_child(self, rowref):
+        return False
+
+    def on_iter_n_children(self, rowref):
+        if rowref == None:
+            return len(self.rows)
+        return 0
+
+    def on_iter_nth_child(self, rowref, n):
+        if rowref == None and n < len(self.rows):
+            return self.__refs[n]
+        return None
+
+    def on_iter_parent(self, rowref):
+        return None
+
+class SnapshotIndex:
+    """
+    Index of the rows of the delete dialog (see SnapshotListModel) for
+    filtering them by file system name, snapshot label and type.
+    There are far fewer distinct file system names and labels than
+    rows, since every snapshot schedule uses the same labels on each
+    file system, so substring matches are only looked for among the
+    distinct values. The rows of the matching values are then
+    gathered from their sorted row index lists.
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.__fsnames = {}
+        self.__labels = {}
+        self.__types = {"Backup" : [], "Snapshot" : []}
+        for idx in range(len(rows)):
+            fsname,snaplabel,creationtime,backup = rows[idx][:4]
+            self.__fsnames.setdefault(fsname, []).append(idx)
+            self.__labels.setdefault(snaplabel, []).append(idx)
+            if backup != None:
+                self.__types["Backup"].append(idx)
+            else:
+                self.__types["Snapshot"].append(idx)
+
+    def __find(self, values, pattern):
+        """
+        Returns the set of row indices of the values in the dictionary
+        values that contain pattern
+        """
+        result = set()
+        for value,indices in values.iteritems():
+            if value.find(pattern) != -1:
+                result.update(indices)
+        return result
+
+    def get_filesystem_rows(self, fsname):
+        """
+        Returns the rows of the file system fsname in their original order
+        """
+        return [self.rows[idx] for idx in self.__fsnames.get(fsname, [])]
+
+    def filter(self, filesys = None, snap = None, btype = None):
+        """
+        Returns the rows matching the filter values, in their original
+        order. A value of None matches everything.
+        """
+        matches = []
+        if filesys != None:
+            matches.append(self.__find(self.__fsnames, filesys))
+        if snap != None:
+            matches.append(self.__find(self.__labels, snap))
+        if btype != None and btype != "All":
+            matches.append(self.__types[btype])
+        if len(matches) == 0:
+            return self.rows[:]
+        # Narrow down the smallest candidate set.
+        matches.sort(key=len)
+        result = set(matches[0])
+        for match in matches[1:]:
+            result.intersection_update(match)
+        return [self.rows[idx] for idx in sorted(result)]
+
 class DeleteSnapManager:
 
     def __init__(self, snapshots = None):
@@ -176,6 +391,24 @@ class DeleteSnapManager:
                                   % (os.path.dirname(__file__)))
         self.backuptodelete = []
         self.shortcircuit = []
+        # Compact rows of everything scanned so far. See
+        # SnapshotListModel.
+        self.snaprows = []
+        self.snapmodel = None
+        self.snapscanner = None
+        # Shared with the scanners, which fill it in.
+        self.mounts = {}
+        self.sortcolumn = None
+        self.sortorder = gtk.SORT_ASCENDING
+        # Set once the scan completes. Until then rows are filtered
+        # one by one.
+        self.snapindex = None
+        # The last filter values applied and the rows they matched
+        self.lastfilter = None
+        self.lastresult = None
+        self.filtertimeout = None
+        self.reclaimestimate = None
+        self.reclaimtimeout = None
         maindialog = self.xml.get_widget("time-slider-delete")
         self.pulsedialog = self.xml.get_widget("pulsedialog")
         self.pulsedialog.set_transient_for(maindialog)
@@ -207,15 +440,12 @@ class DeleteSnapManager:
     def initialise_view(self):
         if len(self.shortcircuit) == 0:
             # Set TreeViews
-            self.liststorefs = gtk.ListStore(str, str, str, str, str, long,
-                                             gobject.TYPE_PYOBJECT)
-            list_filter = self.liststorefs.filter_new()
-            list_sort = gtk.TreeModelSort(list_filter)
-            list_sort.set_sort_column_id(1, gtk.SORT_ASCENDING)
-
             self.snaptreeview = self.xml.get_widget("snaplist")
-            self.snaptreeview.set_model(self.liststorefs)
             self.snaptreeview.get_selection().set_mode(gtk.SELECTION_MULTIPLE)
+            # The virtual list model doesn't support reordering rows by
+            # drag and drop.
+            self.snaptreeview.set_reorderable(False)
+            self.__set_model([])
 
             cell0 = gtk.CellRendererText()
             cell1 = gtk.CellRendererText()
@@ -226,7 +456,7 @@ class DeleteSnapManager:
 
             typecol = gtk.TreeViewColumn(_("Type"),
                                             cell0, text = 0)
-            typecol.set_sort_column_id(0)
+            typecol.set_clickable(True)
             typecol.set_resizable(True)
             typecol.connect("clicked",
                 self.__on_treeviewcol_clicked, 0)
@@ -234,7 +464,7 @@ class DeleteSnapManager:
 
             mountptcol = gtk.TreeViewColumn(_("Mount Point"),
                                             cell1, text = 1)
-            mountptcol.set_sort_column_id(1)
+            mountptcol.set_clickable(True)
             mountptcol.set_resizable(True)
             mountptcol.connect("clicked",
                 self.__on_treeviewcol_clicked, 1)
@@ -242,7 +472,7 @@ class DeleteSnapManager:
 
             fsnamecol = gtk.TreeViewColumn(_("File System Name"),
                                            cell2, text = 2)
-            fsnamecol.set_sort_column_id(2)
+            fsnamecol.set_clickable(True)
             fsnamecol.set_resizable(True)
             fsnamecol.connect("clicked",
                 self.__on_treeviewcol_clicked, 2)
@@ -250,7 +480,7 @@ class DeleteSnapManager:
 
             snaplabelcol = gtk.TreeViewColumn(_("Snapshot Name"),
                                               cell3, text = 3)
-            snaplabelcol.set_sort_column_id(3)
+            snaplabelcol.set_clickable(True)
             snaplabelcol.set_resizable(True)
             snaplabelcol.connect("clicked",
                 self.__on_treeviewcol_clicked, 3)
@@ -259,12 +489,37 @@ class DeleteSnapManager:
             cell4.props.xalign = 1.0
             creationcol = gtk.TreeViewColumn(_("Creation Time"),
                                              cell4, text = 4)
-            creationcol.set_sort_column_id(5)
+            creationcol.set_clickable(True)
             creationcol.set_resizable(True)
             creationcol.connect("clicked",
                 self.__on_treeviewcol_clicked, 5)
             self.snaptreeview.append_column(creationcol)
 
+            # Space used only by the snapshot, referenced by it, and
+            # written since the previous snapshot.
+            for title,column in [(_("Used"), 7),
+                                 (_("Referenced"), 8),
+                                 (_("Written"), 9)]:
+                cell = gtk.CellRendererText()
+                cell.props.xalign = 1.0
+                sizecol = gtk.TreeViewColumn(title, cell, text = column)
+                sizecol.set_clickable(True)
+                sizecol.set_resizable(True)
+                sizecol.connect("clicked",
+                    self.__on_treeviewcol_clicked, column)
+                self.snaptreeview.append_column(sizecol)
+
+            # Fixed height mode saves the view from measuring every row,
+            # so only the visible rows are ever looked at. It requires
+            # fixed width columns.
+            for column,width in zip(self.snaptreeview.get_columns(),
+                                    [90, 180, 180, 280, 200, 90, 90, 90]):
+                column.set_sizing(gtk.TREE_VIEW_COLUMN_FIXED)
+                column.set_fixed_width(width)
+            self.snaptreeview.set_fixed_height_mode(True)
+            self.snaptreeview.get_selection().connect("changed",
+                self.__on_selection_changed)
+
             # Note to developers.
             # The second element is for internal matching and should not
             # be i18ned under any circumstances.
@@ -313,14 +568,13 @@ class DeleteSnapManager:
             self.fsfilterentry.set_active(0)
             self.typefiltercombo.set_active(0)
         else:
-            cloned = self.datasets.list_cloned_snapshots()
+            cloned = set(self.datasets.list_cloned_snapshots())
             num_snap = 0
             num_rsync = 0
             for snapname in self.shortcircuit:
                 # Filter out snapshots that are the root
                 # of cloned filesystems or volumes
-                try:
-                    cloned.index(snapname)
+                if snapname in cloned:
                     dialog = gtk.MessageDialog(None,
                                    0,
                                    gtk.MESSAGE_ERROR,
@@ -335,15 +589,14 @@ class DeleteSnapManager:
                     dialog.format_secondary_text(text)
                     dialog.run()
                     sys.exit(1)
-                except ValueError:
-                    path = os.path.abspath (snapname)
-                    if not os.path.exists (path):
-                        snapshot = zfs.Snapshot(snapname)
-                        self.backuptodelete.append(snapshot)
-                        num_snap += 1
-                    else:
-                        self.backuptodelete.append(RsyncBackup (snapname))
-                        num_rsync += 1
+                path = os.path.abspath (snapname)
+                if not os.path.exists (path):
+                    snapshot = zfs.Snapshot(snapname)
+                    self.backuptodelete.append(snapshot)
+                    num_snap += 1
+                else:
+                    self.backuptodelete.append(RsyncBackup (snapname))
+                    num_rsync += 1
 
             confirm = self.xml.get_widget("confirmdialog")
             summary = self.xml.get_widget("summarylabel")
@@ -376,41 +629,68 @@ class DeleteSnapManager:
 
     def __on_treeviewcol_clicked(self, widget, searchcol):
         self.snaptreeview.set_search_column(searchcol)
+        if self.sortcolumn == searchcol and \
+           self.sortorder == gtk.SORT_ASCENDING:
+            self.sortorder = gtk.SORT_DESCENDING
+        else:
+            self.sortorder = gtk.SORT_ASCENDING
+        self.sortcolumn = searchcol
+        for column in self.snaptreeview.get_columns():
+            column.set_sort_indicator(column == widget)
+        widget.set_sort_order(self.sortorder)
+        self.__apply_filter()
+
+    def __sort_key(self, row):
+        fsname,snaplabel,creationtime,backup = row[:4]
+        if self.sortcolumn == 0:
+            return (backup != None, fsname, snaplabel)
+        elif self.sortcolumn == 1:
+            if backup != None:
+                return backup.zfs_mountpoint
+            return self.mounts[fsname]
+        elif self.sortcolumn == 2:
+            return fsname
+        elif self.sortcolumn == 3:
+            return snaplabel
+        elif self.sortcolumn == 5:
+            return creationtime
+        else:
+            return row[self.sortcolumn - 3]
 
     def __filter_snapshot_list(self, list, filesys = None, snap = None, btype = None):
         if filesys == None and snap == None and btype == None:
             return list
         fssublist = []
         if filesys != None:
-            for snapshot in list:
-                if snapshot.fsname.find(filesys) != -1:
-                    fssublist.append(snapshot)
+            for row in list:
+                if row[0].find(filesys) != -1:
+                    fssublist.append(row)
         else:
             fssublist = list
 
         snaplist = []
         if snap != None:
-            for snapshot in fssublist:
-                if  snapshot.snaplabel.find(snap) != -1:
-                    snaplist.append(snapshot)
+            for row in fssublist:
+                if  row[1].find(snap) != -1:
+                    snaplist.append(row)
         else:
             snaplist = fssublist
 
         typelist = []
         if btype != None and btype != "All":
-            for item in snaplist:
+            for row in snaplist:
                 if btype == "Backup":
-                    if isinstance(item, RsyncBackup):
-                        typelist.append (item)
+                    if row[3] != None:
+                        typelist.append (row)
                 else:
-                    if isinstance(item, zfs.Snapshot):
-                        typelist.append (item)
+                    if row[3] == None:
+                        typelist.append (row)
         else:
             typelist = snaplist
 
         return typelist
 
-    def __on_filterentry_changed(self, widget):
+    def __get_filter(self):
         # Get the filesystem filter value
         iter = self.fsfilterentry.get_active_iter()
         if iter == None:
@@ -433,47 +713,122 @@ class DeleteSnapManager:
         else:
             model = self.typefiltercombo.get_model()
             type = model.get(iter, 1)[0]
+        return filesys,snap,type
 
-        self.liststorefs.clear()
-        newlist = self.__filter_snapshot_list(self.snapscanner.snapshots,
-                    filesys,
-                    snap, type)
-        for snapshot in newlist:
-            try:
-                tm = time.localtime(snapshot.get_creation_time())
-                t = unicode(time.strftime ("%c", tm),
-                    locale.getpreferredencoding()).encode('utf-8')
-            except:
-                t = time.ctime(snapshot.get_creation_time())
-            try:
-                mount_point = self.snapscanner.mounts[snapshot.fsname]
-                if (mount_point == "legacy"):
-                    mount_point = _("Legacy")
-
-                self.liststorefs.append([
-                       _("Snapshot"),
-                       mount_point,
-                       snapshot.fsname,
-                       snapshot.snaplabel,
-                       t,
-                       snapshot.get_creation_time(),
-                       snapshot])
-            except KeyError:
+    def __set_model(self, rows):
+        self.snapmodel = SnapshotListModel(self.mounts, rows)
+        self.snaptreeview.set_model(self.snapmodel)
+
+    def __on_filterentry_changed(self, widget):
+        # Wait for typing to pause rather than filtering the list on
+        # every keystroke.
+        if self.filtertimeout != None:
+            glib.source_remove(self.filtertimeout)
+        self.filtertimeout = glib.timeout_add(FILTERDELAY,
+                                              self.__apply_filter)
+
+    def __narrows(self, oldfilter, newfilter):
+        """
+        Returns True if everything newfilter matches is also matched
+        by oldfilter
+        """
+        for old,new in zip(oldfilter[:2], newfilter[:2]):
+            if old == None:
                 continue
-                # This will catch exceptions from things we ignore
-                # such as dump as swap volumes and skip over them.
-            # add rsync backups
-        newlist = self.__filter_snapshot_list(self.snapscanner.rsynced_backups,
-                                                filesys,
-                                                snap, type)
-        for backup in newlist:
-            self.liststorefs.append([_("Backup"),
-                                     backup.zfs_mountpoint,
-                                     backup.fsname,
-                                     backup.snaplabel,
-                                     backup.creationtime_str,
-                                     backup.creationtime,
-                                     backup])
+            if new == None or new.find(old) == -1:
+                return False
+        return oldfilter[2] in (None, "All") or \
+               oldfilter[2] == newfilter[2]
+
+    def __apply_filter(self):
+        self.filtertimeout = None
+        filesys,snap,type = self.__get_filter()
+        if self.lastfilter != None and \
+           self.__narrows(self.lastfilter, (filesys, snap, type)):
+            # Only the rows that matched before can still match
+            newlist = self.__filter_snapshot_list(self.lastresult,
+                                                  filesys,
+                                                  snap, type)
+        elif self.snapindex != None:
+            newlist = self.snapindex.filter(filesys, snap, type)
+        else:
+            newlist = self.__filter_snapshot_list(self.snaprows,
+                                                  filesys,
+                                                  snap, type)
+        self.lastfilter = (filesys, snap, type)
+        self.lastresult = newlist
+        if self.sortcolumn != None:
+            newlist = sorted(newlist, key=self.__sort_key,
+                             reverse=(self.sortorder == gtk.SORT_DESCENDING))
+        else:
+            # The model's rows get appended to during a scan
+            newlist = newlist[:]
+        self.__set_model(newlist)
+        return False
+
+    def __add_scanned_rows(self, scanner):
+        """
+        Adds the rows scanned since the last call to the view, keeping
+        the rows already shown in place even if they are sorted.
+        """
+        if self.snapmodel == None:
+            # The view hasn't been set up yet.
+            return
+        rows = scanner.take_rows()
+        if len(rows) == 0:
+            return
+        self.snaprows.extend(rows)
+        self.lastfilter = None
+        filesys,snap,type = self.__get_filter()
+        self.snapmodel.append_rows(self.__filter_snapshot_list(rows,
+                                                               filesys,
+                                                               snap, type))
+
+    def __on_selection_changed(self, selection):
+        # Selecting a range of rows emits a signal per row. Wait for the
+        # selection to settle before estimating.
+        if self.reclaimtimeout != None:
+            glib.source_remove(self.reclaimtimeout)
+        self.reclaimtimeout = glib.timeout_add(FILTERDELAY,
+                                               self.__estimate_reclaim)
+
+    def __estimate_reclaim(self):
+        self.reclaimtimeout = None
+        if self.reclaimestimate != None:
+            self.reclaimestimate.cancel()
+            self.reclaimestimate = None
+        model,paths = self.snaptreeview.get_selection().get_selected_rows()
+        selected = {}
+        for path in paths:
+            row = model.rows[path[0]]
+            # Only snapshots are estimated, not backups
+            if row[3] == None:
+                selected.setdefault(row[0], []).append(row[1])
+        label = self.xml.get_widget("reclaimlabel")
+        if len(selected) == 0:
+            label.set_text("")
+            return False
+        label.set_text(_("Estimating the space freed by deleting "
+                         "the selected snapshots..."))
+        self.reclaimestimate = ReclaimEstimate(selected, self.snapindex)
+        self.reclaimestimate.start()
+        glib.timeout_add(200, self.__monitor_reclaim, self.reclaimestimate)
+        return False
+
+    def __monitor_reclaim(self, estimate):
+        # The selection may have changed since.
+        if estimate != self.reclaimestimate:
+            return False
+        if estimate.isAlive() == True:
+            return True
+        label = self.xml.get_widget("reclaimlabel")
+        if estimate.size == None:
+            label.set_text(_("The space freed by deleting the selected "
+                             "snapshots could not be estimated."))
+        else:
+            label.set_text(_("Deleting the selected snapshots will free "
+                             "about %s.") % format_size(estimate.size))
+        return False
 
     def __on_selectbutton_clicked(self, widget):
         selection = self.snaptreeview.get_selection()
@@ -528,10 +883,10 @@ class DeleteSnapManager:
         return
 
     def __init_scan(self):
-        self.snapscanner = ScanSnapshots()
+        self.snapscanner = ScanSnapshots(self.mounts)
         self.pulsedialog.show()
         self.snapscanner.start()
-        glib.timeout_add(100, self.__monitor_scan)
+        glib.timeout_add(100, self.__monitor_scan, self.snapscanner)
         return False
 
     def __init_delete(self):
@@ -545,9 +900,19 @@ class DeleteSnapManager:
         glib.timeout_add(300, self.__monitor_deletion)
         return False
 
-    def __monitor_scan(self):
-        if self.snapscanner.isAlive() == True:
-            self.xml.get_widget("pulsebar").pulse()
+    def __monitor_scan(self, scanner):
+        # A rescan may have been started since.
+        if scanner != self.snapscanner:
+            return False
+        # Rows are shown in batches as they get scanned. Once there's
+        # something to look at, the user needn't wait for the rest.
+        alive = scanner.isAlive()
+        self.__add_scanned_rows(scanner)
+        if alive == True:
+            if len(self.snaprows) > 0:
+                self.pulsedialog.hide()
+            else:
+                self.xml.get_widget("pulsebar").pulse()
             return True
         else:
             self.pulsedialog.hide()
@@ -564,7 +929,10 @@ class DeleteSnapManager:
                     details = details + error
                 dialog.format_secondary_text(details)
                 dialog.show()
-            self.__on_filterentry_changed(None)
+            self.snapindex = scanner.index
+            # Rows added during the scan were appended unsorted.
+            if self.sortcolumn != None:
+                self.__apply_filter()
             return False
 
     def __monitor_deletion(self):
@@ -598,7 +966,11 @@ class DeleteSnapManager:
             return False
 
     def __refresh_view(self):
-        self.liststorefs.clear()
+        self.xml.get_widget("reclaimlabel").set_text("")
+        self.snaprows = []
+        self.snapindex = None
+        self.lastfilter = None
+        self.__set_model([])
         glib.idle_add(self.__init_scan)
         self.backuptodelete = []
 
@@ -618,20 +990,56 @@ class DeleteSnapManager:
         widget.hide()
 
 class ScanSnapshots(threading.Thread):
-
-    def __init__(self):
+    """
+    Scans the snapshots and rsync backups in the background, handing
+    them over to the view in batches of compact rows as they are found.
+    See SnapshotListModel for the format of the rows. mounts, a
+    dictionary mapping filesystems to their mountpoints, is filled in
+    before any snapshot rows are made available.
+    """
+
+    def __init__(self, mounts):
         threading.Thread.__init__(self)
         self.errors = []
         self.datasets = zfs.Datasets()
-        self.snapshots = []
-        self.rsynced_fs = []
+        self.mounts = mounts
         self.rsynced_backups = []
+        self.index = None
+        self.__rows = []
+        self.__allrows = []
+        self.__rowslock = threading.Lock()
 
     def run(self):
-        self.mounts = self.__get_fs_mountpoints()
+        self.mounts.update(self.__get_fs_mountpoints())
         self.rsyncsmf = rsyncsmf.RsyncSMF("%s:rsync" %(plugin.PLUGINBASEFMRI))
         self.__get_rsync_backups ()
-        self.rescan()
+        self.__push_rows([(backup.fsname, backup.snaplabel,
+                           long(backup.creationtime), backup,
+                           None, None, None) \
+                          for backup in self.rsynced_backups])
+        try:
+            self.rescan()
+        except RuntimeError, message:
+            self.errors.append(str(message))
+        # Build the index for filtering here rather than hold up the
+        # user interface.
+        self.index = SnapshotIndex(self.__allrows)
+
+    def take_rows(self):
+        """
+        Returns the rows scanned since the previous call
+        """
+        self.__rowslock.acquire()
+        rows = self.__rows
+        self.__rows = []
+        self.__rowslock.release()
+        return rows
+
+    def __push_rows(self, rows):
+        self.__allrows.extend(rows)
+        self.__rowslock.acquire()
+        self.__rows.extend(rows)
+        self.__rowslock.release()
 
     def __get_rsync_backups (self):
         # get rsync backup dir
@@ -677,19 +1085,98 @@ class ScanSnapshots(threading.Thread):
         return result
 
     def rescan(self):
-        cloned = self.datasets.list_cloned_snapshots()
-        self.snapshots = []
-        snaplist = self.datasets.list_snapshots()
-        for snapname,snaptime in snaplist:
+        cloned = set(self.datasets.list_cloned_snapshots())
+        batch = []
+        # Fetch the sizes along with the names rather than ask for
+        # each snapshot's separately.
+        snaplist = self.datasets.stream_snapshots(["used", "referenced",
+                                                   "written"])
+        for snapname,snaptime,used,referenced,written in snaplist:
             # Filter out snapshots that are the root
             # of cloned filesystems or volumes
+            if snapname in cloned:
+                continue
+            fsname,snaplabel = snapname.split("@", 1)
+            # Skip over snapshots of volumes, such as dump and
+            # swap devices, which have no mountpoint.
+            if fsname not in self.mounts:
+                continue
+            batch.append((fsname, snaplabel, snaptime, None,
+                          parse_size(used), parse_size(referenced),
+                          parse_size(written)))
+            if len(batch) >= SCANBATCHSIZE:
+                self.__push_rows(batch)
+                batch = []
+        self.__push_rows(batch)
+
+class ReclaimEstimate(threading.Thread):
+    """
+    Estimates in the background how much space destroying a selection
+    of snapshots would free, using a dry run of zfs destroy per file
+    system. selected maps each file system to the labels of its
+    selected snapshots. If index, the SnapshotIndex of all the rows,
+    is supplied, runs of consecutive snapshots are passed to zfs(1)
+    as ranges to keep its arguments short.
+    """
+
+    def __init__(self, selected, index = None):
+        threading.Thread.__init__(self)
+        self.selected = selected
+        self.index = index
+        # Set once the estimate completes
+        self.size = None
+        self.__cancelled = False
+
+    def cancel(self):
+        self.__cancelled = True
+
+    def run(self):
+        datasets = zfs.Datasets()
+        total = 0L
+        for fsname in sorted(self.selected.keys()):
+            if self.__cancelled == True:
+                return
+            labels = self.selected[fsname]
+            ranges = self.__get_ranges(fsname)
             try:
-                cloned.index(snapname)
-            except ValueError:
-                snapshot = zfs.Snapshot(snapname, snaptime)
-                self.snapshots.append(snapshot)
+                total += datasets.get_reclaimable_size(fsname, ranges)
+            except RuntimeError:
+                # A range might span a snapshot that can't be
+                # destroyed, such as the origin of a clone.
+                try:
+                    total += datasets.get_reclaimable_size(fsname, labels)
+                except RuntimeError:
+                    return
+        self.size = total
+
+    def __get_ranges(self, fsname):
+        labels = self.selected[fsname]
+        if self.index == None:
+            return labels
+        chosen = set(labels)
+        snaprows = [row for row in self.index.get_filesystem_rows(fsname) \
+                    if row[3] == None]
+        snaprows.sort(key=lambda row: row[2])
+        ranges = []
+        run = []
+        for row in snaprows + [None]:
+            if row != None and row[1] in chosen:
+                run.append(row[1])
+                continue
+            if len(run) == 1:
+                ranges.append(run[0])
+            elif len(run) > 1:
+                ranges.append("%s%%%s" % (run[0], run[-1]))
+            run = []
+        return ranges
 
 class DeleteSnapshots(threading.Thread):
+    """
+    Deletes the selected snapshots and backups in the background.
+    Snapshots are destroyed in batches, each a comma separated list of
+    snapshots of the same file system destroyed by a single zfs(1)
+    invocation, with the pools worked on in parallel.
+    """
 
     def __init__(self, snapshots):
         threading.Thread.__init__(self)
@@ -698,25 +1185,84 @@ class DeleteSnapshots(threading.Thread):
         self.completed = False
         self.progress = 0.0
         self.errors = []
+        self.datasets = zfs.Datasets()
+        self.__deleted = 0
+        self.__lock = threading.Lock()
 
     def run(self):
-        deleted = 0
         self.started = True
-        total = len(self.backuptodelete)
+        trashed = []
+        pools = {}
+        backups = []
         for backup in self.backuptodelete:
+            if isinstance(backup, RsyncBackup):
+                backups.append(backup)
+            else:
+                pools.setdefault(backup.poolname, {}) \
+                     .setdefault(backup.fsname, []).append(backup.name)
+        workers = []
+        for poolname in sorted(pools.keys()):
+            worker = threading.Thread(target=self.__destroy_snapshots,
+                                      args=(pools[poolname],))
+            worker.start()
+            workers.append(worker)
+
+        # Backups are only moved to the trash here, which is quick. The
+        # reaper deletes them afterwards.
+        for backup in backups:
             # The backup could have expired and been automatically
             # destroyed since the user selected it. Check that it
             # still exists before attempting to delete it. If it
             # doesn't exist just silently ignore it.
+            errors = []
             if backup.exists():
                 try:
                     backup.destroy ()
+                    if backup.rsync_dir not in trashed:
+                        trashed.append(backup.rsync_dir)
                 except RuntimeError, inst:
-                    self.errors.append(str(inst))
-            deleted += 1
-            self.progress = deleted / (total * 1.0)
+                    errors.append(str(inst))
+            self.__deleted_items(1, errors)
+        for worker in workers:
+            worker.join()
+
+        # Empty the trash in the background. The reaper carries on
+        # after we exit.
+        for rsyncDir in trashed:
+            try:
+                subprocess.Popen([rsyncsmf.RSYNCREAPERCMD, rsyncDir,
+                                  "%s:rsync" % (plugin.PLUGINBASEFMRI)],
+                                 close_fds=True)
+            except OSError, inst:
+                self.errors.append(str(inst))
         self.completed = True
 
+    def __destroy_snapshots(self, filesystems):
+        """
+        Destroys the snapshots of a single pool. filesystems maps each
+        file system or volume to the names of its snapshots to destroy.
+        Snapshots that have expired and been automatically destroyed
+        since the user selected them are silently ignored by zfs(1).
+        """
+        for fsname in sorted(filesystems.keys()):
+            snapnames = filesystems[fsname]
+            # Update the progress at least every DELETEBATCHSIZE
+            # snapshots.
+            for idx in range(0, len(snapnames), DELETEBATCHSIZE):
+                batch = snapnames[idx:idx + DELETEBATCHSIZE]
+                try:
+                    errors = self.datasets.destroy_snapshots(batch)
+                except RuntimeError, inst:
+                    errors = [str(inst)]
+                self.__deleted_items(len(batch), errors)
+
+    def __deleted_items(self, count, errors):
+        self.__lock.acquire()
+        self.errors.extend(errors)
+        self.__deleted += count
+        self.progress = self.__deleted / (len(self.backuptodelete) * 1.0)
+        self.__lock.release()
+
 def main(argv):
     try:
         opts,args = getopt.getopt(sys.argv[1:], "", [])
@@ -30,6 +30,11 @@ import subprocess
 import string
 import gnomevfs
 import gnome.ui
+import fcntl
+import hashlib
+import mmap
+import shelve
+import zfs
 #import traceback
 
 try:
@@ -72,6 +77,23 @@ MEGABYTES = KILOBYTES*1024
 GIGABYTES = MEGABYTES*1024
 TERABYTES = GIGABYTES*1024
 
+# Number of threads looking for the file in the snapshots. Each lookup
+# can mount a snapshot, so most of the time is spent waiting.
+SCANTHREADS = 8
+
+# Only the attributes needed to display the icon of a file
+ICONATTRIBUTES = "standard::content-type,standard::icon"
+
+# Size of the chunks hashed when comparing the contents of versions
+HASHCHUNKSIZE = 1024*1024
+
+# Versions already found, so that only newer snapshots need to be
+# looked at the next time the same file is explored.
+VERSIONCACHE = os.path.join(os.path.expanduser("~"), ".cache",
+			    "time-slider", "versions")
+# Number of files whose versions are remembered
+VERSIONCACHESIZE = 1000
+
 class File:
 	displayTemplates = [
 		(TERABYTES, '%0.1f TB'), 
@@ -80,14 +102,32 @@ class File:
 		(KILOBYTES, '%0.1f KB'),
 		(0, '%0.1f B'),]
 
-	def __init__(self, path):
+	def __init__(self, path, stat = None):
+		"""
+		stat is the result of os.lstat() on path, if already known.
+		Nothing else is looked up until it is needed.
+		"""
 		self.path = path
 		self.file = gio.File (path)
+		self.info = None
 		try:
-			self.info = self.file.query_info ("*")
+			if stat == None:
+				stat = os.lstat (path)
 			self.exist = True
-		except gio.Error:
+		except OSError:
 			self.exist = False
+			return
+		self.mtime = stat.st_mtime
+		self.size = stat.st_size
+		# Identifies the version of the file. An unchanged file
+		# looks the same in every snapshot.
+		self.key = (stat.st_mtime, stat.st_size, stat.st_ino,
+			    getattr (stat, "st_gen", 0))
+
+	def get_info (self):
+		if self.info == None:
+			self.info = self.file.query_info (ICONATTRIBUTES)
+		return self.info
 
 	def  get_icon (self):
 		#try thumnailer first
@@ -97,31 +137,50 @@ class File:
 		thumb =  icon_factory.lookup (uri, mtime)
 		if thumb:
 		  return gtk.gdk.pixbuf_new_from_file (thumb)
-	        thumb = icon_factory.generate_thumbnail (uri, self.info.get_content_type())
+	        thumb = icon_factory.generate_thumbnail (uri, self.get_info().get_content_type())
 		if thumb:
 		  icon_factory.save_thumbnail (thumb, uri, mtime)
 		  return thumb
 		 #fallback get the themed icon
-		return gtk.icon_theme_get_default().choose_icon (self.info.get_icon().get_property ("names"), 48,  gtk.ICON_LOOKUP_USE_BUILTIN).load_icon ()
+		return gtk.icon_theme_get_default().choose_icon (self.get_info().get_icon().get_property ("names"), 48,  gtk.ICON_LOOKUP_USE_BUILTIN).load_icon ()
 
 	def  get_size (self):
-		amount = self.info.get_size ()
+		amount = self.size
 		for treshold, template in self.displayTemplates:
 			if amount > treshold:
 				if treshold:
 					amount = amount /treshold
-				return "%s (%d bytes)" % (template % amount, self.info.get_size ())
+				return "%s (%d bytes)" % (template % amount, self.size)
 		return "%d byte" % amount
 
-	def add_if_unique (self, versions):
-		found = False
-		for file in versions:
-			if int (file.info.get_modification_time ()) == int (self.info.get_modification_time ()):
-				found = True
-		if not found:
-			versions.append (self)
-			return True
-		return False
+	def get_date (self):
+		return time.strftime ("%d/%m/%y %Hh%Ms%S", time.localtime(self.mtime))
+
+	def get_digest (self):
+		"""
+		Returns a digest of the contents of the file, read through
+		mmap one chunk at a time, or None if it can't be read.
+		"""
+		digest = hashlib.sha1 ()
+		try:
+			f = open (self.path, "rb")
+		except IOError:
+			return None
+		try:
+			# Empty files can't be mapped
+			if self.size > 0:
+				try:
+					m = mmap.mmap (f.fileno (), 0, access=mmap.ACCESS_READ)
+				except (EnvironmentError, mmap.error):
+					return None
+				try:
+					for offset in range (0, len (m), HASHCHUNKSIZE):
+						digest.update (m[offset:offset + HASHCHUNKSIZE])
+				finally:
+					m.close ()
+		finally:
+			f.close ()
+		return digest.hexdigest ()
 
 	def get_mime_type (self):
 		return gnomevfs.get_mime_type(gnomevfs.make_uri_from_input(self.path))
@@ -139,9 +198,11 @@ class File:
 class FileVersionWindow:
 	meld_hint_displayed = False
 
-	def __init__(self, snap_path, file):
+	def __init__(self, snap_path, file, bisect = True, contents = False):
 		self.snap_path = snap_path
 		self.filename = file
+		self.bisect = bisect
+		self.contents = contents
 		self.xml = gtk.glade.XML("%s/../../glade/time-slider-version.glade" \
 			% (os.path.dirname(__file__)))
 		self.window = self.xml.get_widget("toplevel")
@@ -166,10 +227,14 @@ class FileVersionWindow:
 		self.window.show ()
 
 		self.file = File (file)
-		self.filename_label.set_text (self.file.info.get_name ())
+		self.filename_label.set_text (os.path.basename (file))
 		self.size_label.set_text (self.file.get_size ())
-		self.date_label.set_text (time.strftime ("%d/%m/%y %Hh%Ms%S", time.localtime(self.file.info.get_modification_time ())))
+		self.date_label.set_text (self.file.get_date ())
 		self.xml.get_widget("icon_image").set_from_pixbuf (self.file.get_icon ())
+		# Row references of the versions waiting for their icon
+		self.icon_queue = []
+		self.icon_queued = set ()
+		self.icon_idle = None
 
 		self.treeview = self.xml.get_widget("treeview")
 		self.model = gtk.ListStore(gtk.gdk.Pixbuf,
@@ -188,7 +253,8 @@ class FileVersionWindow:
 		model = treeview.get_model()
 
 		renderer = gtk.CellRendererPixbuf()
-		column = gtk.TreeViewColumn('Icon', renderer, pixbuf=COLUMN_ICON)
+		column = gtk.TreeViewColumn('Icon', renderer)
+		column.set_cell_data_func (renderer, self.__icon_data_func)
 		treeview.append_column(column)
 
 		self.date_column = gtk.TreeViewColumn('Last Modified Date', gtk.CellRendererText(),
@@ -203,14 +269,56 @@ class FileVersionWindow:
 		treeview.append_column(column)
 
 	def add_file (self, file):
+		# The icon is filled in once the row gets displayed
 		iter = self.model.append ()
 		self.model.set (iter, 
-		COLUMN_ICON, file.get_icon (),
 		COLUMN_NAME, file.path,
-		COLUMN_STRING_DATE, time.strftime ("%d/%m/%y %Hh%Ms%S", time.localtime(file.info.get_modification_time ())),
-		COLUMN_DATE, file.info.get_modification_time (),
+		COLUMN_STRING_DATE, file.get_date (),
+		COLUMN_DATE, "%d" % file.mtime,
 		COLUMN_SIZE, file.get_size ())
 
+	def __icon_data_func (self, column, cell, model, iter):
+		# Only called for the rows being displayed, so thumbnails
+		# are only generated for the versions that get looked at.
+		icon = model.get_value (iter, COLUMN_ICON)
+		filename = model.get_value (iter, COLUMN_NAME)
+		if icon == None and filename not in self.icon_queued:
+			self.icon_queued.add (filename)
+			self.icon_queue.append (gtk.TreeRowReference (model,
+						model.get_path (iter)))
+			if self.icon_idle == None:
+				self.icon_idle = gobject.idle_add (self.__load_icons)
+		cell.set_property ("pixbuf", icon)
+
+	def __load_icons (self):
+		# One at a time, to keep the window responsive
+		loaded = False
+		try:
+			while len(self.icon_queue) > 0:
+				ref = self.icon_queue.pop (0)
+				if not ref.valid ():
+					continue
+				iter = self.model.get_iter (ref.get_path ())
+				filename = self.model.get_value (iter, COLUMN_NAME)
+				self.icon_queued.discard (filename)
+				if self.model.get_value (iter, COLUMN_ICON) != None:
+					continue
+				try:
+					icon = File (filename).get_icon ()
+				except Exception:
+					# eg. the snapshot has been unmounted since
+					theme = gtk.icon_theme_get_default ()
+					icon = theme.load_icon (gtk.STOCK_FILE, 48,
+							gtk.ICON_LOOKUP_USE_BUILTIN)
+				self.model.set (iter, COLUMN_ICON, icon)
+				loaded = True
+				break
+		finally:
+			# glib drops the handler if it raises too
+			if not loaded:
+				self.icon_idle = None
+		return loaded
+
 	def exit3 (self, blah, blih):
 		self.exit (self)
 
@@ -253,11 +361,77 @@ class FileVersionWindow:
 		  p2 = subprocess.Popen(str.split ("/usr/bin/zenity --text-info --editable"), stdin=p1.stdout, stdout=subprocess.PIPE)
 
 
+class VersionCache:
+	"""
+	Remembers, for a file in a filesystem, the snapshots holding
+	each of its versions and the newest snapshot examined. Only the
+	size most recently explored files are remembered, and only while
+	their filesystem exists.
+	"""
+
+	def __init__(self, path = VERSIONCACHE, size = VERSIONCACHESIZE):
+		self.path = path
+		self.size = size
+
+	def __open (self, flag):
+		dir = os.path.dirname (self.path)
+		if not os.path.exists (dir):
+			os.makedirs (dir, 0700)
+		# Explorers opened on different files share the cache
+		lockfile = open ("%s.lock" % self.path, "w")
+		fcntl.lockf (lockfile, fcntl.LOCK_EX)
+		return lockfile, shelve.open (self.path, flag)
+
+	def load (self, fsname, path):
+		try:
+			lockfile,db = self.__open ("c")
+		except Exception:
+			return None
+		try:
+			return db.get ("%s\t%s" % (fsname, path))
+		finally:
+			db.close ()
+			lockfile.close ()
+
+	def save (self, fsname, path, entry):
+		try:
+			lockfile,db = self.__open ("c")
+		except Exception:
+			return
+		try:
+			entry["saved"] = time.time ()
+			db["%s\t%s" % (fsname, path)] = entry
+			self.__prune (db, fsname)
+		finally:
+			db.close ()
+			lockfile.close ()
+
+	def __prune (self, db, fsname):
+		keys = db.keys ()
+		fsnames = set ([key.split ("\t", 1)[0] for key in keys])
+		try:
+			found = zfs.Datasets ().get_properties (["type"], list (fsnames))
+		except RuntimeError:
+			found = {}
+		# fsname was just explored, so if it isn't found zfs(1)
+		# can't tell which filesystems have been destroyed or
+		# renamed either.
+		if fsname in found:
+			for key in keys:
+				if key.split ("\t", 1)[0] not in found:
+					del db[key]
+			keys = db.keys ()
+		if len (keys) > self.size:
+			keys.sort (key=lambda key: db[key].get ("saved", 0))
+			for key in keys[:len (keys) - self.size]:
+				del db[key]
+
 class VersionScanner(threading.Thread):
 
 	def __init__(self, window):
 		self.w = window
 		self._stopevent = threading.Event()
+		self._cond = threading.Condition()
 		threading.Thread.__init__(self)
 
 	def run(self):
@@ -269,35 +443,305 @@ class VersionScanner(threading.Thread):
 		dirs = os.listdir(snap_path)
 
 		num_dirs = len(dirs)
-		current_dir = 1
-
-		gobject.idle_add (self.w.progress.set_pulse_step,  (1.0 / num_dirs))
-		gobject.idle_add (self.w.progress.set_text,  ("Scanning for older versions (%d/%d)" % (current_dir, num_dirs)))
-
-		versions = [File (self.w.filename)]
-
-		for dir in dirs:
-			if not self._stopevent.isSet ():
-				file = File ("%s%s/%s" % (snap_path, dir, path_after_snap))
-				if file.exist :
-					if file.add_if_unique(versions):
-						gobject.idle_add (self.w.add_file, file)
-				fraction = self.w.progress.get_fraction ()
-				fraction += self.w.progress.get_pulse_step ()
-				if fraction > 1:
-					fraction = 1
-
-				gobject.idle_add (self.w.progress.set_fraction, fraction)
-				current_dir += 1
-				gobject.idle_add (self.w.progress.set_text, "Scanning for older versions (%d/%d)" % (current_dir, num_dirs))
-			else:
+		self._snap_path = snap_path
+		self._path_after_snap = path_after_snap
+		self._dirs = dirs
+		# Snapshots in creation order and the file found in each
+		self._fsname = None
+		self._dirs_unordered = set ()
+		self._ordered = []
+		self._ctimes = []
+		self._keys = {}
+		self._ranges = []
+		self._busy = 0
+		self._scanned = 0
+		# Versions are told apart by their stat details, so each
+		# one found is checked against all the others in one go.
+		# Maps each version to the snapshot it was first found in.
+		self._versions = {}
+		self._current = None
+		if self.w.file.exist:
+			self._current = self.w.file.key
+		self._shown = 0
+		# Versions waiting for their contents to be compared, and
+		# the digests of their contents by snapshot and stat key
+		self._candidates = []
+		self._digests = {}
+
+		gobject.idle_add (self.w.progress.set_text,  ("Scanning for older versions (%d/%d)" % (0, num_dirs)))
+
+		cache = VersionCache ()
+		entry = None
+		if self.w.bisect:
+			self.__order_snapshots (path_before_snap)
+			if self._fsname != None:
+				entry = self.__load_versions (cache.load (self._fsname, path_after_snap))
+		if len (self._ordered) > 0:
+			last = len (self._ordered) - 1
+			endpoints = [0, last]
+			if entry != None:
+				# Carry on from the newest snapshot examined
+				# last time, even if it has since been destroyed.
+				self._keys[0] = entry["key"]
+				endpoints = [last]
+			for index in endpoints:
+				if not self._keys.has_key (index):
+					label = self._ordered[index]
+					self._keys[index] = self.__add_version (label, self.__stat (label))
+					self._scanned += 1
+			if last > 0:
+				self._ranges.append ((0, last))
+		else:
+			self._dirs.extend (self._ordered)
+			self._ordered = []
+
+		workers = []
+		for i in range (min (SCANTHREADS, num_dirs)):
+			worker = threading.Thread (target=self.__scan_dirs)
+			worker.start ()
+			workers.append (worker)
+		# Report progress a few times a second rather than per snapshot
+		for worker in workers:
+			while worker.isAlive ():
+				worker.join (0.2)
+				self.__report_progress (num_dirs)
+		if self._stopevent.isSet ():
+			return None
+		self.__report_progress (num_dirs)
+
+		if self.w.contents:
+			self.__compare_contents ()
+			if self._stopevent.isSet ():
 				return None
 
+		if len (self._ordered) > 0:
+			last = len (self._ordered) - 1
+			versions = [label for label in self._versions.values () \
+				    if label not in self._dirs_unordered]
+			cache.save (self._fsname, path_after_snap,
+				    {"newest" : self._ordered[last],
+				     "ctime" : self._ctimes[last],
+				     "key" : self._keys[last],
+				     "versions" : versions,
+				     "digests" : self._digests})
+
 		gobject.idle_add(self.w.progress.hide)
-		gobject.idle_add(self.w.older_versions_label.set_markup , "<b>Older Versions</b> (%d) " % (len(versions) - 1))
+		gobject.idle_add(self.w.older_versions_label.set_markup , "<b>Older Versions</b> (%d) " % self._shown)
 		# sort by date
 		gobject.idle_add(self.w.date_column.emit, "clicked")
 		gobject.idle_add(self.w.date_column.emit, "clicked")
+
+	def __order_snapshots (self, path_before_snap):
+		"""
+		Moves the snapshot directories which can be put in creation
+		order from self._dirs to self._ordered. Anything else is left
+		for the linear scan.
+		"""
+		mountpoint = path_before_snap.rstrip ("/")
+		if mountpoint == "":
+			mountpoint = "/"
+		try:
+			# zfs(1) finds the filesystem mounted there itself
+			datasets = zfs.Datasets ()
+			fsnames = [name for name,props in \
+				   datasets.get_properties (["mountpoint"], [mountpoint]).items () \
+				   if props.get ("mountpoint") == mountpoint]
+			if len (fsnames) != 1:
+				return
+			snapshots = datasets.list_dataset_snapshots (fsnames[0])
+		except (RuntimeError, ValueError):
+			return
+		self._fsname = fsnames[0]
+		remaining = set (self._dirs)
+		for name,ctime in snapshots:
+			label = name.split ("@", 1)[1]
+			if label in remaining:
+				remaining.remove (label)
+				self._ordered.append (label)
+				self._ctimes.append (ctime)
+		self._dirs = list (remaining)
+		self._dirs_unordered = remaining
+
+	def __load_versions (self, entry):
+		"""
+		Lists the versions found by an earlier scan and keeps only
+		the snapshots created since. Returns None, so that every
+		snapshot gets examined again, if any of the snapshots those
+		versions were found in has been destroyed.
+		"""
+		if entry == None:
+			return None
+		self._digests = entry.get ("digests", {})
+		files = []
+		for label in entry["versions"]:
+			file = self.__stat (label)
+			if file == None:
+				return None
+			files.append ((label, file))
+		for label,file in files:
+			self.__add_version (label, file)
+		if entry["newest"] in self._ordered:
+			first = self._ordered.index (entry["newest"]) + 1
+		else:
+			first = 0
+			while first < len (self._ordered) and \
+			      self._ctimes[first] <= entry["ctime"]:
+				first += 1
+		self._scanned += first
+		self._ordered = [entry["newest"]] + self._ordered[first:]
+		self._ctimes = [entry["ctime"]] + self._ctimes[first:]
+		return entry
+
+	def __stat (self, dir):
+		path = "%s%s/%s" % (self._snap_path, dir, self._path_after_snap)
+		try:
+			return File (path, os.lstat (path))
+		except OSError:
+			return None
+
+	def __add_version (self, label, file):
+		"""
+		Records the file found in the snapshot called label, if
+		any, and returns its key.
+		"""
+		if file == None:
+			return None
+		if not self._versions.has_key (file.key):
+			self._versions[file.key] = label
+			if file.key == self._current:
+				pass
+			elif self.w.contents:
+				self._candidates.append ((label, file))
+			else:
+				self._shown += 1
+				gobject.idle_add (self.w.add_file, file)
+		return file.key
+
+	def __compare_contents (self):
+		"""
+		Lists only the versions whose contents differ from the
+		current file and from each other. Identical stat keys were
+		already merged, and versions of a size nobody else has
+		are listed without reading them.
+		"""
+		sizes = {}
+		versions = self._candidates[:]
+		if self.w.file.exist:
+			versions.append ((None, self.w.file))
+		for label,file in versions:
+			sizes[file.size] = sizes.get (file.size, 0) + 1
+		self._hashqueue = [(label, file) for label,file in versions \
+				   if sizes[file.size] > 1]
+		digests = {}
+		for label,file in self._hashqueue:
+			if self._digests.has_key ((label, file.key)):
+				digests[file.path] = self._digests[(label, file.key)]
+		self._hashqueue = [(label, file) for label,file in self._hashqueue \
+				   if not digests.has_key (file.path)]
+		total = len (self._hashqueue)
+		workers = []
+		for i in range (min (SCANTHREADS, total)):
+			worker = threading.Thread (target=self.__hash_files,
+						   args=(digests,))
+			worker.start ()
+			workers.append (worker)
+		for worker in workers:
+			while worker.isAlive ():
+				worker.join (0.2)
+				done = total - len (self._hashqueue)
+				gobject.idle_add (self.w.progress.set_fraction, done / (total * 1.0))
+				gobject.idle_add (self.w.progress.set_text, "Comparing versions (%d/%d)" % (done, total))
+		if self._stopevent.isSet ():
+			return
+
+		seen = set ()
+		if self.w.file.exist and digests.has_key (self.w.file.path):
+			seen.add (digests[self.w.file.path])
+		self._digests = {}
+		# Keep the oldest copy of each content
+		self._candidates.sort (key=lambda version: version[1].mtime)
+		for label,file in self._candidates:
+			digest = digests.get (file.path)
+			if digest != None:
+				self._digests[(label, file.key)] = digest
+				if digest in seen:
+					continue
+				seen.add (digest)
+			self._shown += 1
+			gobject.idle_add (self.w.add_file, file)
+
+	def __hash_files (self, digests):
+		while not self._stopevent.isSet ():
+			self._cond.acquire ()
+			if len (self._hashqueue) == 0:
+				self._cond.release ()
+				return
+			label,file = self._hashqueue.pop ()
+			self._cond.release ()
+			digest = file.get_digest ()
+			self._cond.acquire ()
+			digests[file.path] = digest
+			self._cond.release ()
+
+	def __scan_dirs (self):
+		while True:
+			self._cond.acquire ()
+			while not self._stopevent.isSet () and \
+			      len (self._dirs) == 0 and len (self._ranges) == 0 and \
+			      self._busy > 0:
+				# Wait for the other threads to split their ranges
+				self._cond.wait (0.2)
+			if self._stopevent.isSet () or \
+			   (len (self._dirs) == 0 and len (self._ranges) == 0):
+				self._cond.release ()
+				return
+			self._busy += 1
+			if len (self._dirs) > 0:
+				dir = self._dirs.pop ()
+				self._cond.release ()
+				file = self.__stat (dir)
+				self._cond.acquire ()
+				self._scanned += 1
+				self.__add_version (dir, file)
+			else:
+				self.__bisect (self._ranges.pop ())
+			self._busy -= 1
+			self._cond.notifyAll ()
+			self._cond.release ()
+
+	def __bisect (self, range):
+		"""
+		Looks for versions between two snapshots, both already
+		examined. The file is unchanged in between if the same
+		file is found at both ends. Called and returns with the
+		lock held.
+		"""
+		low,high = range
+		if high - low < 2:
+			return
+		first = self._keys[low]
+		last = self._keys[high]
+		if first != None and first == last:
+			self._scanned += high - low - 1
+			return
+		# The file changed, appeared or disappeared somewhere in
+		# between, so look at both halves.
+		middle = (low + high) / 2
+		self._cond.release ()
+		label = self._ordered[middle]
+		file = self.__stat (label)
+		self._cond.acquire ()
+		self._keys[middle] = self.__add_version (label, file)
+		self._scanned += 1
+		self._ranges.append ((low, middle))
+		self._ranges.append ((middle, high))
+
+	def __report_progress (self, num_dirs):
+		if num_dirs == 0:
+			return
+		scanned = self._scanned
+		gobject.idle_add (self.w.progress.set_fraction, scanned / (num_dirs * 1.0))
+		gobject.idle_add (self.w.progress.set_text, "Scanning for older versions (%d/%d)" % (scanned, num_dirs))
 	
 	def join(self, timeout=None):
 		self._stopevent.set ()
@@ -305,9 +749,18 @@ class VersionScanner(threading.Thread):
 
 def main(argv):
 	try:
-		opts, args = getopt.getopt(sys.argv[1:], "", [])
+		opts, args = getopt.getopt(sys.argv[1:], "", ["linear", "contents"])
 	except getopt.GetoptError:
 		sys.exit(2)
+	# Look in every snapshot rather than bisecting the history
+	bisect = True
+	# Only list versions whose contents differ
+	contents = False
+	for opt,arg in opts:
+		if opt == "--linear":
+			bisect = False
+		elif opt == "--contents":
+			contents = True
 	if len(args) != 2:
 		dialog = gtk.MessageDialog(None,
 			0,
@@ -322,7 +775,7 @@ def main(argv):
 		dialog.run()
 		sys.exit (2)
 
-	window = FileVersionWindow(args[0], args[1])
+	window = FileVersionWindow(args[0], args[1], bisect, contents)
 	gtk.gdk.threads_enter()
 	gtk.main()
 	gtk.gdk.threads_leave()
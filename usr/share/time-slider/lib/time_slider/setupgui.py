@@ -60,6 +60,11 @@ import dbussvc
 # vs. the total size of the pools it's expected to backup.
 RSYNCTARGETRATIO = 2
 
+# Number of filesystems whose selection is changed per zfs(1)
+# invocation when applying the configuration. Kept fairly small
+# so that progress can be reported.
+COMMITBATCHSIZE = 256
+
 # here we define the path constants so that other modules can use it.
 # this allows us to get access to the shared files without having to
 # know the actual location, we just use the location of the current
@@ -157,6 +162,9 @@ class SetupManager:
         self._rsyncIntentDic = {}
         # Dictionary that maps device ID numbers to zfs filesystem objects
         self._fsDevices = {}
+        # Description, number of filesystems done and total while
+        # filesystem selection changes are being applied.
+        self._commitProgress = None
 
         topLevel = self._xml.get_widget("toplevel")
         self._pulseDialog = self._xml.get_widget("pulsedialog")
@@ -172,37 +180,13 @@ class SetupManager:
                                          str,
                                          str,
                                          gobject.TYPE_PYOBJECT)
-        filesystems = self._datasets.list_filesystems()
-        for fsname,fsmountpoint in filesystems:
-            if (fsmountpoint == "legacy"):
-                mountpoint = _("Legacy")
-            else:
-                mountpoint = fsmountpoint
-            fs = zfs.Filesystem(fsname, fsmountpoint)
-            # Note that we don't deal with legacy mountpoints.
-            if fsmountpoint != "legacy" and fs.is_mounted():
-                self._fsDevices[os.stat(fsmountpoint).st_dev] = fs
-            snap = fs.get_auto_snap()
-            rsyncstr = fs.get_user_property(rsyncsmf.RSYNCFSTAG)
-            if rsyncstr == "true":
-                rsync = True
-            else:
-                rsync = False
-            # Rsync is only performed on snapshotted filesystems.
-            # So treat as False if rsync is set to true independently
-            self._fsListStore.append([snap, snap & rsync,
-                                     mountpoint, fs.name, fs])
-            self._initialSnapStateDic[fs.name] = snap
-            self._initialRsyncStateDic[fs.name] = snap & rsync
-        del filesystems
-
-        for fsname in self._initialSnapStateDic:
-                self._refine_filesys_actions(fsname,
-                                              self._initialSnapStateDic,
-                                              self._initialFsIntentDic)
-                self._refine_filesys_actions(fsname,
-                                              self._initialRsyncStateDic,
-                                              self._initialRsyncIntentDic)
+        # Filesystems are read in the background and added to the
+        # list as they arrive rather than holding up the window.
+        # Changes can't be applied until they have all been read.
+        self._xml.get_widget("ok").set_sensitive(False)
+        self._fsLoader = ListFilesystems(self._datasets)
+        self._fsLoader.start()
+        glib.timeout_add(100, self._monitor_filesystems)
    
         self._fsTreeView = self._xml.get_widget("fstreeview")
         self._fsTreeView.set_sensitive(False)
@@ -491,9 +475,52 @@ class SetupManager:
                                                        False))
             self._rsyncCombo.set_active_iter(iter)
 
+    def _monitor_filesystems(self):
+        alive = self._fsLoader.isAlive()
+        for row in self._fsLoader.take_rows():
+            self._fsListStore.append(row)
+            self._initialSnapStateDic[row[3]] = row[0]
+            self._initialRsyncStateDic[row[3]] = row[1]
+        if alive == True:
+            return True
+        if self._fsLoader.error != None:
+            # Committing the selection from a partial list would be
+            # misleading, so OK stays disabled.
+            topLevel = self._xml.get_widget("toplevel")
+            dialog = gtk.MessageDialog(topLevel,
+                                       0,
+                                       gtk.MESSAGE_ERROR,
+                                       gtk.BUTTONS_CLOSE,
+                                       _("Unable to list file systems"))
+            dialog.format_secondary_text(_("The list of file systems "
+                                           "could not be read."
+                                           "\n\nDetails:\n%s") \
+                                         % (self._fsLoader.error))
+            dialog.set_icon_name("time-slider-setup")
+            dialog.run()
+            dialog.hide()
+            return False
+        self._fsDevices = self._fsLoader.devices
+        for fsname in self._initialSnapStateDic:
+                self._refine_filesys_actions(fsname,
+                                              self._initialSnapStateDic,
+                                              self._initialFsIntentDic)
+                self._refine_filesys_actions(fsname,
+                                              self._initialRsyncStateDic,
+                                              self._initialRsyncIntentDic)
+        self._xml.get_widget("ok").set_sensitive(True)
+        return False
+
     def _monitor_setup(self, pulseBar):
         if self._enabler.isAlive() == True:
-            pulseBar.pulse()
+            progress = self._commitProgress
+            if progress == None:
+                pulseBar.set_text("")
+                pulseBar.pulse()
+            else:
+                text,done,total = progress
+                pulseBar.set_text(text)
+                pulseBar.set_fraction(done / float(total))
             return True
         else:
             gtk.main_quit()   
@@ -1131,23 +1158,69 @@ class SetupManager:
         return False
 
 
+    def _get_selection_changes(self, initialIntents, intents):
+        """
+        Compares the intended filesystem selection with the initial
+        one. Returns the names of the filesystems that should inherit
+        their value from their parent and a dictionary mapping each
+        value to the names of the filesystems it should be set on.
+        Intentions already inherit wherever the parent has the same
+        value, so values only get set locally where a filesystem
+        differs from its parent.
+        """
+        inherit = []
+        values = {"true" : [], "false" : []}
+        for fsname in sorted(intents.keys()):
+            try:
+                initialIntent = initialIntents[fsname]
+            except KeyError:
+                continue
+            intent = intents[fsname]
+            if intent == initialIntent:
+                continue
+            if intent.inherited == True:
+                inherit.append(fsname)
+            elif intent.selected == True:
+                values["true"].append(fsname)
+            else:
+                values["false"].append(fsname)
+        return inherit,values
+
+    def _commit_selection_changes(self, prop, initialIntents, intents, text):
+        """
+        Applies the changes in the filesystem selection to the user
+        property prop, setting or inheriting it on many filesystems
+        with each invocation of zfs(1).
+        """
+        inherit,values = self._get_selection_changes(initialIntents,
+                                                     intents)
+        batches = []
+        for value,names in [(None, inherit),
+                            ("true", values["true"]),
+                            ("false", values["false"])]:
+            for i in range(0, len(names), COMMITBATCHSIZE):
+                batches.append((value, names[i:i + COMMITBATCHSIZE]))
+        total = len(inherit) + len(values["true"]) + len(values["false"])
+        done = 0
+        for value,names in batches:
+            self._commitProgress = (text, done, total)
+            if value == None:
+                self._datasets.inherit_user_property(prop, names)
+            else:
+                self._datasets.set_user_property(prop, value, names)
+            done += len(names)
+        self._commitProgress = None
+
     def commit_filesystem_selection(self):
         """
         Commits the intended filesystem selection actions based on the
         user's UI configuration to disk. Compares with initial startup
         configuration and applies the minimum set of necessary changes.
         """
-        for fsname,fsmountpoint in self._datasets.list_filesystems():
-            fs = zfs.Filesystem(fsname, fsmountpoint)
-            try:
-                initialIntent = self._initialFsIntentDic[fsname]
-                intent = self._fsIntentDic[fsname]
-                if intent == initialIntent:
-                    continue
-                fs.set_auto_snap(intent.selected, intent.inherited)
-
-            except KeyError:
-                pass
+        self._commit_selection_changes("com.sun:auto-snapshot",
+                                       self._initialFsIntentDic,
+                                       self._fsIntentDic,
+                                       _("Updating snapshot selection"))
 
     def commit_rsync_selection(self):
         """
@@ -1155,25 +1228,10 @@ class SetupManager:
         user's UI configuration to disk. Compares with initial startup
         configuration and applies the minimum set of necessary changes.
         """
-        for fsname,fsmountpoint in self._datasets.list_filesystems():
-            fs = zfs.Filesystem(fsname, fsmountpoint)
-            try:
-                initialIntent = self._initialRsyncIntentDic[fsname]
-                intent = self._rsyncIntentDic[fsname]
-                if intent == initialIntent:
-                    continue
-                if intent.inherited == True and \
-                    initialIntent.inherited == False:
-                    fs.unset_user_property(rsyncsmf.RSYNCFSTAG)
-                else:
-                    if intent.selected == True:
-                        value = "true"
-                    else:
-                        value = "false"
-                    fs.set_user_property(rsyncsmf.RSYNCFSTAG,
-                                         value)
-            except KeyError:
-                pass
+        self._commit_selection_changes(rsyncsmf.RSYNCFSTAG,
+                                       self._initialRsyncIntentDic,
+                                       self._rsyncIntentDic,
+                                       _("Updating backup selection"))
 
     def setup_rsync_config(self):
         if self._rsyncEnabled == True:
@@ -1252,6 +1310,65 @@ class SetupManager:
         p = subprocess.Popen(cmdpath, close_fds=True)
 
 
+class ListFilesystems(threading.Thread):
+    """
+    Reads the snapshot and rsync settings of every filesystem using
+    a single invocation of zfs(1). The list store rows built from
+    them are picked up by the main thread through take_rows() while
+    the remaining filesystems are still being read.
+    """
+
+    def __init__(self, datasets):
+        threading.Thread.__init__(self)
+        # Don't hold up quitting the setup dialog while a long listing
+        # is still being read. zfs(1) is killed by SIGPIPE once its
+        # output is closed.
+        self.setDaemon(True)
+        self._datasets = datasets
+        self._lock = threading.Lock()
+        self._rows = []
+        # Maps device ID numbers to mounted zfs filesystem objects
+        self.devices = {}
+        self.error = None
+
+    def take_rows(self):
+        self._lock.acquire()
+        rows = self._rows
+        self._rows = []
+        self._lock.release()
+        return rows
+
+    def run(self):
+        props = ["mounted", "mountpoint", "com.sun:auto-snapshot",
+                 rsyncsmf.RSYNCFSTAG]
+        try:
+            for fsname,values in \
+                self._datasets.stream_filesystem_properties(props):
+                fsmountpoint = values.get("mountpoint")
+                if (fsmountpoint == "legacy"):
+                    mountpoint = _("Legacy")
+                else:
+                    mountpoint = fsmountpoint
+                fs = zfs.Filesystem(fsname, fsmountpoint)
+                # Note that we don't deal with legacy mountpoints.
+                if fsmountpoint != "legacy" and \
+                   values.get("mounted") == "yes":
+                    try:
+                        self.devices[os.stat(fsmountpoint).st_dev] = fs
+                    except OSError:
+                        pass
+                snap = values.get("com.sun:auto-snapshot") == "true"
+                rsync = values.get(rsyncsmf.RSYNCFSTAG) == "true"
+                # Rsync is only performed on snapshotted filesystems.
+                # So treat as False if rsync is set to true independently
+                self._lock.acquire()
+                self._rows.append([snap, snap & rsync,
+                                   mountpoint, fs.name, fs])
+                self._lock.release()
+        except RuntimeError, message:
+            self.error = str(message)
+
+
 class EnableService(threading.Thread):
 
     def __init__(self, setupManager):
@@ -64,6 +64,9 @@ STATUS_EMERGENCY = 3 # Above specified emergency threshhold level
 
 intervals = {"weeks" : _WEEK, "days" : _DAY, "hours" : _HOUR, "minutes" : _MINUTE}
 
+# User property/hold tag prefix used by time-slider plugin instances
+PLUGINPROPBASE = "org.opensolaris:time-slider-plugin"
+
 
 class SnapshotManager(threading.Thread):
 
@@ -155,6 +158,11 @@ class SnapshotManager(threading.Thread):
                         # We took too long and missed a snapshot, so break out
                         # and catch up on it the next time through the loop
                         continue
+                # Wake up in time to execute any deferred plugin triggers
+                drainwait = self._plugin.drain_plugins()
+                if drainwait != None and \
+                   (waittime == None or drainwait < waittime):
+                    waittime = drainwait
                 # waittime could be None if no auto-snap schedules are online
                 self._conditionLock.acquire()
                 if waittime:
@@ -748,6 +756,13 @@ class SnapshotManager(threading.Thread):
             self.exitCode = smf.SMF_EXIT_ERR_FATAL
             # Propogate the error up to the thread's run() method.
             raise RuntimeError,message
+
+        try:
+            sources = self._list_replication_sources(zpool)
+        except RuntimeError,message:
+            sys.stderr.write("Error (non-fatal) listing replication " \
+                             "sources while recovering pool capacity\n")
+            sources = {}
    
         while zpool.get_capacity() > threshold:
             if len(snapshots) == 0:
@@ -781,6 +796,8 @@ class SnapshotManager(threading.Thread):
             # will mostly non-zero so we should get more effectiveness as a
             # result of deleting snapshots since they should be nearly always
             # non zero sized.
+            if snapname in sources:
+                self._release_replication_source(snapshot, sources[snapname])
             util.debug("Destroying %s" % snapname, self.verbose)
             try:
                 snapshot.destroy()
@@ -796,6 +813,48 @@ class SnapshotManager(threading.Thread):
             # Give zfs some time to recalculate.
             time.sleep(3)
         
+    def _list_replication_sources(self, zpool):
+        """
+        Returns a dictionary mapping each snapshot in zpool that a
+        plugin instance last sent, and will send its next incremental
+        stream from, to the plugin hold tags that may be pinning it:
+        {snapshotname : [tag, ...]}
+        """
+        sources = {}
+        cmd = [zfs.ZFSCMD, "get", "-H", "-r", "-s", "local",
+               "-t", "filesystem,volume",
+               "-o", "name,property,value", "all", zpool.name]
+        outdata,errdata = util.run_command(cmd)
+        for line in outdata.rstrip('\n').split('\n'):
+            line = line.split('\t')
+            if len(line) < 3 or \
+               line[1].find(PLUGINPROPBASE + ':') != 0:
+                continue
+            name,prop,label = line
+            sources.setdefault("%s@%s" % (name, label), []).append(prop)
+        return sources
+
+    def _release_replication_source(self, snapshot, tags):
+        """
+        Bookmarks a snapshot that plugins will send their next
+        incremental stream from and releases the plugins' holds on it,
+        so that destroying it recovers space without breaking
+        replication. The plugins fall back to the bookmark as their
+        incremental source. The holds are left in place if the
+        bookmark can't be created.
+        """
+        bookmarks = self._datasets.create_bookmarks([snapshot.name])
+        if len(bookmarks) == 0:
+            sys.stderr.write("Warning: Cleanup failed to bookmark " \
+                             "replication source: %s\n" % (snapshot.name))
+            return
+        held = snapshot.holds()
+        for tag in tags:
+            if tag in held:
+                util.debug("Releasing %s hold on bookmarked %s" \
+                           % (tag, snapshot.name), self.verbose)
+                self._datasets.release_snapshots(tag, [snapshot.name])
+
     def _send_to_syslog(self):
         for zpool in self._zpools:
             status = self._poolstatus[zpool.name]
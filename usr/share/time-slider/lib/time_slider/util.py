@@ -50,6 +50,41 @@ def run_command(command, raise_on_try=True):
                             (str(command), err, errdata)
     return outdata,errdata
 
+def run_command_chunked(command, args, raise_on_try=True):
+    """
+    Runs command as many times as necessary, appending as many of the
+    arguments in args to each invocation as will safely fit within
+    the system's ARG_MAX limit.
+    Returns a tuple of the concatenated standard out and standard
+    error of all invocations.
+    Throws a RunTimeError under the same conditions as run_command()
+    """
+    try:
+        argMax = os.sysconf("SC_ARG_MAX")
+    except (ValueError, OSError):
+        argMax = 65536
+    # Leave plenty of room for the environment
+    limit = argMax / 2
+    base = sum([len(arg) + 1 for arg in command])
+    outdata = ""
+    errdata = ""
+    chunk = []
+    size = base
+    for arg in args:
+        if len(chunk) > 0 and size + len(arg) + 1 > limit:
+            out,err = run_command(command + chunk, raise_on_try)
+            outdata += out
+            errdata += err
+            chunk = []
+            size = base
+        chunk.append(arg)
+        size += len(arg) + 1
+    if len(chunk) > 0:
+        out,err = run_command(command + chunk, raise_on_try)
+        outdata += out
+        errdata += err
+    return outdata,errdata
+
 def debug(message, verbose):
     """
     Prints message out to standard error and syslog if
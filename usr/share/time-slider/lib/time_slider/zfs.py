@@ -22,6 +22,7 @@
 
 import subprocess
 import re
+import tempfile
 import threading
 from bisect import insort, bisect_left, bisect_right
 
@@ -34,6 +35,10 @@ PFCMD = "/usr/bin/pfexec"
 ZFSCMD = "/usr/sbin/zfs"
 ZPOOLCMD = "/usr/sbin/zpool"
 
+# Maximum length of a comma separated list of snapshots to destroy
+# with a single invocation of zfs(1)
+MAXSNAPLIST = 32768
+
 
 class Datasets(Exception):
     """
@@ -349,6 +354,106 @@ class Datasets(Exception):
         Datasets.snapshotslock.release()
         return snapshots
 
+    def stream_snapshots(self, props = None):
+        """
+        Generates the [snapshotname, creationtime] pair of every
+        snapshot on the system as zfs(1) lists them, grouped by
+        filesystem or volume rather than sorted by creation date. Lets
+        callers process snapshots as they are found instead of waiting
+        for, and holding on to, the complete list. The parsable value
+        of each property in props is appended to each pair.
+        Throws a RuntimeError once the list is exhausted if zfs(1)
+        failed.
+        """
+        if props == None:
+            props = []
+        cmd = [ZFSCMD, "list", "-H", "-p", "-t", "snapshot",
+               "-o", ",".join(["name", "creation"] + props)]
+        # Collect standard error in a file so that zfs(1) can't block
+        # writing to it while standard out is being read.
+        errfile = tempfile.TemporaryFile()
+        try:
+            p = subprocess.Popen(cmd,
+                                 stdout=subprocess.PIPE,
+                                 stderr=errfile,
+                                 close_fds=True)
+        except OSError, message:
+            raise RuntimeError, "%s subprocess error:\n %s" % \
+                                (cmd, str(message))
+        for line in p.stdout:
+            details = line.rstrip('\n').split('\t')
+            if len(details) < 2 + len(props):
+                continue
+            yield [details[0], long(details[1])] + details[2:]
+        err = p.wait()
+        errfile.seek(0)
+        errdata = errfile.read()
+        errfile.close()
+        if err != 0:
+            raise RuntimeError, '%s failed with exit code %d\n%s' % \
+                                (str(cmd), err, errdata)
+
+    def stream_filesystem_properties(self, props):
+        """
+        Generates a [filesystemname, {property : value}] pair for every
+        filesystem on the system with the values of the properties in
+        props, as a single invocation of zfs(1) reports them. Callers
+        can start on the first filesystems while the rest are still
+        being read. Throws a RuntimeError once the list is exhausted
+        if zfs(1) failed.
+        """
+        cmd = [ZFSCMD, "get", "-H", "-t", "filesystem",
+               "-o", "name,property,value", ",".join(props)]
+        errfile = tempfile.TemporaryFile()
+        try:
+            p = subprocess.Popen(cmd,
+                                 stdout=subprocess.PIPE,
+                                 stderr=errfile,
+                                 close_fds=True)
+        except OSError, message:
+            raise RuntimeError, "%s subprocess error:\n %s" % \
+                                (cmd, str(message))
+        # All the properties of a filesystem are listed together
+        name = None
+        values = {}
+        for line in p.stdout:
+            details = line.rstrip('\n').split('\t')
+            if len(details) < 3:
+                continue
+            if details[0] != name:
+                if name != None:
+                    yield [name, values]
+                name = details[0]
+                values = {}
+            values[details[1]] = details[2]
+        if name != None:
+            yield [name, values]
+        err = p.wait()
+        errfile.seek(0)
+        errdata = errfile.read()
+        errfile.close()
+        if err != 0:
+            raise RuntimeError, '%s failed with exit code %d\n%s' % \
+                                (str(cmd), err, errdata)
+
+    def list_dataset_snapshots(self, name):
+        """
+        List the snapshots of the filesystem or volume name alone,
+        sorted by creation. Oldest listed first, in the same
+        [snapshotname, creationtime] form as list_snapshots(), which
+        has to look up every snapshot on the system.
+        """
+        cmd = [ZFSCMD, "list", "-H", "-p", "-t", "snapshot", "-d", "1",
+               "-s", "createtxg", "-o", "name,creation", name]
+        outdata,errdata = util.run_command(cmd)
+        result = []
+        for line in outdata.rstrip('\n').split('\n'):
+            line = line.split('\t')
+            if len(line) < 2:
+                continue
+            result.append([line[0], long(line[1])])
+        return result
+
     def list_cloned_snapshots(self):
         """
         Returns a list of snapshots that have cloned filesystems
@@ -382,10 +487,274 @@ class Datasets(Exception):
         result = []
         for line in outdata.rstrip().split('\n'):
             details = line.split()
+            if len(details) == 0:
+                continue
             if details[0] != "0":
                 result.append(details[1])
         return result
 
+    def list_holds(self, snapnames):
+        """
+        Returns a dictionary mapping each snapshot in snapnames that
+        has one or more user holds to a list of its hold tags:
+        {snapshotname : [tag, ...]}
+        Requires only one invocation of zfs(1) for the entire list in
+        most cases.
+        """
+        result = {}
+        if len(snapnames) == 0:
+            return result
+        cmd = [ZFSCMD, "holds"]
+        # Snapshots that have since been destroyed will cause a non
+        # zero exit status, so just report on what we got back.
+        outdata,errdata = util.run_command_chunked(cmd, snapnames, False)
+        for line in outdata.rstrip().split('\n'):
+            line = line.split()
+            # Filter out blank lines and the "NAME TAG TIMESTAMP"
+            # column headings
+            if len(line) < 2 or (line[0] == "NAME" and line[1] == "TAG"):
+                continue
+            result.setdefault(line[0], []).append(line[1])
+        return result
+
+    def hold_snapshots(self, tag, snapnames):
+        """
+        Place a hold with the specified "tag" string on each snapshot
+        in snapnames using as few invocations of zfs(1) as possible.
+        Returns the list of snapshots that are held with "tag".
+        Snapshots that no longer exist are excluded from the result.
+        """
+        if len(snapnames) == 0:
+            return []
+        cmd = [PFCMD, ZFSCMD, "hold", tag]
+        try:
+            util.run_command_chunked(cmd, snapnames)
+            return snapnames[:]
+        except RuntimeError:
+            pass
+        # Something in the list was destroyed or already held. Fall back
+        # to doing it one at a time to figure out what.
+        result = []
+        for snapname in snapnames:
+            snapshot = Snapshot(snapname)
+            if snapshot.exists() == False:
+                continue
+            try:
+                snapshot.hold(tag)
+            except RuntimeError:
+                if tag not in snapshot.holds():
+                    continue
+            result.append(snapname)
+        return result
+
+    def release_snapshots(self, tag, snapnames):
+        """
+        Release the hold with the specified "tag" string on each snapshot
+        in snapnames using as few invocations of zfs(1) as possible.
+        Snapshots that no longer exist or are not held are ignored.
+        """
+        if len(snapnames) == 0:
+            return
+        cmd = [PFCMD, ZFSCMD, "release", tag]
+        try:
+            util.run_command_chunked(cmd, snapnames)
+        except RuntimeError:
+            # Fall back to doing it one at a time, ignoring failures
+            holds = self.list_holds(snapnames)
+            for snapname in snapnames:
+                if tag in holds.get(snapname, []):
+                    Snapshot(snapname).release(tag)
+        # Releasing the snapshots might cause them to get automatically
+        # deleted by zfs.
+        self.refresh_snapshots()
+
+    def set_user_property(self, prop, value, names):
+        """
+        Set the user property "prop" to "value" on each dataset in names
+        using as few invocations of zfs(1) as possible.
+        Datasets that no longer exist are ignored.
+        """
+        if len(names) == 0:
+            return
+        cmd = [PFCMD, ZFSCMD, "set", "%s=%s" % (prop, value)]
+        try:
+            util.run_command_chunked(cmd, names)
+        except RuntimeError:
+            # Fall back to doing it one at a time
+            for name in names:
+                dataset = ReadableDataset(name)
+                if dataset.exists() == True:
+                    dataset.set_user_property(prop, value)
+
+    def inherit_user_property(self, prop, names):
+        """
+        Clear the local value of the user property "prop" on each
+        dataset in names, so that it is inherited from the parent,
+        using as few invocations of zfs(1) as possible.
+        Datasets that no longer exist are ignored.
+        """
+        if len(names) == 0:
+            return
+        cmd = [PFCMD, ZFSCMD, "inherit", prop]
+        try:
+            util.run_command_chunked(cmd, names)
+        except RuntimeError:
+            # Fall back to doing it one at a time
+            for name in names:
+                dataset = ReadableDataset(name)
+                if dataset.exists() == True:
+                    dataset.unset_user_property(prop)
+
+    def create_bookmarks(self, snapnames):
+        """
+        Create a bookmark of each snapshot in snapnames, named after the
+        snapshot with the "@" replaced by "#". zfs(1) can only bookmark
+        one snapshot per invocation. Returns the list of bookmarks that
+        exist afterwards, including any that already existed.
+        """
+        failed = []
+        for snapname in snapnames:
+            try:
+                Snapshot(snapname).create_bookmark()
+            except RuntimeError:
+                failed.append(snapname.replace('@', '#', 1))
+        bookmarks = [snapname.replace('@', '#', 1) for snapname in snapnames]
+        if len(failed) > 0:
+            existing = self.get_properties(["type"], failed)
+            bookmarks = [name for name in bookmarks \
+                         if name not in failed or name in existing]
+        return bookmarks
+
+    def destroy_bookmarks(self, names):
+        """
+        Destroy each bookmark in names. Bookmarks that no longer exist
+        are ignored.
+        """
+        for name in names:
+            cmd = [PFCMD, ZFSCMD, "destroy", name]
+            try:
+                util.run_command(cmd)
+            except RuntimeError:
+                pass
+
+    def destroy_snapshots(self, snapnames, deferred=True):
+        """
+        Destroy each snapshot in snapnames. The snapshots of each
+        filesystem or volume are destroyed together with a single
+        invocation of zfs(1), passing them as a comma separated list.
+        Snapshots that no longer exist are ignored. Performs deferred
+        destruction by default.
+        Returns a list of error messages, one for each snapshot that
+        could not be destroyed.
+        """
+        groups = {}
+        for snapname in snapnames:
+            snapshot = Snapshot(snapname)
+            groups.setdefault(snapshot.fsname, []).append(snapshot.snaplabel)
+        cmd = [PFCMD, ZFSCMD, "destroy"]
+        if deferred == True:
+            cmd.append("-d")
+        errors = []
+        for fsname in sorted(groups.keys()):
+            # Keep each list well within the maximum argument length
+            lists = []
+            snaplist = ""
+            for snaplabel in groups[fsname]:
+                if len(snaplist) > 0 and \
+                   len(snaplist) + len(snaplabel) >= MAXSNAPLIST:
+                    lists.append(snaplist)
+                    snaplist = ""
+                if len(snaplist) > 0:
+                    snaplist += ","
+                snaplist += snaplabel
+            lists.append(snaplist)
+            for snaplist in lists:
+                try:
+                    util.run_command(cmd + ["%s@%s" % (fsname, snaplist)])
+                except RuntimeError:
+                    # Fall back to doing it one at a time to find out
+                    # which ones failed.
+                    for snaplabel in snaplist.split(','):
+                        snapshot = Snapshot("%s@%s" % (fsname, snaplabel))
+                        try:
+                            snapshot.destroy(deferred)
+                        except RuntimeError, message:
+                            errors.append(str(message))
+        # Clear the global snapshot cache so that a rescan will be
+        # triggered on the next call to Datasets.list_snapshots()
+        self.refresh_snapshots()
+        return errors
+
+    def get_reclaimable_size(self, fsname, snaplabels):
+        """
+        Returns the number of bytes that destroying the snapshots of
+        the filesystem or volume fsname in snaplabels would free, as
+        estimated by a dry run of zfs destroy. Each element of
+        snaplabels is either the label of a single snapshot, or a
+        range of snapshots in the form "firstlabel%lastlabel".
+        """
+        cmd = [PFCMD, ZFSCMD, "destroy", "-n", "-v", "-p",
+               "%s@%s" % (fsname, ",".join(snaplabels))]
+        outdata,errdata = util.run_command(cmd)
+        for line in outdata.split('\n'):
+            details = line.split('\t')
+            if len(details) == 2 and details[0] == "reclaim":
+                return long(details[1])
+        return 0L
+
+    def list_send_sources(self, names):
+        """
+        Returns the snapshots and bookmarks of each filesystem or volume
+        in names, which can serve as the source of an incremental send
+        stream, in the form of a dictionary:
+        {datasetname : [snapshot or bookmark name, ...]}
+        Each list is ordered oldest first, with a snapshot listed after
+        any bookmark of it. Requires only one invocation of zfs(1) for
+        the entire list in most cases. Datasets that no longer exist
+        are excluded from the result.
+        """
+        result = {}
+        if len(names) == 0:
+            return result
+        cmd = [ZFSCMD, "list", "-H", "-p", "-o", "createtxg,name",
+               "-t", "snapshot,bookmark", "-d", "1"]
+        outdata,errdata = util.run_command_chunked(cmd, names, False)
+        sources = []
+        for line in outdata.rstrip('\n').split('\n'):
+            line = line.split('\t')
+            if len(line) < 2:
+                continue
+            # Sort snapshots after bookmarks of the same txg so that
+            # the snapshot is preferred when both are usable.
+            sources.append([long(line[0]), '@' in line[1], line[1]])
+        sources.sort()
+        for createtxg,isSnapshot,name in sources:
+            dataset = name.replace('#', '@', 1).split('@', 1)[0]
+            result.setdefault(dataset, []).append(name)
+        return result
+
+    def get_properties(self, props, names):
+        """
+        Returns the values of the properties in the list props for each
+        dataset in names in the form of a dictionary:
+        {datasetname : {property : value}}
+        Requires only one invocation of zfs(1) for the entire list in
+        most cases. Datasets that no longer exist are excluded from the
+        result. Numeric values are returned in parsable (exact) form.
+        """
+        result = {}
+        if len(names) == 0:
+            return result
+        cmd = [ZFSCMD, "get", "-H", "-p", "-o", "name,property,value",
+               ",".join(props)]
+        outdata,errdata = util.run_command_chunked(cmd, names, False)
+        for line in outdata.rstrip('\n').split('\n'):
+            line = line.split('\t')
+            if len(line) < 3:
+                continue
+            result.setdefault(line[0], {})[line[1]] = line[2]
+        return result
+
     def refresh_snapshots(self):
         """
         Should be called when snapshots have been created or deleted
@@ -746,6 +1115,19 @@ class Snapshot(ReadableDataset):
         # triggered on the next call to Datasets.list_snapshots()
         self.datasets.refresh_snapshots()
 
+    def create_bookmark(self):
+        """
+        Create a bookmark of the snapshot, named after the snapshot with
+        the "@" replaced by "#". Returns the name of the bookmark.
+        A bookmark keeps no data alive but can still be used as the
+        source of an incremental send stream once the snapshot has
+        been destroyed.
+        """
+        bookmark = "%s#%s" % (self.fsname, self.snaplabel)
+        cmd = [PFCMD, ZFSCMD, "bookmark", self.name, bookmark]
+        outdata,errdata = util.run_command(cmd)
+        return bookmark
+
     def hold(self, tag):
         """
         Place a hold on the snapshot with the specified "tag" string.
@@ -776,6 +1158,31 @@ class Snapshot(ReadableDataset):
                 results.append(line[1])
         return results
 
+    def diff(self, snapshot):
+        """
+        Returns a list of changes made to the filesystem between this
+        snapshot and the later snapshot "snapshot", as reported by
+        "zfs diff". Each element of the list is of the form:
+        [change, path] or, for renamed paths: ["R", oldpath, newpath]
+        where change is one of "-", "+", "M" or "R". Paths are absolute
+        paths under the filesystem's mountpoint.
+        """
+        cmd = [PFCMD, ZFSCMD, "diff", "-H", self.name, snapshot.name]
+        outdata,errdata = util.run_command(cmd)
+        results = []
+        for line in outdata.rstrip('\n').split('\n'):
+            if len(line) == 0:
+                continue
+            fields = line.split('\t')
+            # zfs diff escapes whitespace, backslashes and non printable
+            # characters in path names as a backslash followed by a
+            # 4 digit octal character code.
+            results.append([fields[0]] + \
+                           [re.sub(r'\\([0-7]{4})',
+                                   lambda m: chr(int(m.group(1), 8)),
+                                   path) for path in fields[1:]])
+        return results
+
     def release(self, tag,):
         """
         Release the hold on the snapshot with the specified "tag" string.